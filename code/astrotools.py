@@ -16,6 +16,9 @@ The module **astrotools** is a set of functions for astrophysical analysis devel
 :Requirements:
     The following modules should already be installed in your computer: `asciidata`_, `matplotlib`_, `numpy`_, `pyfits`_, and `scipy`_.
 
+:Imports:
+    Only numpy is imported with astrotools. matplotlib, scipy, and astropy are imported by the functions that use them, the first time they are called, so that reading, combining, and normalizing spectra never loads matplotlib (see IMPORT_BUDGET).
+
 '''
 
 # II ++++++++++++++++++++++++ EXTERNAL MODULES ++++++++++++++++++++++++++++++++
@@ -23,20 +26,25 @@ The module **astrotools** is a set of functions for astrophysical analysis devel
 
 # Basic Python modules
 import os
-import pdb
-import types
 
 # Third party Python modules
-import matplotlib
-import matplotlib.pyplot as plt
+# (matplotlib, scipy, and astropy are imported inside the functions that use them)
 import numpy as np
-import astropy.io.fits as pf
-import scipy.interpolate as spi
-import scipy.ndimage as spn
-import scipy.stats as sps
 
 # III +++++++++++++++++++++++ PUBLIC FUNCTIONS ++++++++++++++++++++++++++++++++
 # Functions meant to be used by end users of astrotools. Use only lower case characters to name functions.
+
+# Default maximum size (in bytes) of the folder used by read_spec to cache spectra
+CACHE_SIZE = 500 * 1024 ** 2
+
+# Kernel length (in data points) from which smooth_batch convolves using FFT
+FFT_KERNEL = 64
+
+# Maximum time (in seconds) that importing astrotools should take, without
+# loading matplotlib (checked by import_budget.py)
+IMPORT_BUDGET = 0.5
+
+
 def avg_flux(startW, endW, SpecData, median=False, verbose=True):
     '''
     (by Damian, Dan, & Jocelyn)
@@ -64,117 +72,99 @@ def avg_flux(startW, endW, SpecData, median=False, verbose=True):
     
     '''
     
-    Wavelength_big = SpecData[0]
-    Flux_big = SpecData[1]
-    
-    if not(isinstance(Wavelength_big, np.ndarray)):
-        Wavelength_big = np.array( Wavelength_big)
-    if not(isinstance(Flux_big, np.ndarray)):
-        Flux_big = np.array( Flux_big)
-    
+    Wavelength = np.asarray(SpecData[0], dtype=float)
+    Flux = np.asarray(SpecData[1], dtype=float)[np.newaxis,:]
     if len(SpecData) >= 3:
-        Sigma_big = SpecData[2]
-        if not(isinstance(Sigma_big, np.ndarray)):
-            Sigma_big = np.array( Sigma_big)
+        Sigma = np.asarray(SpecData[2], dtype=float)[np.newaxis,:]
+    else:
+        Sigma = None
+    
+    avgs, sigs, status = __avg_flux_windows(Wavelength, Flux, Sigma, \
+                                            np.array([startW], dtype=float), \
+                                            np.array([endW], dtype=float))
     
     # See if the wavelength range falls inside the wavelength array
-    if np.min(Wavelength_big) > startW or np.max(Wavelength_big) < endW:
+    if status[0] == 1:
         if verbose == True:
             print('avg_flux: wavelength interval out of range')
         return
     # See that wavelength range does not fall between data points in 
     # wavelength array
-    set1 = set(list(np.where( Wavelength_big >= startW)[0]))
-    newEnd = endW + .0022
-    set2 = set(list(np.where(Wavelength_big <= endW + .0022)[0]))
-    temp = np.array(list(set1.intersection(set2)))
-    if len(temp) == 0:
+    if status[0] == 2:
         if verbose == True:
             print('avg_flux: there is no data in the selected interval')
         return
     
-    # Winds the pixel scale
-    temp = np.where(Wavelength_big >= startW)[0]
-    pix_scale = Wavelength_big[temp[0]+1] - Wavelength_big[temp[0]]
-    
-    # Find wavelengths in array that are in interval and make a new array
-    set1 = set(list(np.where(Wavelength_big + pix_scale / 2 >= startW)[0]))
-    set2 = set(list(np.where(Wavelength_big - pix_scale / 2 <= endW)[0]))
-    # For some reason, temp1 may be slightly out of order, so sort it:
-    temp1 = np.array(list(set1.intersection(set2)))
-    temp  = np.sort(temp1)
-    Wavelength = Wavelength_big[temp]
-    Flux = Flux_big[temp]
-    if len(SpecData) >= 3:
-        Sigma = Sigma_big[temp]
-    num_pixels = len(Wavelength)
-    first = 0
-    last = num_pixels - 1
-    if num_pixels >= 1:
-    # Determine fractional pixel value on the edge of the region
-        frac1 = (Wavelength[first] + pix_scale / 2 - startW) / pix_scale
-        frac2 = (endW - Wavelength[last] + pix_scale / 2) / pix_scale
-        #sums the fluxes in the interval
-        sumflux = 0
-        sumsigma2 = 0
-        for n in np.arange(first, num_pixels):
-            if n == first:
-                pixflux = frac1 * Flux[n]
-            elif n == last:
-                pixflux = frac2 * Flux[n]
-            else:
-                pixflux = Flux[n]
-            sumflux = sumflux + pixflux
-            
-            if len(SpecData) >= 3:
-                if n == first:
-                    sigflux2 = frac1**2 * Sigma[n]**2
-                if n == last:
-                    sigflux2 = frac2**2 * Sigma[n]**2
-                else:
-                    sigflux2 = Sigma[n]**2
-                sumsigma2 += sigflux2
-        
-        realpix = num_pixels - 2 + frac1 + frac2
-        avgflux = sumflux / realpix
-        
-        #Use the sample variance if the sigma spectrum is not present
-        #to estimate uncertainty
-        if len(SpecData) >= 3:
-            sigflux = np.sqrt(sumsigma2) / realpix
-        else:
-            elementdev = 0
-            sumdev = 0
-            for x in range(len(Flux)):
-                elementdev = Flux[x] - np.mean(Flux)
-                sumdev += elementdev**2
-            sigflux = np.sqrt((sumdev)/(num_pixels-1)) \
-                      / np.sqrt(num_pixels)
+    avgflux = avgs[0,0]
+    sigflux = sigs[0,0]
     
-    else:
-        frac = (endW - startW) / pix_scale
-        avgflux = frac * Flux[0]
+    if median == True:
+        avgflux = __avg_flux_median(Wavelength, Flux[0], startW, endW, avgflux, \
+                                    verbose)
     
-    if median == True and num_pixels > 5:
-        if verbose == True:
-            print('median worked')
-        old = avgflux
-        avgflux = np.median(Flux)
-        
-        if 100 * np.abs(avgflux - old) / old > 3:
-            print('avg_flux: WARNING: difference between average and median ' \
-                  & 'is greater than 3%')
-            print('avg_flux: median = ' + str(avgflux) + ',\t' + ' average = ' \
-                  + str(old))
-            print('avg_flux: difference % = ' + \
-                  str(100 * np.abs(avgflux - old) / old))
-        else:
-            if verbose == True:
-                print('median worked')
-        
     return [avgflux, sigflux]
 
 
+def avg_flux_batch(windows, specData, median=False, verbose=False):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Calculate the average (or median) flux values of many spectra on many wavelength ranges at once, the same way *avg_flux* does for one spectrum and one range. The output is a list of two numpy arrays of shape (number of spectra, number of ranges): the average flux values in position 0, and their uncertainties in position 1. Ranges that fall outside a spectrum, or that contain no data, get nans.
+    
+    *windows*
+      Array of wavelength ranges, with shape (number of ranges, 2); each row has the lower limit in position 0 and the upper limit in position 1.
+    *specData*
+      Python list of spectra, where each spectrum is an array having wavelength in position 0, flux in position 1, and optional uncertainties in position 2; missing spectra (None) get nans. Alternatively, a stack of spectra on a shared wavelength grid: a Python list with the wavelength array in position 0, a 2-D flux array (one spectrum per row) in position 1, and an optional 2-D uncertainty array in position 2.
+    *median*
+      Boolean: Find the median instead of the average.
+    *verbose*
+      Boolean: Print warning messages.
+    '''
+    
+    windows = np.atleast_2d(np.asarray(windows, dtype=float))
+    startWs = windows[:,0]
+    endWs   = windows[:,1]
+    
+    # Stack of spectra on a shared wavelength grid
+    if np.ndim(specData[0]) == 1 and np.ndim(specData[1]) == 2:
+        stackWl = np.asarray(specData[0], dtype=float)
+        stackFlux = np.asarray(specData[1], dtype=float)
+        stackSigma = None
+        if len(specData) >= 3:
+            stackSigma = np.asarray(specData[2], dtype=float)
+        avgs, sigs, status = __avg_flux_windows(stackWl, stackFlux, stackSigma, \
+                                                startWs, endWs)
+        if median:
+            for spIdx in range(stackFlux.shape[0]):
+                for winIdx in np.where(status == 0)[0]:
+                    avgs[spIdx,winIdx] = __avg_flux_median(stackWl, stackFlux[spIdx], \
+                                         startWs[winIdx], endWs[winIdx], \
+                                         avgs[spIdx,winIdx], verbose)
+        return [avgs, sigs]
+    
+    # List of spectra: each one gets its own wavelength grid
+    avgs = np.zeros((len(specData), len(windows))) * np.nan
+    sigs = np.zeros((len(specData), len(windows))) * np.nan
+    for spIdx, spData in enumerate(specData):
+        if spData is None:
+            continue
+        spWl = np.asarray(spData[0], dtype=float)
+        spFlux = np.asarray(spData[1], dtype=float)
+        spSigma = None
+        if len(spData) >= 3:
+            spSigma = np.asarray(spData[2], dtype=float)[np.newaxis,:]
+        tmpAvgs, tmpSigs, status = __avg_flux_windows(spWl, spFlux[np.newaxis,:], \
+                                                      spSigma, startWs, endWs)
+        avgs[spIdx] = tmpAvgs[0]
+        sigs[spIdx] = tmpSigs[0]
+        if median:
+            for winIdx in np.where(status == 0)[0]:
+                avgs[spIdx,winIdx] = __avg_flux_median(spWl, spFlux, startWs[winIdx], \
+                                     endWs[winIdx], avgs[spIdx,winIdx], verbose)
+    
+    return [avgs, sigs]
+
+
 def clean_outliers(data, thresh):
     '''
     (by Alejandro N |uacute| |ntilde| ez)
@@ -196,8 +186,8 @@ def clean_outliers(data, thresh):
         return
     
     # Calculate median and median absolute deviation
-    med = sps.nanmedian(data)
-    mad = 1.482 * sps.nanmedian(abs(data-med))
+    med = np.nanmedian(data)
+    mad = 1.482 * np.nanmedian(abs(data-med))
     
     dataClean = np.array(data).copy()
     if mad == 0:
@@ -210,62 +200,91 @@ def clean_outliers(data, thresh):
     return dataClean
 
 
+def comb_spec(ip_spectra, forcesimple=False, extremes=False, renormalize=False):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Combine spectra already interpolated into a common wavelength grid by *resample_spec*, calculating all statistics at once from the 2-D flux array. The output is a python list with the wavelength grid in position 0, mean flux in position 1, and variance in position 2 (see *mean_comb* for how they are calculated). If requested, min and max flux values are in positions 3 and 4.
+    
+    *ip_spectra*
+        Python list as returned by *resample_spec*.
+    *forcesimple*
+      Boolean, whether to calculate a straight mean and variance even if weights are available.
+    *extremes*
+      Boolean, whether to include the min and max flux values at each wavelength.
+    *renormalize*
+      Boolean, whether to also calculate the factor that re-normalizes each spectrum to the combined spectrum (the median of their ratio), in which case the output is the combined spectrum AND an array with one factor per spectrum.
+    '''
+    wl_grid = ip_spectra[0]
+    fluxes = ip_spectra[1]
+    uncs = ip_spectra[2]
+    
+    # 1. Calculate mean and variance of flux values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if uncs is not None and not forcesimple:
+            mvarraw = 1. / np.nansum(1. / uncs, axis=0) # 1/Sum(1/sigma_i^2)
+            wmean = np.nansum(fluxes / uncs, axis=0) # Sum(x_i/sigma_i^2)
+            mean = wmean * mvarraw
+            mvar = mvarraw
+        else:
+            mvar = __nanstat(np.nanstd, fluxes) ** 2
+            mean = __nanstat(np.nanmean, fluxes)
+    
+    # 2. Create the combined spectrum, with extreme flux values if requested
+    if extremes:
+        minF = __nanstat(np.nanmin, fluxes)
+        maxF = __nanstat(np.nanmax, fluxes)
+        specComb = [wl_grid, mean, mvar, minF, maxF]
+    else:
+        specComb = [wl_grid, mean, mvar]
+    
+    # 3. Calculate re-normalization factors, if requested
+    if renormalize:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            renormfacs = np.median(fluxes / mean, axis=1)
+        return specComb, renormfacs
+    else:
+        return specComb
+
+
 def create_ascii(listObj, saveto=None, delimiter='\t'):
     '''
     (by Alejandro N |uacute| |ntilde| ez)
     
-    Save data from a Python list into an ascii file. It returns an asciidata type instance defined in the *ascii* module of astropy.
+    Save data from a Python list into an ascii file. It returns a numpy array with one column per item in *listObj*.
     
     *listObj*
         Python list object with data to be saved.
     *saveto*
-        String with name for ascii file. If no full path is provided, ascii file is created in the current directory. If no name is provided, ascii file is not created, only asciidata type instance is returned. This file name does not need to include extension (e.g. ".txt").
+        String with name for ascii file. If no full path is provided, ascii file is created in the current directory. If no name is provided, ascii file is not created, only the numpy array is returned. This file name does not need to include extension (e.g. ".txt").
     *delimiter*
         String specifying the delimiter desired for the ascii file. The default is *tab delimited*.
     '''
-    import astropy.io.ascii as asc
     
-    # Initialize variables
-    DELIMITER = '\t'
-    
-    # Determine important parameters
-    numCols = len(listObj)
-    numRows = 0
-    for col in listObj:
-        if len(col) > numRows:
-            numRows = len(col)
-    
-    # Create ascii table
-    asciiObj = np.zeros((numRows, numCols))
-    #asciiObj = ascii.create(numCols, numRows, delimiter=DELIMITER)
-    
-    # Populate the asciidata table
-    for rowIdx in range(numRows):
-    #for colIdx in range(asciiObj.ncols):
-        for colIdx in range(numCols):
-        #for rowIdx in range(len(listObj[colIdx])):
-            asciiObj[rowIdx,colIdx] = listObj[colIdx][rowIdx]
+    # Create ascii table, one column per item in listObj
+    asciiObj = np.column_stack([np.asarray(col, dtype=float) for col in listObj])
     
     # Save file
     if saveto is not None:
         fileTp = '.txt'
         try:
-            asc.write(asciiObj, saveto + fileTp, delimiter=DELIMITER, format='no_header')
-            #asciiObj.writeto(saveto + fileTp)
+            __write_ascii(asciiObj, saveto + fileTp, delimiter)
         except IOError:
             print('Invalid name/location to save ascii file.')
     
     return asciiObj
 
 
-def integrate(xyData):
+def integrate(xyData, cumulative=False):
     '''
     (by Damian)
     
     Integrate x and y data treating it as a scatter plot with the trapezoid rule. the output is a float number.
     
     *xyData*
-        2-D array with x-data in position 0 and y-data in position 1, can be a Python list or a numpy array.
+        2-D array with x-data in position 0 and y-data in position 1, can be a Python list or a numpy array. Several data sets sharing the same x-data can be integrated at once by giving a 2-D array as y-data (one data set per row), in which case the output is an array with one integral per row.
+    *cumulative*
+        Boolean, whether to return the running integral at each x-data point (starting with zero) instead of only the total integral.
     '''
     
     try:
@@ -273,14 +292,11 @@ def integrate(xyData):
             print('Cannot integrate, object does not have necessary parameters.')
             return 
         else:
-            xData = xyData[1]
-            yData = xyData[0]
-            integral = 0.
             try:
-                length = len(xData)
-                for n in range (0, length - 1):
-                    integral = integral + (xData[n + 1] - xData[n]) * \
-                               (yData[n + 1] + yData[n]) * 0.5
+                xData = np.asarray(xyData[0], dtype=float)
+                yData = np.asarray(xyData[1], dtype=float)
+                # Area of each trapezoid
+                areas = np.diff(xData) * (yData[...,1:] + yData[...,:-1]) * 0.5
             except ValueError:
                 print('Data type cannot be integrated')
                 return
@@ -288,6 +304,12 @@ def integrate(xyData):
         print('Cannot integrate.')
         return
     
+    if cumulative:
+        integral = np.zeros(yData.shape)
+        np.cumsum(areas, axis=-1, out=integral[...,1:])
+    else:
+        integral = areas.sum(axis=-1)
+    
     return integral
 
 
@@ -299,8 +321,12 @@ def mean_comb(spectra, mask=None, robust=None, forcesimple=False, extremes=False
     
     This function mimics IDL mc_meancomb (by Mike Cushing), with some restrictions.
     
+    All spectra are interpolated into memory at once; to combine more spectra than fit in memory, feed them in chunks to a SpecAccumulator object, which gives the same result.
+    
+    Spectra are interpolated and combined in float64 (see *resample_spec*), so the mask wavelength in the output is a float64 array even for float32 data.
+    
     *spectra*
-        Python list of spectra, where each spectrum is an array having wavelength in position 0, flux in position 1, and optional uncertainties in position 2.
+        Python list of spectra, where each spectrum is an array having wavelength in position 0, flux in position 1, and optional uncertainties in position 2. It can also be a SpectrumBatch object, in which case the combined spectrum is returned as a Spectrum object (and the re-normalized spectra as a SpectrumBatch object).
     *mask*
       Array of wavelengths to be used as mask for all spectra. If none, then the wavelength array of the first spectrum is used as mask.
     *robust*
@@ -332,116 +358,42 @@ def mean_comb(spectra, mask=None, robust=None, forcesimple=False, extremes=False
             print('Robust invalid.')
             return
     
-    # 1. Generate mask using the first spectrum given
-    if mask is None:
-        # Use x-axis (i.e. wl) values of first spectrum as mask for all others
-        wl_mask = spectra[0][0]
-    else:
-        wl_mask = mask
-    numPoints = len(wl_mask)
-    numSpec = len(spectra)
-    
-    # 2. Check if uncertainties were given
-    uncsGiven = True
-    if forcesimple:
-        uncsGiven = False
-    for spec in spectra:
-        if uncsGiven:
-            try:
-                uncs = spec[2]
-            except IndexError:
-                uncsGiven = False
-                continue
-            nanIdx = np.where(np.isfinite(uncs))
-            if len(nanIdx[0]) == 0:
-                uncsGiven = False
-    
-    # 3D-array that will hold interpolated spectra
-    # (it omits wavelength dimension, since all spectra have the same one)
-    if uncsGiven:
-        dims = 2
-    else:
-        dims = 1
-    ip_spectra = np.zeros((numPoints, dims, numSpec)) * np.nan
-    
-    # 3. Interpolate spectra using mask
-    for spIdx, spec in enumerate(spectra):
-        wl = spec[0]
-        fluxRaw= spec[1]
-        if uncsGiven:
-            unc = spec[2]
-        
-        # Eliminate outliers if requested
-        if robust is not None:
-            flux = clean_outliers(fluxRaw, robust)
-        else:
-            flux = fluxRaw
-        
-        if spIdx == 0:
-            # No need to interpolate first spectrum
-            flux_new = flux
-            if uncsGiven:
-                unc_new = unc
-        else:
-            ip_func_flux = spi.interp1d(wl, flux, bounds_error=False)
-            flux_new = ip_func_flux(wl_mask.tolist())
-            if uncsGiven:
-                ip_func_unc = spi.interp1d(wl, unc, bounds_error=False)
-                unc_new = ip_func_unc(wl_mask.tolist())
-        
-        ip_spectra[:,0,spIdx] = flux_new
-        if uncsGiven:
-            ip_spectra[:,1,spIdx] = unc_new
-    
-    # 4. Calculate mean and variance of flux values
-    if uncsGiven:
-        mvarraw = 1. / np.nansum(1. / ip_spectra[:,1,:], axis=1) # 1/Sum(1/sigma_i^2)
-        wmean = np.nansum(ip_spectra[:,0,:] / ip_spectra[:,1,:], axis=1) # Sum(x_i/sigma_i^2)
-        mean = wmean * mvarraw
-        mvar = mvarraw
-        # Correct weighted sample variance for small sample
-        #meantile = np.tile(mean, (numSpec,1)).T
-        #V1 = 1 / mvarraw
-        #V2 = np.nansum(ip_spectra[:,1,:]**2, axis=1)
-        #mvar = V1 / (V1**2 - V2) * \
-        #       np.nansum((ip_spectra[:,0,:] - meantile)**2 / ip_spectra[:,1,:], axis=1)
-    else:
-        mvar = sps.nanstd(ip_spectra[:,0,:], axis=1) ** 2 # /numSpec -- I think I dont need this
-        mean = sps.nanmean(ip_spectra[:,0,:], axis=1)
+    # 1. Interpolate spectra using mask (the wl of the first spectrum if no mask)
+    ip_spectra = resample_spec(spectra, mask=mask, robust=robust)
     
-    # 5. Calculate extreme flux values if requested
-    if extremes:
-        minF = np.nanmin(ip_spectra[:,0,:], axis=1)
-        maxF = np.nanmax(ip_spectra[:,0,:], axis=1)
+    # 2. Calculate mean, variance, and extreme flux values
+    combined = comb_spec(ip_spectra, forcesimple=forcesimple, extremes=extremes, \
+                         renormalize=renormalize)
     
-    # 5. Create the combined spectrum
-    if extremes:
-        specComb = [wl_mask, mean, mvar, minF, maxF]
-    else:
-        specComb = [wl_mask, mean, mvar]
-    
-    # 6. Re-normalize spectra to calculated combined spectrum, if requested
+    # 3. Re-normalize spectra to calculated combined spectrum, if requested
     if renormalize:
+        specComb, renormfacs = combined
+        wl_mask = ip_spectra[0]
+        uncsGiven = ip_spectra[2] is not None and not forcesimple
         renorm_spectra = []
-        for ispec in range(0, numSpec):
-            tmpflux = ip_spectra[:,0,ispec]
-            renormfac = np.median(tmpflux / mean) # mean is the flux of the combined spectrum
+        for ispec in range(0, len(spectra)):
+            tmpflux = ip_spectra[1][ispec]
             if uncsGiven:
-                tmpunc = ip_spectra[:,1,ispec]
-                renorm_spectra.append([wl_mask, tmpflux / renormfac, tmpunc / renormfac])
+                tmpunc = ip_spectra[2][ispec]
+                renorm_spectra.append([wl_mask, tmpflux / renormfacs[ispec], \
+                                       tmpunc / renormfacs[ispec]])
             else:
-                renorm_spectra.append([wl_mask, tmpflux / renormfac])
+                renorm_spectra.append([wl_mask, tmpflux / renormfacs[ispec]])
         
+        if isinstance(spectra, SpectrumBatch):
+            return Spectrum(*specComb), SpectrumBatch(renorm_spectra)
         return specComb, renorm_spectra
     else:
-        return specComb
+        if isinstance(spectra, SpectrumBatch):
+            return Spectrum(*combined)
+        return combined
 
 
-def norm_spec(specData, limits, flag=False):
+def norm_spec(specData, limits, flag=False, factors=None, getfactors=False):
     '''
     (by Alejandro N |uacute| |ntilde| ez)
     
-    Normalize a spectrum using a band (i.e. a portion) of the spectrum specified by *limits*.
+    Normalize a spectrum using a band (i.e. a portion) of the spectrum specified by *limits*. The normalization factor of each spectrum is the mean of its finite flux values in the band; the factors of all spectra are calculated at once. Wavelength values must be sorted in increasing order.
     
     *specData*
       Spectrum as a Python list with wavelength in position 0, flux in position 1, and (optional) error values in position 2. More than one spectrum can be provided simultaneously, in which case *specData* shall be a list of lists.
@@ -449,129 +401,163 @@ def norm_spec(specData, limits, flag=False):
       Python list with lower limit in position 0 and upper limit in position 1. If more than one spectrum provided, these limits will be applied to all spectra.
     *flag*
       Boolean, whether to warn if normalization limits were shrinked in the case when they fall outside spectrum. If set to *True*, *norm_spec* returns the normalized spectra AND a boolean flag.
+    *factors*
+      Array with the normalization factors to use, one per spectrum (e.g. as returned before with *getfactors=True*). If provided, *limits* are ignored and the flag is always False.
+    *getfactors*
+      Boolean, whether to also return the array of normalization factors (nan for spectra that could not be normalized). If set to *True*, the factors are returned last.
     '''
     
     # Convert specData to list or spectra if it consists only of one
-    if len(specData) <= 3 and len(specData[0]) > 10:
-        specData = [specData]
-    
-    # Initialize objects
-    finalData = [None] * len(specData)
+    inData = specData
+    specData, specKind = __spec_list(specData)
     
     # Check that given limits are reasonable
-    if limits[0] >= limits[1]:
+    if factors is None and limits[0] >= limits[1]:
         print('norm_spec: the Min and Max values specified are not reasonable.')
         return None
     
-    # Re-define normalizing band (specified in limits) for each spectrum in case
-    # the limits fall outside of the spectrum range
-    all_lims = [None] * len(specData)
-    flagged = False
-    for spIdx, spData in enumerate(specData):
-        smallest = limits[0]
-        largest  = limits[1]
-        if spData is None:
-            continue
-        
-        tmpNans = np.where(np.isfinite(spData[1]))
-        if len(tmpNans[0]) != 0:
-            if spData[0][tmpNans[0][0]] > smallest:
-                smallest = spData[0][tmpNans[0][0]]
-                flagged = True
-            if spData[0][tmpNans[0][-1]] < largest:
-                largest = spData[0][tmpNans[0][-1]]
-                flagged = True
-        
-        all_lims[spIdx] = [smallest, largest]
-    lims = [smallest, largest]
+    # 1) Stack all spectra into 2-D arrays, padded with nans
+    if specKind == 'batch':
+        stack = inData
+    else:
+        stack = SpectrumBatch(specData)
+    numSpec = len(stack)
+    if stack.sharedwave:
+        wls = np.broadcast_to(stack.wave, stack.flux.shape)
+    else:
+        wls = stack.wave
     
-    # Loop through each spectral data set
-    for spIdx, spData in enumerate(specData):
-        
-        # 1) Skip if data is missing
-        if spData is None:
-            continue
-        
-        # 2) Determine if spectra come with error values
-        if len(spData) == 3:
-            errors = True
-        else:
-            errors = False
-        
-        # 3) Determine minimum wavelength value for band
-        smallIdx = np.where(spData[0] < all_lims[spIdx][0])
-        
-        # If lower limit < all values in spectrum wavelength points, then
-        # make band's minimum value = first data point in spectrum
-        try:
-            smallIdx[0]
-        except IndexError:
-            minIdx = 0
-            smallIdx = [None]
-        
-        # If lower limit > all values in spectrum wavelength points, then
-        # no band can be selected
-        if smallIdx != [None]:
-            if len(smallIdx[0]) == len(spData[0]):
-                print('norm_spec: the wavelength data for object is outside limits.' )
-                continue
-            else:
-                minIdx = smallIdx[0][-1] + 1
-        
-        # 4) Determine maximum wavelength value for band
-        largeIdx = np.where(spData[0] > all_lims[spIdx][1])
-        
-        # If upper limit > all values in spectrum wavelength points, then
-        # make band's maximum value = last data point in spectrum
-        try:
-            largeIdx[0]
-        except IndexError:
-            maxIdx = len(spData[0])
-            largeIdx = [None]
-        
-        # If upper limit < all values in spectrum wavelength points, then
-        # no band can be selected
-        if largeIdx != [None]:
-            if len(largeIdx[0]) == len(spData[0]):
-                print('norm_spec: the wavelength data for object is outside limits.')
+    if factors is not None:
+        normFacs = np.asarray(factors, dtype=float)
+        flagged = False
+    else:
+        normFacs, flagged = __norm_factors(wls, stack.flux, stack.mask, \
+                                           stack.npix, stack.present, limits)
+    
+    # 2) Normalize fluxes and errors of all spectra at once
+    with np.errstate(divide='ignore', invalid='ignore'):
+        finalFlux = stack.flux / normFacs[:,None]
+        if stack.sigma is not None:
+            finalErrors = stack.sigma / normFacs[:,None]
+    
+    # 3) Put normalized spectra back in the given format
+    normed = stack.present & np.isfinite(normFacs)
+    if specKind == 'batch':
+        finalData = SpectrumBatch([])
+        finalData.wave = stack.wave
+        finalData.flux = finalFlux
+        finalData.sigma = finalErrors if stack.sigma is not None else None
+        finalData.mask = np.isfinite(finalFlux)
+        finalData.npix = np.where(normed, stack.npix, 0)
+        finalData.present = normed
+    else:
+        finalData = [None] * numSpec
+        for spIdx, spData in enumerate(specData):
+            if not normed[spIdx]:
                 continue
+            numVals = stack.npix[spIdx]
+            if len(spData) == 3:
+                finalData[spIdx] = [spData[0], finalFlux[spIdx,:numVals], \
+                                    finalErrors[spIdx,:numVals]]
             else:
-                maxIdx = largeIdx[0][0]
-        
-        # 5) Check for consistency in the computed band limits
-        if maxIdx - minIdx < 2:
-            print('norm_spec: The Min and Max values specified yield no band.')
-            continue
-            
-        # 6) Select flux band from spectrum
-        fluxSelect = spData[1][minIdx:maxIdx]
-        fluxSelect = np.array(fluxSelect)
-        
-        # 7) Select error value band from spectrum
-        if errors is True:
-            errorSelect = spData[2][minIdx:maxIdx]
-            errorSelect = np.array(errorSelect)
-        
-        # 8) Normalize spectrum using arithmetic mean
-        notNans = np.where(np.isfinite(fluxSelect))
-        avgFlux = np.mean(fluxSelect[notNans])
-        finalFlux = spData[1] / avgFlux
-        
-        finalData[spIdx] = [spData[0], finalFlux]
-        
-        if errors is True:
-            #notNans  = np.where(np.isfinite(errorSelect))
-            #avgError = np.mean(errorSelect[notNans])
-            finalErrors = spData[2] / avgFlux
-            
-            finalData[spIdx] = [spData[0], finalFlux, finalErrors]
+                finalData[spIdx] = [spData[0], finalFlux[spIdx,:numVals]]
+        finalData = __spec_return(finalData, specKind, specData)
     
-    if flag:
+    if flag and getfactors:
+        return finalData, flagged, normFacs
+    elif flag:
         return finalData, flagged
+    elif getfactors:
+        return finalData, normFacs
     else:
         return finalData
 
 
+def pack_spec(specFiles, archive, names=None, keys=None, errors=True, atomicron=False, negtonan=False, verbose=True, workers=None):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Read spectral data from many fits or ascii files (using *read_spec*) and store them all in one archive that can be opened with the SpecArchive class. The archive consists of two files: *archive*.dat, with the wavelength, flux, and error values of all spectra concatenated into one float array of three rows, and *archive*.json, with the position and number of data points of each spectrum, its name and key, its header data (as returned by *read_spec* with *meta=True*), and the size and modification time of its file (so that SpecArchive can tell whether the file changed after it was packed). Files that cannot be read are left out of the archive. It returns the number of spectra stored.
+    
+    *specFiles*
+      Python list of file names (with full path).
+    *archive*
+      String with name of the archive (with full path and no extension).
+    *names*
+      Python list of strings, the name by which each spectrum is found in the archive. If none given, the file names without path are used.
+    *keys*
+      Python list with a key for each spectrum (e.g. its reference number), by which spectra can also be found in the archive. Several spectra can share a key.
+    *errors*, *atomicron*, *negtonan*, *verbose*, *workers*
+      Same as in *read_spec*.
+    '''
+    import json
+    import tempfile
+    
+    if isinstance(specFiles, str):
+        specFiles = [specFiles,]
+    if names is None:
+        names = [os.path.basename(spFile) for spFile in specFiles]
+    if keys is None:
+        keys = [None] * len(specFiles)
+    if len(names) != len(specFiles) or len(keys) != len(specFiles):
+        print('pack_spec: names and keys must have one item per file.')
+        return
+    
+    # 1. Read all spectra (files are stamped first, so that a file changed while
+    # being read is found to be changed later)
+    stamps = [_file_stamp(spFile) for spFile in specFiles]
+    specData, specMeta = read_spec(specFiles, errors=errors, atomicron=atomicron, \
+                                   negtonan=negtonan, verbose=verbose, \
+                                   workers=workers, meta=True)
+    
+    # 2. Build index of spectra
+    entries = []
+    offset = 0
+    for spIdx, spData in enumerate(specData):
+        if spData is None:
+            continue
+        numPix = len(spData[0])
+        key = keys[spIdx]
+        if isinstance(key, np.generic):
+            key = key.item()
+        entries.append(dict(name=names[spIdx], key=key, offset=offset, \
+                            npix=numPix, meta=specMeta[spIdx], stamp=stamps[spIdx]))
+        offset = offset + numPix
+    
+    # 3. Concatenate spectral data (nans where no error values)
+    packed = np.zeros((3, offset)) * np.nan
+    entryIdx = 0
+    for spData in specData:
+        if spData is None:
+            continue
+        start = entries[entryIdx]['offset']
+        end = start + entries[entryIdx]['npix']
+        for colIdx in range(min(len(spData), 3)):
+            packed[colIdx,start:end] = spData[colIdx]
+        entryIdx = entryIdx + 1
+    
+    # 4. Write data first and index last, each to a temporary file first, so
+    # that an archive is never found with an index that does not match its data
+    folder = os.path.dirname(os.path.abspath(archive))
+    index = dict(numpix=offset, numcols=3, dtype='float64', entries=entries)
+    for extension, content in (('.dat', packed), ('.json', index)):
+        tmpHandle, tmpName = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(tmpHandle, 'wb') as tmpFile:
+                if extension == '.dat':
+                    content.astype('float64').tofile(tmpFile)
+                else:
+                    tmpFile.write(json.dumps(content).encode())
+            os.replace(tmpName, archive + extension)
+        except (IOError, OSError):
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            print('pack_spec: could not write archive ' + archive + '.')
+            return
+    
+    return len(entries)
+
+
 def plot_spec(specData, ploterrors=False):
     '''
     (by Alejandro N |uacute| |ntilde| ez)
@@ -601,6 +587,8 @@ def plot_spec(specData, ploterrors=False):
         if len(specData[0]) > 3:
             specData = [specData]
     
+    import matplotlib.pyplot as plt
+    
     # Initialize figure
     plt.close()
     fig = plt.figure(1)
@@ -635,7 +623,7 @@ def plot_spec(specData, ploterrors=False):
     return fig
 
 
-def read_spec(specFiles, errors=True, atomicron=False, negtonan=False, plot=False, linear=False, templ=False, verbose=True):
+def read_spec(specFiles, errors=True, atomicron=False, negtonan=False, plot=False, linear=False, templ=False, verbose=True, cache=None, cachesize=CACHE_SIZE, workers=None, processes=False, meta=False, asspectrum=False):
     '''
     (by Alejandro N |uacute| |ntilde| ez, Jocelyn Ferrara)
     
@@ -659,6 +647,18 @@ def read_spec(specFiles, errors=True, atomicron=False, negtonan=False, plot=Fals
       Boolean, whether data to extract is of a template spectrum, which means it includes avg flux, flux variance, min and max flux at each wavelength.
     *verbose*
       Boolean, whether to print warning messages.
+    *cache*
+      String with name of a folder where to keep the decoded spectral data of fits files (one .npz file per spectrum). Entries are identified by fits file name, size, and modification time, so they are renewed whenever a fits file changes. If none given, no cache is used.
+    *cachesize*
+      Integer, maximum size of the cache folder in bytes. The least recently used entries are deleted when the cache grows larger than this.
+    *workers*
+      Integer, number of files to read simultaneously. If none given, files are read one after the other. The order of the output is always that of *specFiles*.
+    *processes*
+      Boolean, whether *workers* are separate processes instead of threads. Threads suit reading files from disk; processes pay off when decoding the fits data takes most of the time.
+    *meta*
+      Boolean, whether to also return a list with a dictionary of header data for each spectrum: resolution (key 'RES', from RES or RP header keywords), linearity (key 'LINEAR'), CTYPE1, and the wavelength solution keywords found in the header (CRVAL1, CDELT1, CD1_1, COEFF0, COEFF1, LTV1). Pass this list to *smooth_spec* to avoid opening the fits files again.
+    *asspectrum*
+      Boolean, whether to return the spectral data as a SpectrumBatch object instead of a Python list. Template spectra (*templ=True*) are returned as a Python list of Spectrum objects instead, to keep their min and max flux values.
     '''
     
     # 1. Convert specFiles into a list type if it is only one file name
@@ -671,132 +671,229 @@ def read_spec(specFiles, errors=True, atomicron=False, negtonan=False, plot=Fals
         print('File name(s) in invalid format.')
         return
     
-    # 2. Initialize array to store spectra
+    # 2. Initialize arrays to store spectra and header data
     specData = [None] * len(specFiles)
-    
-    # 3. Loop through each file name:
-    for spFileIdx,spFile in enumerate(specFiles):
-        if spFile is None: continue
-        # 3.1 Determine the type of file it is
-        isFits = False
-        ext = spFile[-4:].lower()
-        if ext == 'fits' or ext == '.fit':
-            isFits = True
-            
-        # 3.2. Get data from file
-        if isFits:
-            try:
-                fitsData, fitsHeader = pf.getdata(spFile, header=True)
-            except IOError:
-                print('Could not open ' + str(spFile) + '.')
-                continue
-        # Assume ascii file otherwise (isFits = False)
+    specMeta = [None] * len(specFiles)
+    
+    # 3. Read each file (simultaneously if requested)
+    fileIdxs = [spFileIdx for spFileIdx,spFile in enumerate(specFiles) \
+                if spFile is not None]
+    readArgs = (errors, atomicron, negtonan, templ, verbose, cache, cachesize)
+    if workers is None or workers <= 1 or len(fileIdxs) <= 1:
+        results = [__read_file(specFiles[spFileIdx], *readArgs) \
+                   for spFileIdx in fileIdxs]
+    else:
+        import concurrent.futures as cf
+        if processes:
+            executor = cf.ProcessPoolExecutor(max_workers=workers)
         else:
-            try:
-                import astropy.io.ascii as ad
-                aData = ad.read(spFile)
-                specData[spFileIdx] = [aData.columns[0], \
-                                       aData.columns[1]]
-                if len(aData) >= 3 and errors:
-                    specData[spFileIdx].append(aData.columns[2])
-            except IOError:
-                print('Could not open ' + str(spFile) + '.')
-                continue
-        
-        # 3.3. Check if data in fits file is linear
-        if isFits:
-            KEY_TYPE = ['CTYPE1']
-            setType  = set(KEY_TYPE).intersection(set(fitsHeader.keys()))
-            if len(setType) == 0:
-                if verbose:
-                    print('Data in ' + spFile + ' assumed to be linear.')
-                isLinear = True
-            else:
-                valType = fitsHeader[setType.pop()]
-                if valType.strip().upper() == 'LINEAR':
-                    isLinear = True
-                else:
-                    isLinear = False
-            if linear and not isLinear:
-                if verbose:
-                    print('Data in ' + spFile + ' is not linear.')
-                return
-        
-        # 3.4. Get wl, flux & error data from fits file
-        #      (returns wl in pos. 0, flux in pos. 1, error values in pos. 2)
-        #      (If template spec: min flux in pos. 3, max flux in pos. 4)
-        if isFits:
-            specData[spFileIdx] = __get_spec(fitsData, fitsHeader, spFile, errors, \
-                                             templ=templ, verb=verbose)
-            if specData[spFileIdx] is None:
-                continue
-            
-            # Generate wl axis when needed
-            if specData[spFileIdx][0] is None:
-                specData[spFileIdx][0] = __create_waxis(fitsHeader, \
-                                         len(specData[spFileIdx][1]), spFile, \
-                                         verb=verbose)
-            # If no wl axis generated, then clear out all retrieved data for object
-            if specData[spFileIdx][0] is None:
-                specData[spFileIdx] = None
-                continue
-        
-        # 3.5. Convert units in wl-axis from Angstrom into microns if desired
-        if atomicron:
-            if specData[spFileIdx][0][-1] > 8000:
-                specData[spFileIdx][0] = specData[spFileIdx][0] / 10000
-        
-        # 3.6. Set negative flux values equal to zero (next step sets them to nans)
-        if negtonan:
-            negIdx = np.where(specData[spFileIdx][1] < 0)
-            if len(negIdx[0]) > 0:
-                specData[spFileIdx][1][negIdx] = 0
-                if verbose:
-                    print('%i negative data points found in %s.' \
-                            % (len(negIdx[0]), spFile))
-        
-        # 3.7. Set zero flux values as nans (do this always)
-        zeros = np.where(specData[spFileIdx][1] == 0)
-        if len(zeros[0]) > 0:
-            specData[spFileIdx][1][zeros] = np.nan
-        
+            executor = cf.ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            futures = [executor.submit(__read_file, specFiles[spFileIdx], *readArgs) \
+                       for spFileIdx in fileIdxs]
+            results = [future.result() for future in futures]
+    
+    for spFileIdx, (spData, spMeta) in zip(fileIdxs, results):
+        spFile = specFiles[spFileIdx]
+        if linear and spMeta is not None and not spMeta['LINEAR']:
+            if verbose:
+                print('Data in ' + spFile + ' is not linear.')
+            return
+        specData[spFileIdx] = spData
+        specMeta[spFileIdx] = spMeta
     
     # 4. Plot the spectra if desired
     if plot:
         plot_spec(specData, ploterrors=True)
     
-    # 5. Clear up memory
-    fitsHeader = ''
-    fitsData   = ''
+    # 5. Store spectral data in columnar containers if requested
+    if asspectrum:
+        if templ:
+            specData = [None if spData is None else Spectrum(*spData) \
+                        for spData in specData]
+        else:
+            specData = SpectrumBatch(specData)
+    
+    if meta:
+        return specData, specMeta
+    else:
+        return specData
+
+
+def resample_spec(spectra, mask=None, robust=None):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Interpolate a set of spectra into a common wavelength grid, once, for *comb_spec* (or *mean_comb*) to combine them. The output is a python list with the wavelength grid in position 0, a 2-D array of fluxes in position 1 (one row per spectrum), a 2-D array of uncertainties in position 2 (None unless all spectra come with uncertainties), and a 2-D boolean array in position 3 that is True where the interpolated values are valid. Values outside the wavelength range of a spectrum are set to nans.
+    
+    The grid and all interpolated values are float64 arrays, whatever the type of the data given (e.g. float32 data read from fits files), and interpolation is done in float64. Results from float32 data may then differ from those of interpolating in float32 (as mean_comb did with scipy's interp1d before) by about the float32 rounding error of the data.
+    
+    *spectra*
+        Python list of spectra, where each spectrum is an array having wavelength in position 0, flux in position 1, and optional uncertainties in position 2; it can also be a SpectrumBatch object, in which case spectra that share the wavelength grid are not interpolated at all.
+    *mask*
+      Array of wavelengths to be used as grid for all spectra. If none, then the wavelength array of the first spectrum is used as grid.
+    *robust*
+      Float, the sigma threshold to throw bad flux data points out before interpolating. If none given, then all flux data points will be used.
+    '''
+    # Check inputs
+    try:
+        spectra[0]
+    except TypeError:
+        print('Spectra invalid.')
+        return
+    if mask is not None:
+        try:
+            mask[0]
+        except TypeError:
+            print('Mask invalid.')
+            return
+    if robust is not None:
+        try:
+            float(robust)
+        except TypeError:
+            print('Robust invalid.')
+            return
+    
+    # 1. Generate grid using the first spectrum given
+    if mask is None:
+        wl_grid = np.asarray(spectra[0][0], dtype=float)
+    else:
+        wl_grid = np.asarray(mask, dtype=float)
+    numPoints = len(wl_grid)
+    numSpec = len(spectra)
+    
+    # Spectra in a SpectrumBatch that share the grid need no interpolation
+    if isinstance(spectra, SpectrumBatch) and spectra.sharedwave and robust is None \
+       and spectra.present.all() and np.array_equal(spectra.wave, wl_grid):
+        fluxes = spectra.flux.copy()
+        uncs = None
+        if spectra.sigma is not None and np.isfinite(spectra.sigma).any(axis=1).all():
+            uncs = spectra.sigma.copy()
+        valid = spectra.mask.copy()
+        if uncs is not None:
+            valid = valid & np.isfinite(uncs)
+        return [wl_grid, fluxes, uncs, valid]
+    
+    # 2. Check if uncertainties were given for all spectra
+    uncsGiven = True
+    for spec in spectra:
+        if len(spec) < 3 or not np.any(np.isfinite(spec[2])):
+            uncsGiven = False
+            break
+    
+    # 2-D arrays that will hold interpolated spectra
+    fluxes = np.zeros((numSpec, numPoints)) * np.nan
+    if uncsGiven:
+        uncs = np.zeros((numSpec, numPoints)) * np.nan
+    else:
+        uncs = None
+    
+    # 3. Interpolate spectra into grid
+    for spIdx, spec in enumerate(spectra):
+        wl = np.asarray(spec[0], dtype=float)
+        
+        # Eliminate outliers if requested
+        if robust is not None:
+            flux = clean_outliers(spec[1], robust)
+        else:
+            flux = spec[1]
+        
+        fluxes[spIdx] = __interp_grid(wl, flux, wl_grid)
+        if uncsGiven:
+            uncs[spIdx] = __interp_grid(wl, spec[2], wl_grid)
+    
+    # 4. Identify valid values
+    valid = np.isfinite(fluxes)
+    if uncsGiven:
+        valid = valid & np.isfinite(uncs)
     
-    return specData
+    return [wl_grid, fluxes, uncs, valid]
+
+
+def save_templ(templates, folder='', container=None, delimiter='\t'):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Save many template spectra at once, each one into its own ascii file with five columns: wavelength, mean flux, variance, min flux, max flux. Optionally, all templates are also stored in one binary numpy (.npz) file. It returns a dictionary with the numpy array of each template.
+    
+    *templates*
+        Python dictionary of templates, where each key is the name of the ascii file (with no extension) and each value is a Python list with the template columns, as returned by *mean_comb* with *extremes=True*. Templates that are None are skipped.
+    *folder*
+        String with name of the folder where to save the files.
+    *container*
+        String with name of the binary file (with no extension) where to store all templates together, keyed by template name. If none given, only the ascii files are created.
+    *delimiter*
+        String specifying the delimiter desired for the ascii files. The default is *tab delimited*.
+    '''
+    
+    templArrays = {}
+    for templName in sorted(templates.keys()):
+        if templates[templName] is None:
+            continue
+        templArrays[templName] = create_ascii(templates[templName], \
+                                              saveto=folder + templName, \
+                                              delimiter=delimiter)
+    
+    if container is not None and len(templArrays) > 0:
+        np.savez(folder + container + '.npz', **templArrays)
+    
+    return templArrays
 
 
 def sel_band(specData, limits, objID='NA'):
     '''
     (by Alejandro N |uacute| |ntilde| ez)
     
-    Select a band (i.e. a portion) from a spectrum specified by *limits*.
+    Select a band (i.e. a portion) from a spectrum specified by *limits*. The band edges are found with a binary search, so wavelength values must be sorted in increasing order. The selected bands are views into the original arrays, not copies.
     
     *specData*
         Spectrum as a Python list with wavelength in position 0, flux in position 1, and (optional) error values in position 2. More than one spectrum can be provided simultaneously, in which case *specData* shall be a list of lists.
     *limits*
-        Python list with lower limit in position 0 and upper limit in position 1.
+        Python list with lower limit in position 0 and upper limit in position 1. To select several bands at once, *limits* can also be a dictionary with band names as keys and Python lists of limits as values, in which case *sel_band* returns a dictionary with the selected data keyed by band name.
     *objID*
         String with ID for spectrum; if dealing with several spectra, *objID* shall be a list of strings. For error printing purposes only.
     '''
     
+    # Convert limits into a dictionary if only one band requested
+    if isinstance(limits, dict):
+        bandKeys = list(limits.keys())
+        bandLims = limits
+    else:
+        bandKeys = [None]
+        bandLims = {None: limits}
+    
+    # Check that given limits are reasonable
+    for bandKey in bandKeys:
+        if bandLims[bandKey][0] >= bandLims[bandKey][1]:
+            print('sel_band: the Min and Max values specified are not reasonable.')
+            return None
+    lowLims = np.array([bandLims[bandKey][0] for bandKey in bandKeys], dtype=float)
+    uppLims = np.array([bandLims[bandKey][1] for bandKey in bandKeys], dtype=float)
+    
+    # Spectra in a SpectrumBatch sharing one wavelength array are cut all at once
+    if isinstance(specData, SpectrumBatch) and specData.sharedwave:
+        minIdxs = np.searchsorted(specData.wave, lowLims, side='left')
+        maxIdxs = np.searchsorted(specData.wave, uppLims, side='right')
+        finalBands = {}
+        for bdIdx, bandKey in enumerate(bandKeys):
+            if maxIdxs[bdIdx] - minIdxs[bdIdx] < 2:
+                print('sel_band: The Min and Max values specified yield no band.')
+                finalBands[bandKey] = None
+            else:
+                finalBands[bandKey] = specData.columns(minIdxs[bdIdx], maxIdxs[bdIdx])
+        if bandKeys == [None]:
+            return finalBands[None]
+        return finalBands
+    
     # Convert specData to list or spectra if it consists only of one
-    if len(specData) <= 3 and len(specData[0]) > 10:
-        specData = [specData]
+    specData, specKind = __spec_list(specData)
+    if isinstance(objID, str):
+        objID = [objID] * len(specData)
     
     # Initialize objects
-    finalData = [None] * len(specData)
-    
-    # Check that given limits are reasonable
-    if limits[0] >= limits[1]:
-        print('sel_band: the Min and Max values specified are not reasonable.')
-        return None
+    finalData = {}
+    for bandKey in bandKeys:
+        finalData[bandKey] = [None] * len(specData)
     
     # Loop through each spectral data set
     for spIdx, spData in enumerate(specData):
@@ -811,62 +908,143 @@ def sel_band(specData, limits, objID='NA'):
         else:
             errors = False
         
-        # 3) Determine minimum wavelength value for band
-        smallIdx = np.where(spData[0] < limits[0])
-        
-        # If lower limit < all values in spectrum wavelength points, then
-        # make band's minimum value = first data point in spectrum
-        if len(smallIdx[0]) == 0:
-            minIdx = 0
+        # 3) Determine min and max wavelength index of every band; a band starts
+        # at the first value >= lower limit and ends at the last value <= upper limit
+        wls = np.asarray(spData[0])
+        minIdxs = np.searchsorted(wls, lowLims, side='left')
+        maxIdxs = np.searchsorted(wls, uppLims, side='right')
         
-        # If lower limit > all values in spectrum wavelength points, then
-        # no band can be selected
-        elif len(smallIdx[0]) == len(spData[0]):
-            print('sel_band: the wavelength data for object ', objID[spIdx], \
-                  ' is outside the given limits.')
-            continue
+        for bdIdx, bandKey in enumerate(bandKeys):
+            minIdx = minIdxs[bdIdx]
+            maxIdx = maxIdxs[bdIdx]
+            
+            # 4) Check that band falls within spectrum wavelength values
+            if minIdx == len(wls) or maxIdx == 0:
+                print('sel_band: the wavelength data for object %s is outside ' \
+                      'the given limits.' %objID[spIdx])
+                continue
+            
+            # 5) Check for consistency in the computed band limits
+            if maxIdx - minIdx < 2:
+                print('sel_band: The Min and Max values specified for object %s ' \
+                      'yield no band.' %objID[spIdx])
+                continue
+            
+            # 6) Select wavelength, flux, and error value band from spectrum
+            if errors is True:
+                finalData[bandKey][spIdx] = [wls[minIdx:maxIdx], \
+                                             spData[1][minIdx:maxIdx], \
+                                             spData[2][minIdx:maxIdx]]
+            else:
+                finalData[bandKey][spIdx] = [wls[minIdx:maxIdx], \
+                                             spData[1][minIdx:maxIdx]]
+    
+    if bandKeys == [None]:
+        return __spec_return(finalData[None], specKind, specData)
+    
+    finalBands = {}
+    for bandKey in bandKeys:
+        finalBands[bandKey] = __spec_return(finalData[bandKey], specKind, specData)
+    return finalBands
+
+
+def smooth_batch(specData, newres=200, oldres=None, specMeta=None, winWidth=10, kernel='boxcar'):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Smooth the flux data of many spectra at once to the resolution specified, as *smooth_spec* does, but using a kernel that ignores nan values instead of squeezing them out: each smoothed value is the kernel-weighted mean of the finite flux values around it, so the smoothing never reaches across a gap in the data. Flux values that are nans remain nans. Uncertainties, if given, are propagated through the kernel (missing uncertainties, nans, remain nans).
+    
+    Spectra that need the same kernel are convolved together as a 2-D array. Kernels are calculated once per pair of original and new resolution, and wide kernels (of at least *FFT_KERNEL* data points) are applied using FFT convolution.
+    
+    *specData*
+      Spectrum as a Python list with wavelength in position 0, flux in position 1, and (optional) error values in position 2. More than one spectrum can be provided simultaneously, in which case *specData* shall be a list of lists or a SpectrumBatch object.
+    *newres*
+      Float with resolution desired.
+    *oldres*
+      Float with the original resolution of all spectra, if known.
+    *specMeta*
+      Dictionary with header data of the spectrum as returned by *read_spec* with *meta=True*; if dealing with several spectra, *specMeta* shall be a list of dictionaries. It is used to find the original resolution of each spectrum when *oldres* is not provided.
+    *winWidth*
+      Float with width of smoothing window (in data points); used when original spectrum resolution is unknown.
+    *kernel*
+      String with the shape of the kernel: 'boxcar' (width equal to the ratio of resolutions) or 'gaussian' (FWHM equal to the ratio of resolutions).
+    '''
+    if kernel not in ('boxcar', 'gaussian'):
+        print('smooth_batch: kernel must be boxcar or gaussian.')
+        return None
+    
+    # 1) Stack all spectra into 2-D arrays, padded with nans
+    inData = specData
+    specData, specKind = __spec_list(specData)
+    if specKind == 'batch':
+        stack = inData
+    else:
+        stack = SpectrumBatch(specData)
+    if isinstance(specMeta, dict):
+        specMeta = [specMeta]
+    
+    # 2) Determine original resolution of each spectrum
+    resPairs = [None] * len(stack)
+    for spIdx in range(len(stack)):
+        if oldres is not None:
+            origRes = oldres
+        elif specMeta is not None and specMeta[spIdx] is not None \
+                                  and specMeta[spIdx]['RES'] is not None:
+            origRes = specMeta[spIdx]['RES']
         else:
-            minIdx = smallIdx[0][-1] + 1
-        
-        # 4) Determine maximum wavelength value for band
-        largeIdx = np.where(spData[0] > limits[1])
-        
-        # If upper limit > all values in spectrum wavelength points, then
-        # make band's maximum value = last data point in spectrum
-        if len(largeIdx[0]) == 0:
-            maxIdx = len(spData[0])
-        
-        # If upper limit < all values in spectrum wavelength points, then
-        # no band can be selected
-        elif len(largeIdx[0]) == len(spData[0]):
-            print('sel_band: the wavelength data for object %s is outside  ' \
-                  + 'the given limits.' %objID[spIdx])
+            origRes = 0
+        resPairs[spIdx] = (origRes, newres)
+    
+    # 3) Smooth together all spectra that use the same kernel
+    finite = stack.mask
+    smoothFlux = stack.flux.copy()
+    if stack.sigma is not None:
+        smoothErrs = stack.sigma.copy()
+    for resPair in set(resPairs):
+        kern = __smooth_kernel(resPair[0], resPair[1], winWidth, kernel)
+        if kern is None:
             continue
-        else:
-            maxIdx = largeIdx[0][0]
-        
-        # 5) Check for consistency in the computed band limits
-        if maxIdx - minIdx < 2:
-            print('sel_band: The Min and Max values specified for object %s ' \
-                  + 'yield no band.' %objID[spIdx])
+        rows = np.array([pair == resPair for pair in resPairs]) & stack.present
+        if not rows.any():
             continue
-            
-        # 6) Select flux band from spectrum
-        fluxSelect = spData[1][minIdx:maxIdx]
         
-        # 7) Select error value band from spectrum
-        if errors is True:
-            errorSelect = spData[2][minIdx:maxIdx]
-            
-            finalData[spIdx] = [spData[0][minIdx:maxIdx], fluxSelect, \
-                                errorSelect]
+        weights = __convolve_rows(finite[rows].astype(float), kern)
+        fluxSum = __convolve_rows(np.where(finite[rows], stack.flux[rows], 0.), kern)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            smoothFlux[rows] = np.where(finite[rows], fluxSum / weights, np.nan)
+            if stack.sigma is not None:
+                # Missing uncertainties (nans) remain missing
+                errFinite = finite[rows] & np.isfinite(stack.sigma[rows])
+                errSq = np.where(errFinite, stack.sigma[rows], 0.) ** 2
+                errSum = __convolve_rows(errSq, kern ** 2)
+                smoothErrs[rows] = np.where(errFinite, \
+                                   np.sqrt(np.abs(errSum)) / weights, np.nan)
+    
+    # 4) Put smoothed spectra back in the given format
+    if specKind == 'batch':
+        smoothData = SpectrumBatch([])
+        smoothData.wave = stack.wave
+        smoothData.flux = smoothFlux
+        smoothData.sigma = smoothErrs if stack.sigma is not None else None
+        smoothData.mask = np.isfinite(smoothFlux)
+        smoothData.npix = stack.npix
+        smoothData.present = stack.present
+        return smoothData
+    
+    smoothData = [None] * len(stack)
+    for spIdx, spData in enumerate(specData):
+        if spData is None:
+            continue
+        numVals = stack.npix[spIdx]
+        if len(spData) >= 3:
+            smoothData[spIdx] = [np.array(spData[0]), smoothFlux[spIdx,:numVals], \
+                                 smoothErrs[spIdx,:numVals]]
         else:
-            finalData[spIdx] = [spData[0][minIdx:maxIdx], fluxSelect]
-    
-    return finalData
+            smoothData[spIdx] = [np.array(spData[0]), smoothFlux[spIdx,:numVals]]
+    return __spec_return(smoothData, specKind, specData)
 
 
-def smooth_spec(specData, oldres=None, newres=200, specFile=None, winWidth=10):
+def smooth_spec(specData, oldres=None, newres=200, specFile=None, winWidth=10, specMeta=None):
     '''
     (by Alejandro N |uacute| |ntilde| ez)
     
@@ -882,6 +1060,8 @@ def smooth_spec(specData, oldres=None, newres=200, specFile=None, winWidth=10):
       String with name of the fits file (with full path) from where the spectrum was obtained; if dealing with several spectra, *specFiles* shall be a list of strings.
     *winWidth*
       Float with width of smoothing window; use when original spectrum resolution is unknown.
+    *specMeta*
+      Dictionary with header data of the spectrum as returned by *read_spec* with *meta=True*; if dealing with several spectra, *specMeta* shall be a list of dictionaries. When provided, it is used instead of *specFile* to find the original resolution.
     '''
     # Define key names for resolution in fits file
     KEY_RES = ['RES','RP']
@@ -892,10 +1072,11 @@ def smooth_spec(specData, oldres=None, newres=200, specFile=None, winWidth=10):
         fitsExist = True
     
     # Convert into python list type when only one set of spectrum and fits file
-    if len(specData) <= 3 and len(specData[0]) > 10:
-        specData = [specData]
+    specData, specKind = __spec_list(specData)
     if isinstance(specFile, str):
         specFile = [specFile]
+    if isinstance(specMeta, dict):
+        specMeta = [specMeta]
     
     smoothData = []
     for specIdx,spec in enumerate(specData):
@@ -913,8 +1094,14 @@ def smooth_spec(specData, oldres=None, newres=200, specFile=None, winWidth=10):
             # Get original resolution from oldres, if provided
             if oldres is not None:
                 origRes = oldres
-            # If oldres not provided, then get original resolution from fits file
+            # If oldres not provided, then get original resolution from header data
+            elif specMeta is not None and specMeta[specIdx] is not None:
+                origRes = specMeta[specIdx]['RES']
+                if origRes is None:
+                    origRes = 0
+            # If no header data either, then get original resolution from fits file
             elif fitsExist and specFile[specIdx] is not None:
+                import astropy.io.fits as pf
                 fitsData = pf.open(specFile[specIdx])
                 # Find Key names for resolution in fits file header
                 setRes = set(KEY_RES).intersection(set(fitsData[0].header.keys()))
@@ -937,6 +1124,7 @@ def smooth_spec(specData, oldres=None, newres=200, specFile=None, winWidth=10):
             
             # Reduce spectrum resolution if greater than newres
             if width > 0:
+                import scipy.ndimage as spn
                 notNans = np.where(np.isfinite(fluxes))
                 fluxes[notNans] = spn.filters.uniform_filter( \
                                   fluxes[notNans], size=width)
@@ -950,11 +1138,360 @@ def smooth_spec(specData, oldres=None, newres=200, specFile=None, winWidth=10):
             else:
                 smoothData.append([wls, fluxes, errs])
     
-    return smoothData
+    return __spec_return(smoothData, specKind, specData)
 
 
 # IV ++++++++++++++++++++ NON-PUBLIC FUNCTIONS ++++++++++++++++++++++++++++++++
 # Functions used by Global Functions; these are not meant to be used directly by end users of astrotools. Precede function names by double underscore.
+def __avg_flux_windows(wl, flux, sigma, startWs, endWs):
+# Function used by avg_flux and avg_flux_batch only
+# Calculates the average flux (and its uncertainty) of a stack of spectra sharing
+# the same wavelength array, on a set of wavelength ranges, using cumulative sums.
+# Edge pixels count by the fraction of them inside the range. Returns arrays of
+# shape (spectra, ranges) and a status per range: 0-ok, 1-out of range, 2-no data.
+    
+    numSpec, numPix = flux.shape
+    numWin = len(startWs)
+    avgs = np.zeros((numSpec, numWin)) * np.nan
+    sigs = np.zeros((numSpec, numWin)) * np.nan
+    status = np.zeros(numWin, dtype=int)
+    
+    # 1. Check that ranges fall inside the wavelength array and contain data
+    status[(wl.min() > startWs) | (wl.max() < endWs)] = 1
+    firstIdx = np.searchsorted(wl, startWs, side='left')
+    numIn = np.searchsorted(wl, endWs + .0022, side='right') - firstIdx
+    status[(status == 0) & ((numIn <= 0) | (firstIdx + 1 >= numPix))] = 2
+    okWin = np.where(status == 0)[0]
+    if len(okWin) == 0:
+        return avgs, sigs, status
+    
+    # 2. Find the pixel scale and the pixels that overlap each range
+    firstIdx = firstIdx[okWin]
+    startW = startWs[okWin]
+    endW = endWs[okWin]
+    pixScale = wl[firstIdx + 1] - wl[firstIdx]
+    loIdx = np.searchsorted(wl, startW - pixScale / 2, side='left')
+    hiIdx = np.searchsorted(wl, endW + pixScale / 2, side='right')
+    numPixels = hiIdx - loIdx
+    hasPix = numPixels >= 1
+    status[okWin[~hasPix]] = 2
+    okWin = okWin[hasPix]
+    loIdx = loIdx[hasPix]
+    hiIdx = hiIdx[hasPix]
+    lastIdx = hiIdx - 1
+    startW = startW[hasPix]
+    endW = endW[hasPix]
+    pixScale = pixScale[hasPix]
+    numPixels = numPixels[hasPix]
+    single = numPixels == 1
+    
+    # 3. Determine fractional pixel value on the edges of the ranges
+    frac1 = (wl[loIdx] + pixScale / 2 - startW) / pixScale
+    frac2 = (endW - wl[lastIdx] + pixScale / 2) / pixScale
+    realpix = numPixels - 2 + frac1 + frac2
+    
+    # 4. Sum the fluxes in the ranges (ranges containing nans yield nans)
+    nanCount = __window_sums(np.isnan(flux).astype(float), loIdx, hiIdx)
+    sumflux = __window_sums(np.nan_to_num(flux), loIdx, hiIdx) \
+              - (1 - frac1) * flux[:,loIdx] \
+              - np.where(single, 0, (1 - frac2) * flux[:,lastIdx])
+    sumflux[nanCount > 0] = np.nan
+    avgs[:,okWin] = sumflux / realpix
+    
+    # 5. Calculate uncertainties
+    if sigma is not None:
+        sigma2 = sigma ** 2
+        nanSigCount = __window_sums(np.isnan(sigma2).astype(float), loIdx, hiIdx)
+        sumsigma2 = __window_sums(np.nan_to_num(sigma2), loIdx, hiIdx) \
+                    - (1 - frac1 ** 2) * sigma2[:,loIdx] \
+                    - np.where(single, 0, (1 - frac2 ** 2) * sigma2[:,lastIdx])
+        sumsigma2[nanSigCount > 0] = np.nan
+        sigs[:,okWin] = np.sqrt(sumsigma2) / realpix
+    else:
+        # Use the sample variance to estimate uncertainty
+        # (fluxes are shifted by a reference value to keep sums precise)
+        with np.errstate(all='ignore'):
+            refFlux = np.nanmedian(flux, axis=1)[:,np.newaxis]
+        refFlux[~np.isfinite(refFlux)] = 0
+        shifted = flux - refFlux
+        sum1 = __window_sums(np.nan_to_num(shifted), loIdx, hiIdx)
+        sum2 = __window_sums(np.nan_to_num(shifted ** 2), loIdx, hiIdx)
+        with np.errstate(all='ignore'):
+            sumdev = sum2 - sum1 ** 2 / numPixels
+            sigflux = np.sqrt(np.maximum(sumdev, 0) / (numPixels - 1)) \
+                      / np.sqrt(numPixels)
+        sigflux[nanCount > 0] = np.nan
+        sigs[:,okWin] = sigflux
+    
+    return avgs, sigs, status
+
+
+def __avg_flux_median(wl, flux, startW, endW, avgflux, verb):
+# Function used by avg_flux and avg_flux_batch only
+# Returns the median flux in a wavelength range when it has more than 5 pixels,
+# warning when it differs from the average flux by more than 3%.
+    
+    firstIdx = np.searchsorted(wl, startW, side='left')
+    pixScale = wl[firstIdx + 1] - wl[firstIdx]
+    loIdx = np.searchsorted(wl, startW - pixScale / 2, side='left')
+    hiIdx = np.searchsorted(wl, endW + pixScale / 2, side='right')
+    if hiIdx - loIdx <= 5:
+        return avgflux
+    
+    old = avgflux
+    avgflux = np.median(flux[loIdx:hiIdx])
+    
+    if 100 * np.abs(avgflux - old) / old > 3:
+        print('avg_flux: WARNING: difference between average and median ' \
+              + 'is greater than 3%')
+        print('avg_flux: median = ' + str(avgflux) + ',\t' + ' average = ' \
+              + str(old))
+        print('avg_flux: difference % = ' + \
+              str(100 * np.abs(avgflux - old) / old))
+    else:
+        if verb == True:
+            print('median worked')
+    
+    return avgflux
+
+
+def __convolve_rows(values, kern):
+# Function used by smooth_batch only
+# Convolves each row of a 2-D array with the kernel, keeping the row length;
+# values beyond the edges of the rows count as zeros.
+    if len(kern) >= FFT_KERNEL:
+        import scipy.signal as spsig
+        return spsig.fftconvolve(values, kern[None,:], mode='same', axes=1)
+    else:
+        import scipy.ndimage as spn
+        return spn.convolve1d(values, kern, axis=1, mode='constant', cval=0.)
+
+
+def __norm_factors(wls, fluxes, finite, npix, present, limits):
+# Function used by norm_spec only
+# Calculates the normalization factor of every row of the 2-D arrays at once.
+# Returns the factors (nan where spectra could not be normalized) and whether
+# the limits had to be shrinked for any spectrum.
+    numSpec, numCols = fluxes.shape
+    normFacs = np.zeros(numSpec) * np.nan
+    if numSpec == 0 or numCols == 0:
+        return normFacs, False
+    rowIdxs = np.arange(numSpec)
+    
+    # Shrink the limits to the range of finite flux values of each spectrum
+    hasData = finite.any(axis=1)
+    firstIdx = np.argmax(finite, axis=1)
+    lastIdx = numCols - 1 - np.argmax(finite[:,::-1], axis=1)
+    lowLims = np.zeros(numSpec) + limits[0]
+    uppLims = np.zeros(numSpec) + limits[1]
+    lowLims[hasData] = np.maximum(lowLims, wls[rowIdxs,firstIdx])[hasData]
+    uppLims[hasData] = np.minimum(uppLims, wls[rowIdxs,lastIdx])[hasData]
+    flagged = bool(np.any(present & hasData & ((lowLims > limits[0]) | \
+                                               (uppLims < limits[1]))))
+    
+    # Index bounds of the normalization band of each spectrum
+    with np.errstate(invalid='ignore'):
+        minIdxs = np.sum(wls < lowLims[:,None], axis=1)
+        maxIdxs = np.sum(wls <= uppLims[:,None], axis=1)
+    outside = present & ((minIdxs == npix) | (maxIdxs == 0))
+    noBand = present & ~outside & (maxIdxs - minIdxs < 2)
+    for spIdx in np.where(outside)[0]:
+        print('norm_spec: the wavelength data for object is outside limits.')
+    for spIdx in np.where(noBand)[0]:
+        print('norm_spec: The Min and Max values specified yield no band.')
+    good = present & ~outside & ~noBand
+    
+    # Mean of finite flux values in each band
+    colIdxs = np.arange(numCols)
+    inBand = (colIdxs >= minIdxs[:,None]) & (colIdxs < maxIdxs[:,None]) & finite
+    numVals = inBand.sum(axis=1)
+    sumVals = np.where(inBand, fluxes, 0.).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normFacs[good] = (sumVals / numVals)[good]
+    
+    return normFacs, flagged
+
+
+# Kernels already calculated by __smooth_kernel
+__SMOOTH_KERNELS = {}
+
+def __smooth_kernel(origRes, newRes, winWidth, kernel):
+# Function used by smooth_batch only
+# Returns the (normalized) kernel that degrades resolution origRes to newRes, or
+# None if no smoothing is needed. Kernels are kept in __SMOOTH_KERNELS.
+    keyName = (origRes, newRes, winWidth, kernel)
+    if keyName in __SMOOTH_KERNELS:
+        return __SMOOTH_KERNELS[keyName]
+    
+    # Determine width of smoothing window (same as smooth_spec)
+    width = 0
+    if origRes > newRes:
+        width = float(origRes) / newRes
+    elif origRes == 0:
+        width = winWidth
+    
+    if width <= 1:
+        kern = None
+    elif kernel == 'boxcar':
+        # Odd number of points, with fractional weights at both ends so that
+        # the kernel is exactly width points wide
+        halfLen = int(np.ceil((width - 1) / 2.))
+        kern = np.ones(2 * halfLen + 1)
+        kern[[0,-1]] = (width - (2 * halfLen - 1)) / 2.
+        kern = kern / kern.sum()
+    else:
+        sigma = width / (2 * np.sqrt(2 * np.log(2)))
+        halfLen = int(np.ceil(4 * sigma))
+        kern = np.exp(-0.5 * (np.arange(-halfLen, halfLen + 1) / sigma) ** 2)
+        kern = kern / kern.sum()
+    
+    __SMOOTH_KERNELS[keyName] = kern
+    return kern
+
+
+def __spec_list(specData):
+# Function used by sel_band, norm_spec, smooth_spec, and mean_comb
+# Returns the spectra in specData as a Python list, plus a flag that tells how to
+# return results: 'batch' (SpectrumBatch), 'single' (Spectrum), or 'list'.
+    if isinstance(specData, SpectrumBatch):
+        return list(specData), 'batch'
+    if isinstance(specData, Spectrum):
+        return [specData], 'single'
+    
+    # Convert specData to list of spectra if it consists only of one (its first
+    # element is then the wavelength array, not a spectrum)
+    first = specData[0]
+    if first is None or isinstance(first, (Spectrum, SpectrumBatch)):
+        return specData, 'list'
+    try:
+        oneSpec = np.ndim(first) == 1
+    except ValueError:
+        # Spectra with columns of different lengths (or no uncertainties)
+        oneSpec = False
+    if oneSpec:
+        return [specData], 'list'
+    
+    return specData, 'list'
+
+
+def __spec_return(outData, kind, inData):
+# Function used by sel_band, norm_spec, smooth_spec, and mean_comb
+# Returns results in the same kind of object in which spectra were received.
+    if kind == 'batch':
+        return SpectrumBatch(outData)
+    
+    outSpecs = [None] * len(outData)
+    for spIdx, spData in enumerate(outData):
+        if spData is not None and isinstance(inData[spIdx], Spectrum):
+            outSpecs[spIdx] = Spectrum(*spData)
+        else:
+            outSpecs[spIdx] = spData
+    
+    if kind == 'single':
+        return outSpecs[0]
+    return outSpecs
+
+
+def __window_sums(values, loIdx, hiIdx):
+# Function used by __avg_flux_windows only
+# Sums values[:, lo:hi] for every pair of indices using one cumulative sum.
+    cumVals = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(values, axis=1, out=cumVals[:,1:])
+    return cumVals[:,hiIdx] - cumVals[:,loIdx]
+
+
+def __cache_key(spFile, options):
+# Function used by read_spec only
+# Builds the name of the cache entry of a fits file from its full name, size,
+# and modification time, and from the read_spec options that change its data.
+    import hashlib
+    
+    fileStat = os.stat(spFile)
+    keyStr = '|'.join([os.path.abspath(spFile), str(fileStat.st_size), \
+                       repr(fileStat.st_mtime)] + [str(opt) for opt in options])
+    
+    return hashlib.sha1(keyStr.encode('utf-8')).hexdigest() + '.npz'
+
+
+def __cache_load(cache, keyName):
+# Function used by read_spec only
+# Returns the spectral data and header data stored in a cache entry, or None.
+    import json
+    
+    entry = os.path.join(cache, keyName)
+    try:
+        with np.load(entry) as npz:
+            numCols = int(npz['numcols'])
+            spec = [npz['col%i' % colIdx] for colIdx in range(numCols)]
+            specMeta = json.loads(str(npz['meta']))
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    
+    # Mark entry as recently used
+    try:
+        os.utime(entry, None)
+    except OSError:
+        pass
+    
+    return spec, specMeta
+
+
+def __cache_save(cache, keyName, spec, specMeta, cachesize):
+# Function used by read_spec only
+# Stores spectral & header data in a cache entry, then trims the cache to cachesize bytes.
+    import json
+    import tempfile
+    
+    if not os.path.isdir(cache):
+        try:
+            os.makedirs(cache)
+        except OSError:
+            if not os.path.isdir(cache):
+                return
+    
+    cols = {}
+    for colIdx, col in enumerate(spec):
+        cols['col%i' % colIdx] = np.asarray(col)
+    
+    # Write to a temporary file first so that readers never see partial entries
+    tmpHandle, tmpName = tempfile.mkstemp(dir=cache, suffix='.tmp')
+    try:
+        with os.fdopen(tmpHandle, 'wb') as tmpFile:
+            np.savez(tmpFile, numcols=len(spec), meta=json.dumps(specMeta), **cols)
+        os.replace(tmpName, os.path.join(cache, keyName))
+    except (IOError, OSError):
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        return
+    
+    __cache_trim(cache, cachesize)
+
+
+def __cache_trim(cache, cachesize):
+# Function used by read_spec only
+# Deletes least recently used cache entries until the cache fits in cachesize bytes.
+    entries = []
+    totalSize = 0
+    for fileName in os.listdir(cache):
+        if not fileName.endswith('.npz'): continue
+        try:
+            fileStat = os.stat(os.path.join(cache, fileName))
+        except OSError:
+            continue
+        entries.append((fileStat.st_mtime, fileStat.st_size, fileName))
+        totalSize += fileStat.st_size
+    
+    entries.sort()
+    for mtime, size, fileName in entries:
+        if totalSize <= cachesize:
+            break
+        try:
+            os.remove(os.path.join(cache, fileName))
+        except OSError:
+            continue
+        totalSize -= size
+
+
 def __create_waxis(fitsHeader, lenData, fileName, verb=True):
 # Function used by read_spec only
 # (by Alejo)
@@ -999,6 +1536,161 @@ def __create_waxis(fitsHeader, lenData, fileName, verb=True):
     return wAxis
 
 
+def __interp_grid(wl, values, wl_grid):
+# Function used by resample_spec only
+# Linear interpolation of values into wl_grid (with nans outside of wl), as done by
+# scipy's interp1d. Spectra already sampled on wl_grid are just copied; spectra
+# with wavelengths not in increasing order are sorted first (as interp1d does).
+    values = np.asarray(values, dtype=float)
+    if len(wl) == len(wl_grid) and np.array_equal(wl, wl_grid):
+        return values.copy()
+    
+    wl = np.asarray(wl, dtype=float)
+    if np.any(np.diff(wl) < 0):
+        order = np.argsort(wl, kind='stable')
+        wl = wl[order]
+        values = values[order]
+    
+    return np.interp(wl_grid, wl, values, left=np.nan, right=np.nan)
+
+
+def __nanstat(func, values):
+# Function used by comb_spec only
+# Applies a nan-aware numpy reduction along spectra without warning about
+# wavelengths where all values are nans.
+    import warnings
+    
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return func(values, axis=0)
+
+
+def __read_file(spFile, errors, atomicron, negtonan, templ, verb, cache, cachesize):
+# Function used by read_spec only
+# (by Alejo, Jocelyn)
+# Reads spectral data from one fits or ascii file. Returns the spectral data
+# and a dictionary with header data (both None if unsuccessful).
+    
+    # 1. Determine the type of file it is
+    isFits = False
+    ext = spFile[-4:].lower()
+    if ext == 'fits' or ext == '.fit':
+        isFits = True
+    
+    # 2. Look for the decoded spectral data in the cache
+    keyName = None
+    if isFits and cache is not None:
+        try:
+            keyName = __cache_key(spFile, (errors, atomicron, negtonan, templ))
+        except OSError:
+            keyName = None
+        if keyName is not None:
+            cached = __cache_load(cache, keyName)
+            if cached is not None:
+                return cached
+    
+    # 3. Get data from file
+    if isFits:
+        import astropy.io.fits as pf
+        try:
+            fitsData, fitsHeader = pf.getdata(spFile, header=True, memmap=False)
+        except IOError:
+            print('Could not open ' + str(spFile) + '.')
+            return None, None
+    # Assume ascii file otherwise (isFits = False)
+    else:
+        try:
+            import astropy.io.ascii as ad
+            aData = ad.read(spFile)
+            specData = [aData.columns[0], aData.columns[1]]
+            if len(aData) >= 3 and errors:
+                specData.append(aData.columns[2])
+        except IOError:
+            print('Could not open ' + str(spFile) + '.')
+            return None, None
+    
+    # 4. Get header data (including whether data in fits file is linear)
+    if isFits:
+        specMeta = __get_meta(fitsHeader)
+        if specMeta['CTYPE1'] is None and verb:
+            print('Data in ' + spFile + ' assumed to be linear.')
+    else:
+        specMeta = dict(LINEAR=True, RES=None, CTYPE1=None)
+    
+    # 5. Get wl, flux & error data from fits file
+    #    (returns wl in pos. 0, flux in pos. 1, error values in pos. 2)
+    #    (If template spec: min flux in pos. 3, max flux in pos. 4)
+    if isFits:
+        specData = __get_spec(fitsData, fitsHeader, spFile, errors, \
+                              templ=templ, verb=verb)
+        if specData is None:
+            return None, None
+        
+        # Generate wl axis when needed
+        if specData[0] is None:
+            specData[0] = __create_waxis(fitsHeader, len(specData[1]), spFile, \
+                                         verb=verb)
+        # If no wl axis generated, then clear out all retrieved data for object
+        if specData[0] is None:
+            return None, None
+    
+    # 6. Convert units in wl-axis from Angstrom into microns if desired
+    if atomicron:
+        if specData[0][-1] > 8000:
+            specData[0] = specData[0] / 10000
+    
+    # 7. Set negative flux values equal to zero (next step sets them to nans)
+    if negtonan:
+        negIdx = np.where(specData[1] < 0)
+        if len(negIdx[0]) > 0:
+            specData[1][negIdx] = 0
+            if verb:
+                print('%i negative data points found in %s.' \
+                        % (len(negIdx[0]), spFile))
+    
+    # 8. Set zero flux values as nans (do this always)
+    zeros = np.where(specData[1] == 0)
+    if len(zeros[0]) > 0:
+        specData[1][zeros] = np.nan
+    
+    # 9. Store decoded spectral data in the cache
+    if keyName is not None:
+        __cache_save(cache, keyName, specData, specMeta, cachesize)
+    
+    return specData, specMeta
+
+
+def __get_meta(fitsHeader):
+# Function used by read_spec only
+# Gathers the header data that other functions need later (resolution, linearity,
+# and wavelength solution), so that fits files need not be opened again.
+    
+    # Define key names in fits header
+    KEY_RES  = ['RES','RP']
+    KEY_WAXIS = ['CRVAL1','CDELT1','CD1_1','COEFF0','COEFF1','LTV1']
+    
+    specMeta = dict(LINEAR=True, RES=None, CTYPE1=None)
+    
+    # Resolution
+    for keyName in KEY_RES:
+        if keyName in fitsHeader:
+            specMeta['RES'] = int(fitsHeader[keyName])
+            break
+    
+    # Linearity
+    if 'CTYPE1' in fitsHeader:
+        specMeta['CTYPE1'] = str(fitsHeader['CTYPE1'])
+        if specMeta['CTYPE1'].strip().upper() != 'LINEAR':
+            specMeta['LINEAR'] = False
+    
+    # Wavelength solution
+    for keyName in KEY_WAXIS:
+        if keyName in fitsHeader:
+            specMeta[keyName] = float(fitsHeader[keyName])
+    
+    return specMeta
+
+
 def __get_spec(fitsData, fitsHeader, fileName, errorVals, templ=False, verb=True):
 # Function used by read_spec only
 # (by Alejo)
@@ -1122,6 +1814,538 @@ def __get_spec(fitsData, fitsHeader, fileName, errorVals, templ=False, verb=True
     return validData
 
 
+def __write_ascii(table, fileName, delimiter):
+# Function used by create_ascii only
+# Writes a 2-D array into an ascii file, one row per line, using the shortest
+# representation of each value that reads back the same number.
+    lines = [delimiter.join([repr(val) for val in row]) for row in table.tolist()]
+    with open(fileName, 'w') as asciiFile:
+        asciiFile.write('\n'.join(lines) + '\n')
+
+
 # V +++++++++++++++++++++++++ PUBLIC CLASSES ++++++++++++++++++++++++++++++++++
 # Classes meant to be used by end users of astrotools. Capitalize class names.
+
+class SpecAccumulator(object):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Running statistics of a set of spectra on a fixed wavelength grid, to combine spectra fed one at a time or in chunks (as many as needed) in constant memory. Each spectrum is interpolated into the grid when it is added, and then only its contribution to the statistics at each wavelength is kept: number of valid flux values, mean and sum of squared deviations (updated with Welford's algorithm, merging chunks with Chan's formula), sums of inverse variances and of fluxes over variances (for the weighted mean), and the *depth* lowest and highest flux values (with the id of their spectrum).
+    
+    *result* gives the same combined spectrum as *comb_spec* (and *mean_comb*) would give for all spectra at once: a weighted mean if all spectra came with uncertainties, and a straight mean and variance otherwise.
+    
+    Spectra can also be removed (giving the same id they were added with), in which case the statistics are updated as if the spectrum had never been added. The min and max flux values are known as long as fewer than *depth* of the spectra holding the lowest (or highest) values at a wavelength are removed; otherwise those wavelengths are listed in *stale* until *refill* is given all spectra again.
+    
+    *wave*
+      Array of wavelengths of the grid (e.g. the wavelength array of the first spectrum, as used by *mean_comb*).
+    *depth*
+      Integer, number of lowest and highest flux values kept at each wavelength.
+    *state*
+      Dictionary returned by *state*, to restore a SpecAccumulator saved before (*wave* and *depth* are then taken from it).
+    '''
+    
+    _ARRAYS = ('wave', 'count', 'mean', 'm2', 'invsum', 'wfluxsum', 'lows', 'lowIds', \
+               'highs', 'highIds')
+    
+    def __init__(self, wave=None, depth=1, state=None):
+        if state is not None:
+            for name in self._ARRAYS:
+                setattr(self, name, np.array(state[name]))
+            self.numSpec = int(state['numSpec'])
+            self.unweighted = int(state['unweighted'])
+            self.nextId = int(state['nextId'])
+            self.depth = len(self.lows)
+            return
+        
+        self.wave = _as_column(wave)
+        self.depth = depth
+        numPoints = len(self.wave)
+        self.numSpec = 0
+        self.unweighted = 0 # Number of spectra added without uncertainties
+        self.nextId = 0     # Id given to the next spectrum added with no id
+        self.count = np.zeros(numPoints, dtype=int)
+        self.mean = np.zeros(numPoints)
+        self.m2 = np.zeros(numPoints)
+        self.invsum = np.zeros(numPoints)  # Sum(1/sigma_i^2)
+        self.wfluxsum = np.zeros(numPoints) # Sum(x_i/sigma_i^2)
+        self.lows = np.zeros((depth, numPoints)) * np.nan
+        self.highs = np.zeros((depth, numPoints)) * np.nan
+        self.lowIds = np.zeros((depth, numPoints), dtype=int) - 1
+        self.highIds = np.zeros((depth, numPoints), dtype=int) - 1
+    
+    def __len__(self):
+        return self.numSpec
+    
+    @property
+    def weighted(self):
+        # Whether all spectra added came with uncertainties.
+        return self.unweighted == 0
+    
+    @property
+    def stale(self):
+        # Boolean array, True where the min or max flux values are unknown
+        # because the spectra holding them were removed (see refill).
+        return (self.count > 0) & (np.isnan(self.lows[0]) | np.isnan(self.highs[0]))
+    
+    def add(self, spectra, robust=None, ids=None):
+        # Adds one spectrum, a Python list of spectra, or a SpectrumBatch (missing
+        # spectra, None, are skipped). robust is as in resample_spec. ids are the
+        # integer ids of the spectra (needed to remove them later); if none given,
+        # spectra are numbered in the order they are added. Returns the ids.
+        spectra, ids = self._spec_ids(spectra, ids)
+        if len(spectra) == 0:
+            return ids
+        if ids is None:
+            ids = list(range(self.nextId, self.nextId + len(spectra)))
+        ip_spectra = resample_spec(spectra, mask=self.wave, robust=robust)
+        
+        # Spectra with and without uncertainties in the same chunk are added one
+        # by one, to keep the weighted sums of the ones with uncertainties
+        if ip_spectra[2] is None and len(spectra) > 1:
+            for spec, specId in zip(spectra, ids):
+                self.add([spec], robust=robust, ids=[specId])
+            return ids
+        
+        self.add_resampled(ip_spectra, ids)
+        return ids
+    
+    def add_resampled(self, ip_spectra, ids=None):
+        # Adds spectra already interpolated into the grid (as returned by
+        # resample_spec with mask=wave). Returns the ids (see add).
+        fluxes = ip_spectra[1]
+        uncs = ip_spectra[2]
+        if ids is None:
+            ids = list(range(self.nextId, self.nextId + len(fluxes)))
+        self.nextId = max(self.nextId, max(ids) + 1)
+        self.numSpec += len(fluxes)
+        
+        # Straight mean & squared deviations: merge the chunk into the running values
+        finite = np.isfinite(fluxes)
+        chunkCount = finite.sum(axis=0)
+        values = np.where(finite, fluxes, 0.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chunkMean = np.where(chunkCount > 0, values.sum(axis=0) / chunkCount, 0.)
+            chunkM2 = np.sum(np.where(finite, fluxes - chunkMean, 0.) ** 2, axis=0)
+        self._merge_moments(chunkCount, chunkMean, chunkM2)
+        
+        # Weighted sums (nan terms skipped, as comb_spec does)
+        if uncs is None:
+            self.unweighted += len(fluxes)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.invsum = self.invsum + np.nansum(1. / uncs, axis=0)
+                self.wfluxsum = self.wfluxsum + np.nansum(fluxes / uncs, axis=0)
+        
+        # Extreme flux values
+        self._fold_extremes(np.where(finite, fluxes, np.nan), ids)
+        return ids
+    
+    def remove(self, spectra, ids, robust=None):
+        # Removes spectra added before with the given ids (one at a time, in
+        # O(number of wavelengths) each). The spectra (and robust) must be the
+        # same given to add.
+        spectra, ids = self._spec_ids(spectra, ids)
+        for spec, specId in zip(spectra, ids):
+            ip_spectra = resample_spec([spec], mask=self.wave, robust=robust)
+            flux = ip_spectra[1][0]
+            finite = np.isfinite(flux)
+            
+            # Reverse Welford update
+            total = self.count - finite
+            with np.errstate(divide='ignore', invalid='ignore'):
+                newMean = np.where(total > 0, (self.count * self.mean - np.where(finite, \
+                                   flux, 0.)) / total, 0.)
+                self.m2 = np.where(total > 0, self.m2 - np.where(finite, (flux - newMean) \
+                                   * (flux - self.mean), 0.), 0.)
+            self.m2 = np.maximum(self.m2, 0.)
+            self.mean = newMean
+            self.count = total
+            self.numSpec -= 1
+            
+            if ip_spectra[2] is None:
+                self.unweighted -= 1
+            else:
+                sigma = ip_spectra[2][0]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    invTerm = 1. / sigma
+                    fluxTerm = flux / sigma
+                self.invsum = self.invsum - np.where(np.isnan(invTerm), 0., invTerm)
+                self.wfluxsum = self.wfluxsum - np.where(np.isnan(fluxTerm), 0., fluxTerm)
+            
+            # Drop the spectrum from the extreme values it holds
+            for values, valIds, sign in [(self.lows, self.lowIds, 1.), \
+                                         (self.highs, self.highIds, -1.)]:
+                held = valIds == specId
+                values[held] = np.nan
+                valIds[held] = -1
+                order = np.argsort(sign * values, axis=0, kind='stable')
+                values[:] = np.take_along_axis(values, order, axis=0)
+                valIds[:] = np.take_along_axis(valIds, order, axis=0)
+    
+    def refill(self, spectra, ids, robust=None):
+        # Finds again the extreme flux values from all spectra in the accumulator
+        # (with their ids), only at the wavelengths where they are stale.
+        spectra, ids = self._spec_ids(spectra, ids)
+        stale = self.stale
+        if not stale.any() or len(spectra) == 0:
+            return
+        fresh = SpecAccumulator(self.wave, self.depth)
+        fresh.add(spectra, robust=robust, ids=ids)
+        for name in ['lows', 'lowIds', 'highs', 'highIds']:
+            getattr(self, name)[:,stale] = getattr(fresh, name)[:,stale]
+    
+    def merge(self, other):
+        # Adds the statistics of another SpecAccumulator on the same grid (e.g.
+        # one fed with other spectra in another process; spectra ids must differ).
+        self._merge_moments(other.count, other.mean, other.m2)
+        self.numSpec += other.numSpec
+        self.unweighted += other.unweighted
+        self.nextId = max(self.nextId, other.nextId)
+        self.invsum = self.invsum + other.invsum
+        self.wfluxsum = self.wfluxsum + other.wfluxsum
+        self._fold_extremes(np.vstack([other.lows, other.highs]), \
+                            np.vstack([other.lowIds, other.highIds]))
+    
+    def leave_one_out(self, ip_spectra, forcesimple=False):
+        # Returns the mean flux and variance that result would give without each
+        # of the given spectra (all added before, and interpolated into the grid
+        # as for add_resampled), as arrays with one row per spectrum. They are
+        # found from the running statistics, so all rows take O(number of
+        # spectra x number of wavelengths) altogether.
+        fluxes = ip_spectra[1]
+        uncs = ip_spectra[2]
+        finite = np.isfinite(fluxes)
+        count = self.count - finite
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.weighted and self.numSpec > 0 and uncs is not None and not forcesimple:
+                invTerm = 1. / uncs
+                fluxTerm = fluxes / uncs
+                mvar = 1. / (self.invsum - np.where(np.isnan(invTerm), 0., invTerm))
+                mean = (self.wfluxsum - np.where(np.isnan(fluxTerm), 0., fluxTerm)) * mvar
+            else:
+                # Reverse Welford update of each spectrum
+                mean = np.where(count > 0, (self.count * self.mean - np.where(finite, \
+                                fluxes, 0.)) / count, np.nan)
+                m2 = self.m2 - np.where(finite, (fluxes - mean) * (fluxes - self.mean), 0.)
+                m2 = np.where(count > 1, np.maximum(m2, 0.), 0.) # (no rounding leftovers)
+                mvar = np.where(count > 0, m2 / count, np.nan)
+        
+        return mean, mvar
+    
+    def result(self, forcesimple=False, extremes=False):
+        # Returns the combined spectrum as comb_spec does: wavelength grid, mean
+        # flux, and variance, plus min and max flux values if extremes=True.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.weighted and self.numSpec > 0 and not forcesimple:
+                mvar = 1. / self.invsum
+                mean = self.wfluxsum * mvar
+            else:
+                mean = np.where(self.count > 0, self.mean, np.nan)
+                mvar = np.where(self.count > 0, self.m2 / self.count, np.nan)
+        
+        if extremes:
+            return [self.wave, mean, mvar, self.lows[0].copy(), self.highs[0].copy()]
+        return [self.wave, mean, mvar]
+    
+    def renorm_factors(self, spectra, robust=None):
+        # Returns the factors that re-normalize spectra (all added before) to the
+        # current combined spectrum, as comb_spec does with renormalize=True
+        # (the median of the ratio of each spectrum to the combined spectrum).
+        spectra, ids = self._spec_ids(spectra, None)
+        ip_spectra = resample_spec(spectra, mask=self.wave, robust=robust)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.median(ip_spectra[1] / self.result()[1], axis=1)
+    
+    def state(self):
+        # Returns a dictionary of numpy arrays with all the statistics, to save
+        # them (e.g. with np.savez) and restore them later (see state above).
+        state = {}
+        for name in self._ARRAYS:
+            state[name] = getattr(self, name)
+        state['numSpec'] = np.array(self.numSpec)
+        state['unweighted'] = np.array(self.unweighted)
+        state['nextId'] = np.array(self.nextId)
+        return state
+    
+    def _fold_extremes(self, values, ids):
+        # Keeps the depth lowest and highest values of each wavelength among the
+        # ones kept and the given values (one row per spectrum, with their ids).
+        ids = np.broadcast_to(np.asarray(ids, dtype=int).reshape(-1, 1), values.shape) \
+              if np.ndim(ids) == 1 else np.asarray(ids, dtype=int)
+        for name, sign in [('lows', 1.), ('highs', -1.)]:
+            allValues = np.vstack([getattr(self, name), values])
+            allIds = np.vstack([getattr(self, name[:-1] + 'Ids'), ids])
+            order = np.argsort(sign * allValues, axis=0, kind='stable')[:self.depth]
+            setattr(self, name, np.take_along_axis(allValues, order, axis=0))
+            setattr(self, name[:-1] + 'Ids', np.take_along_axis(allIds, order, axis=0))
+    
+    def _merge_moments(self, count, mean, m2):
+        # Merges counts, means and squared deviations into the running values
+        # (Chan's formula).
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0.)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 \
+                               * self.count * count / total, 0.)
+        self.count = total
+    
+    def _spec_ids(self, spectra, ids):
+        # Returns spectra as a Python list (without missing ones) and their ids
+        # (None if not given).
+        if spectra is None:
+            return [], [] if ids is None else ids
+        oneSpec = isinstance(spectra, Spectrum)
+        if not oneSpec and not isinstance(spectra, SpectrumBatch) and spectra[0] is not None \
+           and not isinstance(spectra[0], Spectrum):
+            try:
+                oneSpec = np.ndim(spectra[0]) == 1
+            except ValueError:
+                # Spectra with columns of different lengths (or no uncertainties)
+                oneSpec = False
+        if oneSpec:
+            spectra = [spectra]
+            if ids is not None and np.ndim(ids) == 0:
+                ids = [ids]
+        keep = [spIdx for spIdx, spec in enumerate(spectra) if spec is not None]
+        if ids is not None:
+            ids = [int(ids[spIdx]) for spIdx in keep]
+        return [spectra[spIdx] for spIdx in keep], ids
+
+
+class SpecArchive(object):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Spectral data stored in an archive created by *pack_spec*. The data file is opened with np.memmap, so nothing is read from disk until a spectrum is used, and spectra are returned as views into the archive (not copies) with no file parsing at all. Spectra are found by name (see *pack_spec*) or by key (e.g. reference number).
+    
+    A SpecArchive behaves like a read-only dictionary of spectra keyed by name, where each spectrum is a Python list with wavelength in position 0, flux in position 1, and error values in position 2.
+    
+    *archive*
+      String with name of the archive (with full path and no extension).
+    '''
+    
+    def __init__(self, archive):
+        import json
+        
+        with open(archive + '.json') as indexFile:
+            index = json.load(indexFile)
+        self.archive = archive
+        self.entries = index['entries']
+        if index['numpix'] > 0:
+            self.data = np.memmap(archive + '.dat', dtype=index['dtype'], mode='r', \
+                                  shape=(index['numcols'], index['numpix']))
+        else:
+            self.data = np.zeros((index['numcols'], 0))
+        
+        # Hash indexes: name -> position, key -> positions
+        self.names = {}
+        self.keys = {}
+        for entryIdx, entry in enumerate(self.entries):
+            self.names[entry['name']] = entryIdx
+            self.keys.setdefault(entry['key'], []).append(entryIdx)
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, name):
+        return name in self.names
+    
+    def __getitem__(self, name):
+        entry = self.entries[self.names[name]]
+        start = entry['offset']
+        end = start + entry['npix']
+        return [self.data[0,start:end], self.data[1,start:end], self.data[2,start:end]]
+    
+    def get(self, names):
+        # Returns the spectra with the given names (None for those not in archive)
+        return [self[name] if name in self.names else None for name in names]
+    
+    def get_meta(self, names):
+        # Returns the header data of the spectra with the given names
+        return [self.entries[self.names[name]]['meta'] if name in self.names \
+                else None for name in names]
+    
+    def current(self, name, spFile):
+        # Returns whether the spectrum with the given name is in the archive and
+        # its file (with full path) has the same size and modification time as
+        # when it was packed
+        if name not in self.names:
+            return False
+        stamp = self.entries[self.names[name]].get('stamp')
+        return stamp is not None and stamp == _file_stamp(spFile)
+    
+    def get_key(self, key):
+        # Returns the names of the spectra with the given key
+        return [self.entries[entryIdx]['name'] for entryIdx in self.keys.get(key, [])]
+    
+    def batch(self, names):
+        # Returns the spectra with the given names as a SpectrumBatch
+        return SpectrumBatch(self.get(names))
+
+
+class Spectrum(object):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Spectral data of one object, stored as contiguous float arrays: wavelength (*wave*), flux (*flux*), and optional uncertainties (*sigma*); template spectra also have min and max flux values (*fmin* and *fmax*). *mask* is a boolean array that is True where flux values are finite (it is set when the object is created).
+    
+    A Spectrum behaves like the Python lists used by the rest of astrotools (wavelength in position 0, flux in position 1, uncertainties in position 2, and for templates min and max flux in positions 3 and 4), so it can be given to any function that expects them. The functions *read_spec*, *sel_band*, *norm_spec*, *smooth_spec*, and *mean_comb* return Spectrum objects when they receive them.
+    
+    *wave*
+      Array with wavelength values.
+    *flux*
+      Array with flux values.
+    *sigma*
+      Array with uncertainties of the flux values, if any.
+    *fmin*
+      Array with min flux values, for template spectra.
+    *fmax*
+      Array with max flux values, for template spectra.
+    '''
+    __slots__ = ('wave', 'flux', 'sigma', 'fmin', 'fmax', 'mask')
+    _COLS = ('wave', 'flux', 'sigma', 'fmin', 'fmax')
+    
+    def __init__(self, wave, flux, sigma=None, fmin=None, fmax=None):
+        self.wave = _as_column(wave)
+        self.flux = _as_column(flux)
+        self.sigma = _as_column(sigma)
+        self.fmin = _as_column(fmin)
+        self.fmax = _as_column(fmax)
+        self.mask = np.isfinite(self.flux)
+    
+    def __len__(self):
+        if self.fmin is not None or self.fmax is not None:
+            return 5
+        elif self.sigma is not None:
+            return 3
+        else:
+            return 2
+    
+    def __getitem__(self, idx):
+        return self.tolist()[idx]
+    
+    def __setitem__(self, idx, value):
+        colName = self._COLS[:len(self)][idx]
+        setattr(self, colName, _as_column(value))
+        if colName == 'flux':
+            self.mask = np.isfinite(self.flux)
+    
+    def __iter__(self):
+        return iter(self.tolist())
+    
+    def tolist(self):
+        # Returns the spectral data as a Python list of arrays
+        return [getattr(self, colName) for colName in self._COLS[:len(self)]]
+
+
+class SpectrumBatch(object):
+    '''
+    (by Alejandro N |uacute| |ntilde| ez)
+    
+    Spectral data of many objects, stored as 2-D float arrays with one spectrum per row: *flux*, *sigma* (None if no spectrum has uncertainties), and *mask* (True where flux values are finite). When all spectra share the same wavelength array, *wave* is that 1-D array; otherwise *wave* is 2-D too, and shorter spectra are padded with nans (*npix* holds the number of data points of each spectrum). *present* is False for missing spectra (None).
+    
+    A SpectrumBatch behaves like a Python list of spectra: indexing it returns a Spectrum object (with views into the 2-D arrays, not copies) or None for missing spectra, so it can be given to any function that expects a list of spectra. The functions *sel_band*, *norm_spec*, *smooth_spec*, and *mean_comb* return SpectrumBatch objects when they receive them.
+    
+    *spectra*
+      Python list of spectra (Spectrum objects or Python lists with wavelength in position 0, flux in position 1, and optional uncertainties in position 2), where missing spectra are None.
+    '''
+    __slots__ = ('wave', 'flux', 'sigma', 'mask', 'npix', 'present')
+    
+    def __init__(self, spectra):
+        numSpec = len(spectra)
+        self.present = np.array([spec is not None for spec in spectra], dtype=bool)
+        self.npix = np.array([len(spec[0]) if spec is not None else 0 \
+                              for spec in spectra], dtype=int)
+        numPix = self.npix.max() if numSpec > 0 else 0
+        
+        # Use a shared wavelength array if possible
+        waves = [_as_column(spec[0]) for spec in spectra if spec is not None]
+        shared = len(waves) > 0 and all(len(wave) == numPix for wave in waves)
+        if shared:
+            shared = all(np.array_equal(wave, waves[0]) for wave in waves[1:])
+        
+        if shared:
+            self.wave = waves[0].copy()
+        else:
+            self.wave = np.full((numSpec, numPix), np.nan)
+        self.flux = np.full((numSpec, numPix), np.nan)
+        hasSigma = any(spec is not None and len(spec) >= 3 and spec[2] is not None \
+                       for spec in spectra)
+        if hasSigma:
+            self.sigma = np.full((numSpec, numPix), np.nan)
+        else:
+            self.sigma = None
+        
+        for spIdx, spec in enumerate(spectra):
+            if spec is None:
+                continue
+            numVals = self.npix[spIdx]
+            if not shared:
+                self.wave[spIdx,:numVals] = spec[0]
+            self.flux[spIdx,:numVals] = spec[1]
+            if hasSigma and len(spec) >= 3 and spec[2] is not None:
+                self.sigma[spIdx,:numVals] = spec[2]
+        
+        self.mask = np.isfinite(self.flux)
+    
+    def __len__(self):
+        return len(self.present)
+    
+    def __getitem__(self, idx):
+        if not self.present[idx]:
+            return None
+        numVals = self.npix[idx]
+        if self.wave.ndim == 1:
+            wave = self.wave
+        else:
+            wave = self.wave[idx,:numVals]
+        sigma = None
+        if self.sigma is not None:
+            sigma = self.sigma[idx,:numVals]
+        return Spectrum(wave, self.flux[idx,:numVals], sigma)
+    
+    def __iter__(self):
+        for spIdx in range(len(self)):
+            yield self[spIdx]
+    
+    def columns(self, minIdx, maxIdx):
+        # Returns a SpectrumBatch with data points minIdx to maxIdx of every
+        # spectrum; only for a shared wavelength array. Arrays are views, not copies.
+        batch = SpectrumBatch([])
+        batch.wave = self.wave[minIdx:maxIdx]
+        batch.flux = self.flux[:,minIdx:maxIdx]
+        batch.sigma = None if self.sigma is None else self.sigma[:,minIdx:maxIdx]
+        batch.mask = self.mask[:,minIdx:maxIdx]
+        batch.npix = np.where(self.present, len(batch.wave), 0)
+        batch.present = self.present
+        return batch
+    
+    def tolist(self):
+        # Returns the spectral data as a Python list of Python lists of arrays
+        return [None if spec is None else spec.tolist() for spec in self]
+    
+    @property
+    def sharedwave(self):
+        # Whether all spectra share the same wavelength array
+        return self.wave.ndim == 1
+
+
+def _as_column(values):
+# Used by Spectrum and SpectrumBatch only
+# Converts data into a contiguous float array (no copy if it already is one).
+    if values is None:
+        return None
+    return np.ascontiguousarray(values, dtype=float)
+
+
+def _file_stamp(spFile):
+# Used by pack_spec and SpecArchive only
+# Returns the size and modification time (in ns) of a file, or None if missing.
+    try:
+        fileStat = os.stat(spFile)
+    except OSError:
+        return None
+    return [fileStat.st_size, fileStat.st_mtime_ns]
+
     
@@ -0,0 +1,12 @@
+'''
+The package bench measures how the template-building code scales, on synthetic data with the same layout as the real project (so that the real data are not needed).
+
+bench.synth writes synthetic projects: NIR and optical fits files, objects & standards catalogs, and keepers & rejects files, for any number of objects (e.g. 100 to 100,000).
+
+bench.checks runs regression checks on a small synthetic project. Run it from the code folder as: python -m bench.checks
+
+bench.run times astrotools functions, nir_opt_comp_strip.main, and full template builds on those projects, and writes a JSON report. Run it from the code folder as: python -m bench.run 100 1000 10000 --report bench_report.json
+'''
+
+from bench.synth import make_project
+from bench.run import main, SCENARIOS
@@ -0,0 +1,273 @@
+'''
+The main() procedure runs regression checks of behaviours that broke before, on small synthetic spectra and projects (see bench.synth), and prints one line per check.
+
+INPUT:  1) checks: Python list of checks to run (all in CHECKS by default).
+        2) seed: Integer, seed of the synthetic project.
+
+OUTPUT: 1) Dictionary that maps check name to a dictionary with whether it passed
+           ('ok') and what was found ('message').
+        2) A line per check printed on screen.
+
+Run it from the code folder as: python -m bench.checks [checks]
+(it exits with status 1 if any check fails)
+'''
+
+import contextlib
+import io
+import os
+
+import numpy as np
+
+CHECKS = ['opt_sigma', 'manifests', 'archive', 'screening', 'unsorted_wl', 'spec_list', \
+          'template_stream', 'float32_data']
+
+# Number of objects of the synthetic project
+NUM_OBJS = 60
+
+
+def main(checks=CHECKS, seed=0):
+    
+    # 1. LOAD RELEVANT MODULES ------------------------------------------------
+    import tempfile
+    import traceback
+    
+    # 2. CHECK INPUT ----------------------------------------------------------
+    unknown = [name for name in checks if name not in CHECKS]
+    if len(unknown) > 0:
+        print('Unknown checks: ' + ', '.join(unknown))
+        return
+    
+    # 3. RUN EACH CHECK ON A NEW SYNTHETIC PROJECT ----------------------------
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        context = Context(folder, seed)
+        for name in checks:
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ok, message = check(name, context)
+            except Exception:
+                ok, message = False, traceback.format_exc().strip().split('\n')[-1]
+            results[name] = dict(ok=ok, message=message)
+            print('%s %-16s %s' % ('OK  ' if ok else 'FAIL', name, message))
+    
+    return results
+
+
+class Context(object):
+    '''
+    Synthetic project written only when a check first needs it.
+    
+    *folder*
+      String, folder where to write the project.
+    *seed*
+      Integer, seed of the project.
+    '''
+    
+    def __init__(self, folder, seed=0):
+        self.folder = folder
+        self.seed = seed
+        self.project = None
+    
+    def session(self):
+        # Returns a new nir_opt_comp_strip.DataSession of the project, writing
+        # the project the first time.
+        import nir_opt_comp_strip as nocs
+        from bench import synth
+        
+        if self.project is None:
+            self.project = synth.make_project(self.folder + '/project', NUM_OBJS, self.seed)
+        return nocs.DataSession(folderRoot=self.project['folderRoot'], \
+                                folderIn=self.project['folderIn'])
+
+
+def check(name, context):
+    # Runs a check. Returns whether it passed, and a message with what was found.
+    import astrotools as at
+    import nir_opt_comp_strip as nocs
+    
+    if name == 'opt_sigma':
+        # smooth_batch keeps missing uncertainties missing, so optical spectra
+        # (with no uncertainties) give a finite OPT template
+        wl = np.linspace(0.6, 1.0, 200)
+        flux = 1. + 0.1 * np.sin(20. * wl)
+        sigma = np.zeros(200) * np.nan
+        sigma[50:] = 0.01
+        smoothed = at.smooth_batch([[wl, flux, np.zeros(200) * np.nan], [wl, flux, sigma]], \
+                                   winWidth=10)
+        if np.isfinite(smoothed[0][2]).any():
+            return False, 'all-nan uncertainties became finite'
+        if np.isfinite(smoothed[1][2][:50]).any() or not np.isfinite(smoothed[1][2][50:]).all():
+            return False, 'missing uncertainties not kept where they were missing'
+        
+        session = context.session()
+        rows = list(session.catalog.select('L3'))
+        optSpecs = [spec for spec in nocs.member_spectra(session, rows)['OPT'] \
+                    if spec is not None]
+        template = nocs.make_template(optSpecs, renormalize=False)[0]
+        numFinite = np.isfinite(template[1]).sum()
+        return numFinite == len(template[1]), 'L3 OPT template: %i of %i finite flux ' \
+               'points' % (numFinite, len(template[1]))
+    
+    elif name == 'manifests':
+        # Keepers files edited in place (the folder is not modified) are read again
+        import catalog
+        
+        session = context.session()
+        manifests = catalog.load_manifests(session.folderIn)
+        spType, grav = max([templKey for templKey in manifests.manifests \
+                            if manifests.get(*templKey, 'keepers') is not None], \
+                           key=lambda templKey: len(manifests.get(*templKey, 'keepers')))
+        keepers = manifests.get(spType, grav, 'keepers')
+        fileName = session.folderIn + keepers.fileName
+        folderTimes = os.stat(session.folderIn)
+        with open(fileName) as manFile:
+            lines = manFile.readlines()
+        try:
+            with open(fileName, 'w') as manFile:
+                manFile.writelines([line for line in lines if line.split('\t')[0].strip() \
+                                    != keepers.names[0][:-5]])
+            os.utime(session.folderIn, ns=(folderTimes.st_atime_ns, folderTimes.st_mtime_ns))
+            edited = catalog.load_manifests(session.folderIn).get(spType, grav, 'keepers')
+        finally:
+            with open(fileName, 'w') as manFile:
+                manFile.writelines(lines)
+        return keepers.names[0] not in edited, '%s keepers: %i before, %i after removing ' \
+               '%s in place' % (spType + grav, len(keepers), len(edited), keepers.names[0])
+    
+    elif name == 'archive':
+        # Spectra whose fits files changed after they were packed are read from
+        # the files, not from the archive
+        from astropy.io import fits
+        
+        session = context.session()
+        archive = context.folder + '/archive'
+        numPacked = nocs.pack_archive(archive, session.folderRoot, session.folderIn)
+        spFile = session.folderRoot + 'NIR/' + str(session.data['NIRfile'][0])
+        with open(spFile, 'rb') as fitsFile:
+            original = fitsFile.read()
+        try:
+            with fits.open(spFile) as hdus:
+                hdus[0].data = hdus[0].data * 2.
+                hdus.writeto(spFile, overwrite=True)
+            fresh = at.read_spec(spFile, atomicron=True, negtonan=True, errors=True, \
+                                 verbose=False)[0]
+            packed = nocs.DataSession(session.folderRoot, session.folderIn, \
+                                      archive=archive).read_spec([spFile])[0]
+        finally:
+            with open(spFile, 'wb') as fitsFile:
+                fitsFile.write(original)
+        ok = np.array_equal(packed[1], fresh[1], equal_nan=True)
+        return ok, '%i spectra packed; %s changed after packing read %s' % (numPacked, \
+               spFile[len(session.folderRoot):], 'from its file' if ok else 'from the archive')
+    
+    elif name == 'screening':
+        # Keepers & rejects files are replaced as a pair (older ones are kept if
+        # writing fails), and spectra that miss a band are screened in the others
+        import catalog
+        import screening
+        
+        folderIn = context.folder + '/screening/'
+        os.makedirs(folderIn)
+        result = dict(names=['N1.fits', 'N2.fits'], keep=np.array([True, False]), \
+                      chi2=np.ones((2, len(screening.CHI2_KEYS))))
+        screening.write_manifests(folderIn, 'L0', 'f', 2.0, result)
+        oldNames = sorted(os.listdir(folderIn))
+        replace = os.replace
+        def failing_replace(src, dst):
+            if dst.endswith('rejects.txt'):
+                raise OSError('disk full')
+            replace(src, dst)
+        os.replace = failing_replace
+        try:
+            screening.write_manifests(folderIn, 'L0', 'f', 1.5, result)
+        except OSError:
+            pass
+        finally:
+            os.replace = replace
+        if sorted([fileName for fileName in os.listdir(folderIn) \
+                   if not fileName.endswith('keepers.txt')]) != oldNames[1:]:
+            return False, 'failed write left ' + ', '.join(sorted(os.listdir(folderIn)))
+        screening.write_manifests(folderIn, 'L0', 'f', 1.5, result)
+        newNames = sorted(os.listdir(folderIn))
+        if newNames != ['comp_L0_s1.5_band_keepers.txt', 'comp_L0_s1.5_band_rejects.txt']:
+            return False, 'new write left ' + ', '.join(newNames)
+        
+        wl = np.linspace(0.9, 1.4, 300)
+        batch = at.SpectrumBatch([[wl, np.ones(300), np.ones(300) * 0.01]] * 2)
+        bands = screening.prepare_spectra(batch, None)
+        missing = [bandKey for bandKey in screening.CHI2_KEYS \
+                   if all([spec is None for spec in bands[bandKey]])]
+        return missing == ['H', 'K'], 'files: ' + ', '.join(newNames) + '; bands ' \
+               'missing from spectra at 0.9-1.4 um: ' + ', '.join(missing)
+    
+    elif name == 'unsorted_wl':
+        # Spectra with decreasing wavelengths are resampled as increasing ones
+        wl = np.linspace(1.0, 2.0, 100)
+        flux = 1. + wl ** 2
+        grid = np.linspace(1.1, 1.9, 50)
+        ip_spectra = at.resample_spec([[wl, flux], [wl[::-1], flux[::-1]]], mask=grid)
+        maxDiff = np.max(np.abs(ip_spectra[1][1] - ip_spectra[1][0]))
+        return maxDiff < 1e-12, 'max difference between increasing and decreasing ' \
+               'wavelengths: %.2g' % maxDiff
+    
+    elif name == 'spec_list':
+        # One spectrum is told from a list of spectra whatever its number of
+        # points or columns
+        wl = np.linspace(1.0, 1.1, 8)
+        single = at.sel_band([wl, np.ones(8), np.ones(8) * 0.1], [1.0, 1.1])
+        template = at.sel_band([wl] + [np.ones(8)] * 4, [1.0, 1.1])
+        found = [len(single), len(single[0]), len(template)]
+        return found == [1, 3, 1], 'spectrum of 8 points: %i spectra of %i columns; ' \
+               'template with 5 columns: %i spectra' % tuple(found)    
+    elif name == 'template_stream':
+        # Templates streamed from a generator (without re-normalizing) or a list
+        # of chunks are those of make_template; generators cannot be re-normalized
+        session = context.session()
+        rows = list(session.catalog.select('L2')) + list(session.catalog.select('L3'))
+        specs = [spec for spec in nocs.member_spectra(session, rows)['J'] if spec is not None]
+        chunks = [specs[chunkIdx:chunkIdx + 3] for chunkIdx in range(0, len(specs), 3)]
+        maxDiffs = []
+        for renormalize, chunkIter in [(False, (chunk for chunk in chunks)), (True, chunks)]:
+            streamed = nocs.make_template_stream(chunkIter, renormalize)[0]
+            template = nocs.make_template(specs, renormalize)[0]
+            for rowIdx in range(1, 5):
+                if not np.array_equal(np.isfinite(streamed[rowIdx]), np.isfinite(template[rowIdx])):
+                    return False, 'missing values differ (renormalize=%s)' % renormalize
+                finite = np.isfinite(template[rowIdx])
+                maxDiffs.append(np.max(np.abs(streamed[rowIdx][finite] - template[rowIdx][finite]) \
+                                       / np.abs(template[rowIdx][finite])))
+        try:
+            nocs.make_template_stream((chunk for chunk in chunks), True)
+            return False, 'a generator was re-normalized'
+        except TypeError:
+            pass
+        return max(maxDiffs) < 1e-10, '%i spectra in %i chunks: max relative difference ' \
+               '%.2g' % (len(specs), len(chunks), max(maxDiffs))
+    
+    elif name == 'float32_data':
+        # Float32 data (as read from fits files) are combined in float64, within
+        # float32 rounding of interpolating them in float32 as interp1d does
+        import scipy.interpolate as spi
+        
+        rng = np.random.default_rng(context.seed)
+        specs = []
+        for spIdx in range(5):
+            wl = np.sort(rng.uniform(0.9, 2.4, 300)).astype('>f4')
+            specs.append([wl, (1. + 0.1 * rng.standard_normal(300)).astype('>f4')])
+        ip_spectra = at.resample_spec(specs)
+        interp32 = spi.interp1d(specs[1][0], specs[1][1], bounds_error=False)(specs[0][0].tolist())
+        finite = np.isfinite(interp32)
+        maxDiff = np.max(np.abs(ip_spectra[1][1][finite] - interp32[finite]))
+        types = [ip_spectra[0].dtype, at.mean_comb(specs)[0].dtype]
+        ok = types == [np.float64] * 2 and np.array_equal(ip_spectra[0], specs[0][0]) \
+             and maxDiff < 1e-6
+        return ok, 'grids of %s and %s; max difference with float32 interpolation %.2g' \
+               % (types[0], types[1], maxDiff)
+
+
+if __name__ == '__main__':
+    import sys
+    
+    results = main(sys.argv[1:] or CHECKS)
+    if results is None or not all([results[name]['ok'] for name in results]):
+        sys.exit(1)
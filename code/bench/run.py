@@ -0,0 +1,268 @@
+'''
+The main() procedure times the astrotools functions used to build templates (read_spec, smooth_spec, smooth_batch, sel_band, norm_spec, mean_comb, avg_flux), nir_opt_comp_strip.main, and full template builds, on synthetic projects of the given sizes (see bench.synth). The timings are printed on screen and written to a JSON report.
+
+Projects are written in folder (one subfolder per size and seed) and reused by later runs with the same size and seed.
+
+INPUT:  1) sizes: Python list with the number of objects of each project.
+        2) folder: String, folder where to write the synthetic projects.
+        3) report: String, name of the JSON report (with full path); if None,
+           no report is written.
+        4) scenarios: Python list of scenarios to run (all in SCENARIOS by default).
+        5) repeat: Integer, number of times each scenario is timed (the best
+           and mean times are reported). Full template builds are timed once.
+        6) seed: Integer, seed of the synthetic projects.
+        7) workers: Integer, number of fits files read simultaneously by the
+           read_spec_threads and template_build scenarios.
+
+OUTPUT: 1) Dictionary with the report: machine & library versions ('meta'), and a
+           list with one dictionary per scenario and size ('results') with the
+           number of objects ('numObjs'), the number of items processed
+           ('numItems'), the best & mean times in seconds ('best', 'mean'), and
+           the best time per item ('perItem').
+        2) (if report is given) JSON file with the report.
+
+Run it from the code folder as: python -m bench.run [sizes] [--report file.json]
+'''
+
+import contextlib
+import io
+import json
+import os
+import time
+
+import numpy as np
+
+import def_constants as dc
+
+SCENARIOS = ['read_spec', 'read_spec_threads', 'smooth_spec', 'smooth_batch', \
+             'sel_band', 'norm_spec', 'mean_comb', 'avg_flux', 'avg_flux_batch', \
+             'nocs_main', 'template_build']
+
+# Scenarios timed only once, whatever the value of repeat
+ONCE = ['template_build']
+
+GRAVS = ['f','g','b']
+
+# Ranges used by the avg_flux scenarios (in microns)
+AVG_WINDOWS = [[1.20, 1.30], [1.55, 1.65], [2.10, 2.20]]
+
+# Spectral type whose template is built by the nocs_main scenario
+MAIN_SPTYPE = 'L3'
+
+
+def time_call(func, repeat=3):
+    # Calls func repeat times. Returns the best and mean times in seconds.
+    times = []
+    for repIdx in range(repeat):
+        startTime = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - startTime)
+    return min(times), sum(times) / len(times)
+
+
+def main(sizes=[100], folder='bench_data', report=None, scenarios=SCENARIOS, repeat=3, seed=0, workers=8):
+    
+    # 1. LOAD RELEVANT MODULES ------------------------------------------------
+    import platform
+    import astropy
+    import scipy
+    from bench import synth
+    
+    # 2. SET UP THE REPORT ----------------------------------------------------
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if len(unknown) > 0:
+        print('Unknown scenarios: ' + ', '.join(unknown))
+        return
+    meta = dict(python=platform.python_version(), numpy=np.__version__, \
+                scipy=scipy.__version__, astropy=astropy.__version__, \
+                machine=platform.machine(), system=platform.system(), \
+                cpus=os.cpu_count(), repeat=repeat, seed=seed, workers=workers, \
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    results = []
+    
+    for numObjs in sizes:
+        # 3. WRITE (OR REUSE) THE SYNTHETIC PROJECT ----------------------------
+        projFolder = os.path.join(folder, 'objs%i_seed%i' % (numObjs, seed))
+        stampName = os.path.join(projFolder, 'project.json')
+        if os.path.exists(stampName):
+            with open(stampName) as stampFile:
+                project = json.load(stampFile)
+        else:
+            startTime = time.perf_counter()
+            project = synth.make_project(projFolder, numObjs, seed)
+            print('Wrote %i objects in %.1f s' % (numObjs, time.perf_counter() - startTime))
+            with open(stampName, 'w') as stampFile:
+                json.dump(project, stampFile)
+        
+        # 4. TIME EACH SCENARIO ------------------------------------------------
+        context = Context(project, workers)
+        for scenName in scenarios:
+            func, numItems = scenario(scenName, context)
+            scenRepeat = 1 if scenName in ONCE else repeat
+            with contextlib.redirect_stdout(io.StringIO()):
+                best, mean = time_call(func, scenRepeat)
+            results.append(dict(scenario=scenName, numObjs=numObjs, numItems=numItems, \
+                                repeat=scenRepeat, best=best, mean=mean, \
+                                perItem=best / max(numItems, 1)))
+            print('%-18s %7i objs %8i items  best %9.4f s  mean %9.4f s  %8.2f us/item' \
+                  % (scenName, numObjs, numItems, best, mean, 1.e6 * best / max(numItems, 1)))
+    
+    # 5. WRITE THE REPORT -----------------------------------------------------
+    output = dict(meta=meta, results=results)
+    if report is not None:
+        with open(report, 'w') as reportFile:
+            json.dump(output, reportFile, indent=1)
+    
+    return output
+
+
+class Context(object):
+    '''
+    Spectra of a synthetic project, read and processed only when a scenario first needs them, so that each scenario times only its own step.
+    
+    *project*
+      Dictionary returned by bench.synth.make_project.
+    *workers*
+      Integer, number of fits files read simultaneously.
+    '''
+    
+    def __init__(self, project, workers=None):
+        import nir_opt_comp_strip as nocs
+        
+        self.project = project
+        self.workers = workers
+        self.values = {}
+        self.nirFiles = []
+        self.optFiles = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            objCatalog, dataS = nocs.read_catalogs(project['folderIn'])
+        for key, files in [('NIR', self.nirFiles), ('OPT', self.optFiles)]:
+            for fileName in objCatalog.data[key + 'file']:
+                files.append(project['folderRoot'] + key + '/' + fileName)
+    
+    def read(self, key, workers=None):
+        # Reads the NIR or OPT spectra (key) as nir_opt_comp_strip.DataSession
+        # does. Returns the spectra and their header data.
+        import astrotools as at
+        specFiles = self.nirFiles if key == 'NIR' else self.optFiles
+        return at.read_spec(specFiles, atomicron=True, negtonan=True, errors=True, \
+                            verbose=False, workers=workers, meta=True)
+    
+    def get(self, name):
+        # Returns the spectra read ('NIR', 'OPT'), smoothed NIR spectra
+        # ('smoothed'), their bands ('bands'), normalized J band ('normalized'),
+        # or a preloaded DataSession ('session'), calculating them the first time.
+        import astrotools as at
+        import nir_opt_comp_strip as nocs
+        
+        if name in self.values:
+            return self.values[name]
+        
+        bandLims, normLims = band_limits()
+        if name in ['NIR', 'OPT']:
+            value = self.read(name)
+        elif name == 'smoothed':
+            nirSpecs, nirMeta = self.get('NIR')
+            value = at.smooth_spec(nirSpecs, specMeta=nirMeta, winWidth=0)
+        elif name == 'bands':
+            value = at.sel_band(self.get('smoothed'), bandLims)
+        elif name == 'normalized':
+            value = at.norm_spec(self.get('bands')['J'], normLims['J'])
+        elif name == 'session':
+            with contextlib.redirect_stdout(io.StringIO()):
+                value = nocs.DataSession(folderRoot=self.project['folderRoot'], \
+                                         folderIn=self.project['folderIn'], \
+                                         preload=True, workers=self.workers)
+        self.values[name] = value
+        return value
+
+
+def band_limits():
+    # Returns dictionaries with the band and normalization limits of the J, H,
+    # and K bands.
+    bandLims = {}
+    normLims = {}
+    for bandKey in dc.BANDS:
+        bandLims[bandKey] = dc.BAND_LIMS[bandKey]['lim']
+        normLims[bandKey] = dc.NORM_LIMS[bandKey]['lim']
+    return bandLims, normLims
+
+
+def scenario(name, context):
+    # Returns the function to time for a scenario, and the number of items
+    # (spectra, or spectra x ranges for avg_flux) it processes.
+    import astrotools as at
+    import nir_opt_comp_strip as nocs
+    
+    bandLims, normLims = band_limits()
+    numSpecs = len(context.nirFiles)
+    
+    if name == 'read_spec':
+        return (lambda: context.read('NIR')), numSpecs
+    elif name == 'read_spec_threads':
+        return (lambda: context.read('NIR', context.workers)), numSpecs
+    elif name == 'smooth_spec':
+        nirSpecs, nirMeta = context.get('NIR')
+        return (lambda: at.smooth_spec(nirSpecs, specMeta=nirMeta, winWidth=0)), numSpecs
+    elif name == 'smooth_batch':
+        optSpecs, optMeta = context.get('OPT')
+        return (lambda: at.smooth_batch(optSpecs, specMeta=optMeta, winWidth=10)), \
+               len(context.optFiles)
+    elif name == 'sel_band':
+        smoothed = context.get('smoothed')
+        return (lambda: at.sel_band(smoothed, bandLims)), numSpecs
+    elif name == 'norm_spec':
+        bandJ = context.get('bands')['J']
+        return (lambda: at.norm_spec(bandJ, normLims['J'])), numSpecs
+    elif name == 'mean_comb':
+        normalized = context.get('normalized')
+        return (lambda: at.mean_comb(normalized, renormalize=True)), numSpecs
+    elif name == 'avg_flux':
+        nirSpecs = context.get('NIR')[0]
+        def avg_flux_loop():
+            for spec in nirSpecs:
+                for window in AVG_WINDOWS:
+                    at.avg_flux(window[0], window[1], spec, verbose=False)
+        return avg_flux_loop, numSpecs * len(AVG_WINDOWS)
+    elif name == 'avg_flux_batch':
+        nirSpecs = context.get('NIR')[0]
+        return (lambda: at.avg_flux_batch(AVG_WINDOWS, nirSpecs)), \
+               numSpecs * len(AVG_WINDOWS)
+    elif name == 'nocs_main':
+        # Templates of one spectral type (all gravities) from preloaded spectra
+        session = context.get('session')
+        def main_loop():
+            for grav in GRAVS:
+                nocs.main(MAIN_SPTYPE, grav, templ=True, plot=False, session=session)
+        return main_loop, len(session.catalog.select(MAIN_SPTYPE))
+    elif name == 'template_build':
+        # All templates from scratch, reading the spectra (as make_templ.py does,
+        # without writing them)
+        def build_all():
+            session = nocs.DataSession(folderRoot=context.project['folderRoot'], \
+                                       folderIn=context.project['folderIn'], \
+                                       workers=context.workers)
+            for spType in dc.SPTYPES:
+                for grav in GRAVS:
+                    nocs.main(spType, grav, templ=True, plot=False, session=session)
+        return build_all, numSpecs
+
+
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Times astrotools and template builds on synthetic data.')
+    parser.add_argument('sizes', nargs='*', type=int, default=[100], \
+                        help='number of objects of each synthetic project')
+    parser.add_argument('--folder', default='bench_data', \
+                        help='folder where to write the synthetic projects')
+    parser.add_argument('--report', default='bench_report.json', \
+                        help='name of the JSON report')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    
+    main(args.sizes, args.folder, args.report, args.scenarios, args.repeat, args.seed, \
+         args.workers)
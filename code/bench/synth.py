@@ -0,0 +1,191 @@
+'''
+The module synth generates a synthetic project with the same layout as the real data used by nir_opt_comp_strip.py: SpeX-prism-like NIR fits files and optical fits files (in the NIR and OPT folders), an objects catalog (nir_spex_prism_with_optical.txt), a NIR standards catalog (NIR_Standards_K10.txt), and the keepers & rejects files of every spectral type and gravity.
+
+NIR spectra span 0.65-2.55 microns in NIR_PIX points (wavelength, flux, and uncertainty in the rows of the fits data, like SpeX prism files); optical spectra span 6000-10000 Angstrom in OPT_PIX points, with their wavelength solution in the header. Fluxes are blackbodies with water absorption bands that deepen with spectral type, plus noise; low gravity objects are redder.
+
+Everything is drawn from a numpy random generator seeded with *seed*, so the same arguments always give the same files.
+'''
+
+import os
+
+import numpy as np
+
+import def_constants as dc
+
+# Number of points of the synthetic spectra
+NIR_PIX = 564
+OPT_PIX = 1600
+
+# Share of objects of each gravity ('f' field, 'g' gamma, 'b' beta)
+GRAV_SHARES = {'f':0.8, 'g':0.12, 'b':0.08}
+GRAV_SUFFIXES = {'f':'', 'g':u'γ', 'b':u'β'}
+
+# Share of objects of each template that are keepers
+KEEP_SHARE = 0.8
+
+# Number of objects written per block (bounds memory use for large projects)
+BLOCK_SIZE = 5000
+
+# First Ref number of the synthetic objects
+FIRST_REF = 10001
+
+
+def make_project(folder, numObjs=100, seed=0, nirPix=NIR_PIX, optPix=OPT_PIX):
+    # Writes a synthetic project with numObjs objects in folder (created if
+    # needed). Returns a dictionary with the folders to give to
+    # nir_opt_comp_strip.DataSession ('folderRoot' and 'folderIn'), the number
+    # of objects ('numObjs'), and the number of spectra written ('numSpecs').
+    import nir_opt_comp_strip as nocs
+    import screening
+    
+    folderRoot = os.path.join(folder, 'more data', '')
+    folderIn = os.path.join(folder, 'data', '')
+    for subFolder in [folderIn, folderRoot + 'NIR', folderRoot + 'OPT']:
+        if not os.path.exists(subFolder):
+            os.makedirs(subFolder)
+    
+    rng = np.random.default_rng(seed)
+    
+    # 1. DRAW THE PROPERTIES OF ALL OBJECTS ------------------------------------
+    spTypeNums = rng.integers(0, len(dc.SPTYPES), numObjs)
+    gravKeys = sorted(GRAV_SHARES.keys())
+    gravs = rng.choice(gravKeys, numObjs, p=[GRAV_SHARES[key] for key in gravKeys])
+    # The first object of each spectral type is a field object (its standard)
+    firsts = {}
+    for objIdx, spTypeNum in enumerate(spTypeNums):
+        if spTypeNum not in firsts:
+            firsts[spTypeNum] = objIdx
+            gravs[objIdx] = 'f'
+    
+    refs = FIRST_REF + np.arange(numObjs)
+    nirFiles = ['N%i.fits' % ref for ref in refs]
+    optFiles = ['O%i.fits' % ref for ref in refs]
+    
+    # 2. WRITE THE FITS FILES --------------------------------------------------
+    nirWls = np.linspace(0.65, 2.55, nirPix)
+    optWls = 6000. + np.arange(optPix) * (4000. / optPix)
+    nirHeader = __fits_header((3, nirPix), CTYPE1='LINEAR', RES=120)
+    optHeader = __fits_header((optPix,), CTYPE1='LINEAR', CRVAL1=6000., \
+                              CDELT1=4000. / optPix)
+    
+    jMags = np.zeros(numObjs)
+    for blockStart in range(0, numObjs, BLOCK_SIZE):
+        block = slice(blockStart, min(blockStart + BLOCK_SIZE, numObjs))
+        nirSpecs, optFluxes, blockJ = __spectra(rng, spTypeNums[block], \
+                                      gravs[block], nirWls, optWls / 1.e4)
+        jMags[block] = blockJ
+        for posIdx, objIdx in enumerate(range(block.start, block.stop)):
+            __write_fits(folderRoot + 'NIR/' + nirFiles[objIdx], nirHeader, nirSpecs[posIdx])
+            __write_fits(folderRoot + 'OPT/' + optFiles[objIdx], optHeader, optFluxes[posIdx])
+    
+    # 3. WRITE THE CATALOGS ----------------------------------------------------
+    colors = 1.2 + 0.1 * spTypeNums + rng.normal(0, 0.1, numObjs) \
+             + np.where(gravs == 'f', 0., 0.3)
+    lines = ['\t'.join(nocs.HDR_FILE_IN) + '\n']
+    for objIdx in range(numObjs):
+        spTypeTxt = dc.SPTYPES[spTypeNums[objIdx]] + GRAV_SUFFIXES[gravs[objIdx]]
+        young = 'No' if gravs[objIdx] == 'f' else 'Yes'
+        row = [str(refs[objIdx]), __designation(rng), '%.3f' % jMags[objIdx], \
+               '%.3f' % (jMags[objIdx] - colors[objIdx] / 2), \
+               '%.3f' % (jMags[objIdx] - colors[objIdx]), \
+               str(dc.SPTYPESN[spTypeNums[objIdx]]), spTypeTxt, 'Nov-07', 'IRTF', \
+               nirFiles[objIdx], 'Oct-09', 'Keck I', 'LRIS', optFiles[objIdx], \
+               young, 'No', 'No', 'No', 'No']
+        lines.append('\t'.join(row) + '\n')
+    with open(folderIn + nocs.FILE_IN, 'w', encoding='utf-8') as catFile:
+        catFile.writelines(lines)
+    
+    lines = ['# Ref\tDesignation\tNIR SpT\tOPT SpT\n']
+    for spTypeNum in sorted(firsts):
+        spType = dc.SPTYPES[spTypeNum]
+        lines.append('%i\tstd%i\t%s\t%s\n' % (refs[firsts[spTypeNum]], spTypeNum, \
+                                              spType, spType))
+    with open(folderIn + nocs.FILE_IN_STD, 'w') as stdFile:
+        stdFile.writelines(lines)
+    
+    # 4. WRITE THE KEEPERS & REJECTS FILES -------------------------------------
+    for spTypeNum in sorted(firsts):
+        spType = dc.SPTYPES[spTypeNum]
+        for grav in gravKeys:
+            rows = np.where((spTypeNums == spTypeNum) & (gravs == grav))[0]
+            if len(rows) == 0:
+                continue
+            chi2 = rng.gamma(2., 0.5, (len(rows), len(screening.CHI2_KEYS)))
+            keep = rng.random(len(rows)) < KEEP_SHARE
+            chi2[keep,:len(dc.BANDS)] = np.minimum(chi2[keep,:len(dc.BANDS)], 1.)
+            chi2[~keep,0] = chi2[~keep,0] + 3.
+            result = dict(names=[nirFiles[rowIdx] for rowIdx in rows], chi2=chi2, keep=keep)
+            sigma = screening.SIGMAS.get(spType, screening.SIGMA)
+            screening.write_manifests(folderIn, spType, grav, sigma, result)
+    
+    return dict(folderRoot=folderRoot, folderIn=folderIn, numObjs=numObjs, \
+                numSpecs=2 * numObjs)
+
+
+def __designation(rng):
+# Function used by make_project only
+# Returns a random designation (e.g. "00 10 00.1 -20 31 12").
+    raSecs = rng.uniform(0, 86400)
+    decSecs = rng.uniform(-89 * 3600, 89 * 3600)
+    sign = '+' if decSecs >= 0 else '-'
+    decSecs = abs(decSecs)
+    return '%02i %02i %04.1f %s%02i %02i %02i' % (raSecs // 3600, raSecs % 3600 // 60, \
+           raSecs % 60, sign, decSecs // 3600, decSecs % 3600 // 60, decSecs % 60)
+
+
+def __fits_header(shape, **keywords):
+# Function used by make_project only
+# Returns the header (as bytes) of a fits file with float32 data of the given
+# shape and the given keywords.
+    import astropy.io.fits as pf
+    
+    hdu = pf.PrimaryHDU(np.zeros(shape, dtype=np.float32))
+    for keyword in keywords:
+        hdu.header[keyword] = keywords[keyword]
+    return hdu.header.tostring().encode('ascii')
+
+
+def __spectra(rng, spTypeNums, gravs, nirWls, optWls):
+# Function used by make_project only
+# Returns the NIR spectra (objects x 3 x points), optical fluxes (objects x
+# points), and J magnitudes of a block of objects.
+    numObjs = len(spTypeNums)
+    teffs = 2300. - 110. * spTypeNums
+    depths = 0.3 + 0.05 * spTypeNums
+    slopes = np.where(gravs == 'f', 0., 0.3)
+    
+    def model(wls):
+        wls = wls[None,:]
+        planck = 1. / (wls ** 5 * (np.exp(14388. / (wls * teffs[:,None])) - 1.))
+        planck = planck / planck.max(axis=1)[:,None]
+        water = 1. - depths[:,None] * (np.exp(-((wls - 1.40) / 0.06) ** 2) \
+                + np.exp(-((wls - 1.88) / 0.08) ** 2) \
+                + 0.5 * np.exp(-((wls - 1.15) / 0.03) ** 2))
+        return planck * water * (wls / 1.25) ** slopes[:,None]
+    
+    # NIR spectra: signal-to-noise between 30 and 150
+    nirFlux = model(nirWls)
+    snrs = rng.uniform(30., 150., numObjs)
+    sigmas = nirFlux.max(axis=1)[:,None] / snrs[:,None] \
+             * rng.uniform(0.5, 1.5, nirFlux.shape)
+    nirSpecs = np.empty((numObjs, 3, len(nirWls)))
+    nirSpecs[:,0] = nirWls
+    nirSpecs[:,1] = nirFlux + sigmas * rng.standard_normal(nirFlux.shape)
+    nirSpecs[:,2] = sigmas
+    
+    # Optical spectra: TiO-like band heads on top of the same blackbodies
+    optFlux = model(optWls) * (1. - 0.3 * (optWls[None,:] > 0.71) * (optWls[None,:] < 0.74))
+    optFlux = optFlux + optFlux.max(axis=1)[:,None] / 50. * rng.standard_normal(optFlux.shape)
+    
+    jMags = rng.uniform(11., 16., numObjs)
+    return nirSpecs, optFlux, jMags
+
+
+def __write_fits(fileName, header, values):
+# Function used by make_project only
+# Writes a fits file with the header given (as bytes) and the data as float32.
+# (Faster than astropy for many small files with the same header.)
+    dataBytes = np.asarray(values, dtype='>f4').tobytes()
+    padding = b'\0' * (-len(dataBytes) % 2880)
+    with open(fileName, 'wb') as fitsFile:
+        fitsFile.write(header + dataBytes + padding)
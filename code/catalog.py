@@ -0,0 +1,321 @@
+'''
+The module catalog reads the objects catalog used by nir_opt_comp.py, nir_opt_comp_nir.py and nir_opt_comp_strip.py, and keeps it indexed so that targets are selected with dictionary lookups.
+
+NEEDED: 1) FILE_IN: ASCII tab-delimited txt file with data for each object
+           (Access query is "nir_spex_prism_with_optical")
+           (columns are in HDR_FILE_IN).
+        2) Keepers & rejects files (e.g. comp_L0g_s2.0_band_keepers.txt), with the
+           NIR file names (without .fits) and J, H, K reduced chi2 of the objects
+           used for (or rejected from) each template; read by load_manifests.
+
+The catalog is parsed only once per process (see load_catalog). The parsed columns and indexes are also kept in a binary file next to FILE_IN, which is used instead of parsing FILE_IN again until FILE_IN is modified.
+'''
+
+import os
+import pickle
+
+import numpy as np
+
+FILE_IN = 'nir_spex_prism_with_optical.txt' # ASCII file w/ data
+
+# For TXT objects file (updatable here directly)
+HDR_FILE_IN = ('Ref','Designation`','J','H','K','SpType','SpType_T','NIRFobs',\
+               'NIRFtel','NIRfile','OPTobs','OPTtel','OPTinst','OPTfile',\
+               'Young?','Dusty?','Blue?','Binary?','Pec?')
+
+# Gravity suffixes in the Spectral Type-Text column (field objects have none)
+GRAV_CHARS = {u'γ':'g', u'β':'b'} # gamma, beta
+
+# Version of the binary cache; change it whenever its contents change
+CACHE_VERSION = 1
+
+# Catalogs and manifest registries already loaded in this process
+__LOADED = {}
+__LOADED_MANIFESTS = {}
+
+# Kinds of manifest files, and bands of their chi2 columns
+MANIFEST_KINDS = ('keepers', 'rejects')
+MANIFEST_BANDS = ('J', 'H', 'K')
+
+
+class Catalog(object):
+    '''
+    Objects catalog (FILE_IN) as typed numpy arrays, plus indexes to find objects.
+    
+    *data*
+      Dictionary with one numpy array per column (keys in HDR_FILE_IN), plus the J-K color (key 'J-K'). Designations are formatted as "XXXX+XXXX".
+    *spTypes*
+      Dictionary that maps every prefix of every (upper case) spectral type (e.g. 'L', 'L0', 'L0.', 'L0.5') to the array of rows whose spectral type starts with it.
+    *gravs*
+      Dictionary that maps gravity ('f' field, 'g' gamma, 'b' beta, 'lg' low = gamma or beta) to the array of rows with that gravity suffix.
+    *refs*
+      Dictionary that maps Ref (integer) to row.
+    *nirFiles*
+      Dictionary that maps NIR file name to row.
+    '''
+    
+    def __init__(self, data):
+        colNameRef     = HDR_FILE_IN[0]
+        colNameType    = HDR_FILE_IN[6]
+        colNameNIRfile = HDR_FILE_IN[9]
+        
+        self.data = data
+        
+        spTypes = {}
+        gravs = {'f':[], 'g':[], 'b':[]}
+        for rowIdx, spType in enumerate(data[colNameType]):
+            gravs[grav_suffix(str(spType))].append(rowIdx)
+            spType = str(spType).upper()
+            for prefixLen in range(1, len(spType) + 1):
+                spTypes.setdefault(spType[:prefixLen], []).append(rowIdx)
+        gravs['lg'] = sorted(gravs['g'] + gravs['b'])
+        
+        self.spTypes = {}
+        for prefix in spTypes:
+            self.spTypes[prefix] = np.array(spTypes[prefix], dtype=int)
+        self.gravs = {}
+        for grav in gravs:
+            self.gravs[grav] = np.array(gravs[grav], dtype=int)
+        
+        self.refs = {}
+        for rowIdx, ref in enumerate(data[colNameRef]):
+            self.refs[int(ref)] = rowIdx
+        self.nirFiles = {}
+        for rowIdx, fileName in enumerate(data[colNameNIRfile]):
+            self.nirFiles[str(fileName)] = rowIdx
+    
+    def __len__(self):
+        return len(self.data[HDR_FILE_IN[0]])
+    
+    def select(self, spType, grav=None):
+        # Returns the rows (in catalog order) of the objects whose spectral type
+        # starts with spType (case insensitive), optionally only those with the
+        # given gravity suffix.
+        rows = self.spTypes.get(spType.upper(), np.array([], dtype=int))
+        if grav is not None:
+            rows = np.intersect1d(rows, self.gravs.get(grav, []))
+        return rows
+
+
+class Manifest(object):
+    '''
+    Contents of one keepers or rejects file.
+    
+    *fileName*
+      Name of the file (without path).
+    *names*
+      List of NIR file names (with .fits), in file order.
+    *chi2*
+      Array with one row per object and the J, H, K reduced chi2 in its columns (nan if missing).
+    *positions*
+      Dictionary that maps NIR file name (with .fits) to its row.
+    '''
+    
+    def __init__(self, fileName, names, chi2):
+        self.fileName = fileName
+        self.names = names
+        self.chi2 = chi2
+        self.positions = {}
+        for nameIdx, name in enumerate(names):
+            self.positions[name] = nameIdx
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def __contains__(self, name):
+        return name in self.positions
+
+
+class ManifestRegistry(object):
+    '''
+    All keepers and rejects files of a folder, parsed once.
+    
+    *manifests*
+      Dictionary that maps (spectral type, gravity) (e.g. ('L0','g'); gravity 'f' for field) to a dictionary with the Manifest of each kind ('keepers' and 'rejects').
+    '''
+    
+    def __init__(self, manifests):
+        self.manifests = manifests
+    
+    def get(self, spType, grav, kind):
+        # Returns the Manifest of the given kind for a spectral type & gravity,
+        # or None if there is no such file.
+        return self.manifests.get((spType.upper(), grav), {}).get(kind)
+
+
+def grav_suffix(spType):
+    # Returns the gravity of a spectral type according to its suffix:
+    # 'g' (gamma), 'b' (beta), or 'f' (field, no suffix).
+    for gravChar in GRAV_CHARS:
+        if gravChar in spType:
+            return GRAV_CHARS[gravChar]
+    return 'f'
+
+
+def load_catalog(folderIn, fileName=FILE_IN, cache=True):
+    # Returns the Catalog of folderIn + fileName. It is parsed only the first
+    # time in a process; if cache=True, the binary cache is used as long as
+    # the catalog file has not been modified since the cache was written.
+    fullName = folderIn + fileName
+    fileStat = os.stat(fullName)
+    stamp = (CACHE_VERSION, fileStat.st_mtime, fileStat.st_size, HDR_FILE_IN)
+    
+    if fullName in __LOADED and __LOADED[fullName][0] == stamp:
+        return __LOADED[fullName][1]
+    
+    cacheName = os.path.join(os.path.dirname(fullName), '.' + fileName + '.cache')
+    catalog = None
+    if cache and os.path.exists(cacheName):
+        try:
+            with open(cacheName, 'rb') as cacheFile:
+                cacheStamp, catalog = pickle.load(cacheFile)
+            if cacheStamp != stamp:
+                catalog = None
+        except Exception:
+            catalog = None
+    
+    if catalog is None:
+        catalog = Catalog(read_table(fullName))
+        if cache:
+            __save_cache(cacheName, stamp, catalog)
+    
+    __LOADED[fullName] = (stamp, catalog)
+    return catalog
+
+
+def load_manifests(folderIn):
+    # Returns the ManifestRegistry of the keepers & rejects files in folderIn.
+    # The files are parsed only the first time in a process and whenever any
+    # of them changes (added, removed, replaced or edited in place), as told
+    # by the name, size and modification time of each one.
+    fileKeys = {}
+    folderStamp = []
+    for fileName in sorted(os.listdir(folderIn)):
+        fileKey = manifest_key(fileName)
+        if fileKey is None: continue
+        fileStat = os.stat(folderIn + fileName)
+        fileKeys[fileName] = fileKey
+        folderStamp.append((fileName, fileStat.st_size, fileStat.st_mtime_ns))
+    folderStamp = tuple(folderStamp)
+    if folderIn in __LOADED_MANIFESTS and __LOADED_MANIFESTS[folderIn][0] == folderStamp:
+        return __LOADED_MANIFESTS[folderIn][1]
+    
+    manifests = {}
+    for fileName in sorted(fileKeys):
+        spType, grav, kind = fileKeys[fileName]
+        
+        # If more than one file for the same template, keep the first one
+        fileKinds = manifests.setdefault((spType, grav), {})
+        if kind in fileKinds: continue
+        fileKinds[kind] = read_manifest(folderIn, fileName)
+    
+    registry = ManifestRegistry(manifests)
+    __LOADED_MANIFESTS[folderIn] = (folderStamp, registry)
+    return registry
+
+
+def manifest_key(fileName):
+    # Returns (spectral type, gravity, kind) of a keepers or rejects file name
+    # (e.g. comp_L0g_s2.0_band_keepers.txt -> ('L0', 'g', 'keepers')), or None
+    # if it is not one.
+    if not fileName.startswith('comp_') or not fileName.endswith('.txt'):
+        return None
+    kind = fileName[:-4].split('_')[-1]
+    if kind not in MANIFEST_KINDS:
+        return None
+    
+    tmpfl = fileName.split('_')
+    if len(tmpfl[1]) == 2:
+        return tmpfl[1].upper(), 'f', kind
+    elif len(tmpfl[1]) == 3:
+        return tmpfl[1][:2].upper(), tmpfl[1][-1], kind
+    return None
+
+
+def read_manifest(folderIn, fileName):
+    # Parses a keepers or rejects file. Returns its Manifest.
+    names = []
+    chi2 = []
+    with open(folderIn + fileName) as manFile:
+        for line in manFile:
+            if line.startswith('#') or line.strip() == '': continue
+            cols = line.rstrip('\n').split('\t')
+            names.append(cols[0].strip() + '.fits')
+            
+            chi2Vals = [np.nan] * len(MANIFEST_BANDS)
+            for bandIdx in range(len(MANIFEST_BANDS)):
+                try:
+                    chi2Vals[bandIdx] = float(cols[bandIdx + 1].split()[0])
+                except (IndexError, ValueError):
+                    pass
+            chi2.append(chi2Vals)
+    
+    chi2 = np.array(chi2, dtype=float).reshape(-1, len(MANIFEST_BANDS))
+    return Manifest(fileName, names, chi2)
+
+
+def read_table(fullName):
+    # Parses the objects catalog. Returns a dictionary with one numpy array per
+    # column, with the J-K color and designations formatted as "XXXX+XXXX".
+    from astropy.io import ascii
+    
+    colNameDesig = HDR_FILE_IN[1]
+    colNameJ     = HDR_FILE_IN[2]
+    colNameK     = HDR_FILE_IN[4]
+    colNameJK    = 'J-K'
+    colNameType  = HDR_FILE_IN[6]
+    
+    # 1) READ DATA FROM MAIN INPUT FILE ----------------------------------------
+    DELL_CHAR = '\t' # Delimiter character
+    COMM_CHAR = '#'  # Comment character
+    
+    # File with ALL objects (source: query in Access)
+    dataRaw = ascii.read(fullName, format='no_header', \
+                         delimiter=DELL_CHAR, comment=COMM_CHAR, data_start=1)
+    
+    # Store data in a dictionary-type object
+    data = {}.fromkeys(HDR_FILE_IN)
+    for colIdx,colname in enumerate(dataRaw.colnames):
+        data[HDR_FILE_IN[colIdx]] = np.array(dataRaw[colname])
+    
+    # 2) FORMAT SOME ASCII COLUMNS ---------------------------------------------
+    # 2.1 Convert into unicode the Spectral Type-Text column
+    data[colNameType] = np.array([str(sType) for sType in data[colNameType]])
+    
+    # 2.2 Calculate J-K Color
+    data[colNameJK] = data[colNameJ] - data[colNameK]
+    
+    # 2.3 Format Designation Number from Designation Column
+    #     (From "XX XX XX.X +XX XX XX.X" to "XXXX+XXXX")
+    for desigIdx,desig in enumerate(data[colNameDesig]):
+        desig    = ''.join(desig.split())
+        signType = '+'
+        signPos  = desig.find(signType)
+        if signPos == -1:
+            signType = '-'
+            signPos  = desig.find(signType)
+        
+        desigProper = desig[:4] + signType + desig[signPos+1:signPos+5]
+        data[colNameDesig][desigIdx] = desigProper
+    
+    return data
+
+
+def __save_cache(cacheName, stamp, catalog):
+# Function used by load_catalog only
+# Writes the binary cache of a catalog (to a temporary file first, so that
+# readers never find a partial cache). Failing to write it is not an error.
+    import tempfile
+    
+    try:
+        tmpHandle, tmpName = tempfile.mkstemp(dir=os.path.dirname(cacheName), \
+                                              suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with os.fdopen(tmpHandle, 'wb') as tmpFile:
+            pickle.dump((stamp, catalog), tmpFile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpName, cacheName)
+    except (IOError, OSError, pickle.PickleError):
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
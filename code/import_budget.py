@@ -0,0 +1,83 @@
+''' This checks that the compute-only modules (astrotools, catalog, nir_opt_comp_strip) import quickly and without loading matplotlib, so that template builds (make_templ.py) and batch workers (make_strips.py, screening.py) start fast.
+
+Each module is imported in a new Python process, so that nothing imported before counts. The import time is the best of a few tries.
+
+INPUT:  1) modules: Python list of module names to check (COMPUTE_MODULES by default).
+        2) budget: Float, maximum import time in seconds (astrotools.IMPORT_BUDGET
+           by default).
+        3) tries: Integer, number of times each module is imported.
+
+OUTPUT: 1) Dictionary that maps module name to a dictionary with its import time
+           in seconds ('time'), the heavy modules it loaded ('loaded'), and whether
+           it passed the check ('ok').
+        2) A line per module printed on screen.
+
+Run it from the command line as: python import_budget.py
+(it exits with status 1 if any module fails the check)
+'''
+
+import json
+import subprocess
+import sys
+
+COMPUTE_MODULES = ['astrotools', 'catalog', 'nir_opt_comp_strip']
+
+# Modules that must not be loaded by importing the compute-only modules
+HEAVY_MODULES = ['matplotlib', 'scipy', 'astropy']
+
+# Code run in the new process: imports the module and reports time & modules
+PROBE = '''
+import json, sys, time
+sys.path.insert(0, %r)
+startTime = time.perf_counter()
+import %s
+endTime = time.perf_counter()
+heavy = sorted(set([name.split('.')[0] for name in sys.modules]) & set(%r))
+print(json.dumps([endTime - startTime, heavy]))
+'''
+
+
+def measure(module, tries=3):
+    # Imports a module in new Python processes. Returns the best import time
+    # (in seconds) and the list of heavy modules it loaded.
+    import os
+    
+    folder = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    loaded = []
+    for tryIdx in range(tries):
+        probe = PROBE % (folder, module, HEAVY_MODULES)
+        output = subprocess.check_output([sys.executable, '-c', probe], cwd=folder)
+        impTime, loaded = json.loads(output.decode().strip().split('\n')[-1])
+        times.append(impTime)
+    
+    return min(times), loaded
+
+
+def main(modules=COMPUTE_MODULES, budget=None, tries=3):
+    
+    # 1. SET UP VARIABLES -----------------------------------------------------
+    if budget is None:
+        import astrotools as at
+        budget = at.IMPORT_BUDGET
+    
+    # 2. MEASURE EACH MODULE --------------------------------------------------
+    results = {}
+    for module in modules:
+        impTime, loaded = measure(module, tries)
+        results[module] = dict(time=impTime, loaded=loaded, \
+                               ok=(impTime <= budget and len(loaded) == 0))
+        
+        status = 'OK  ' if results[module]['ok'] else 'FAIL'
+        txt = '%s %-20s %.3f s (budget %.3f s)' % (status, module, impTime, budget)
+        if len(loaded) > 0:
+            txt = txt + '; loaded ' + ', '.join(loaded)
+        print(txt)
+    
+    return results
+
+
+if __name__ == '__main__':
+    results = main()
+    if not all([results[module]['ok'] for module in results]):
+        sys.exit(1)
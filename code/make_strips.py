@@ -0,0 +1,100 @@
+''' This generates the strip figures of all spectral types and gravities (e.g. L0strip_g.pdf and L0strip_g_excluded.pdf), using nir_opt_comp_strip.main.
+
+The catalogs and spectra are read only once, before the figures are made, and are shared by all workers. Each worker makes one figure at a time using the non-interactive Agg backend of matplotlib. PDF files carry no creation date, so the same data always give the same files.
+
+INPUT:  1) workers: Integer, number of processes making figures simultaneously,
+           and of fits files read simultaneously when a new session is created;
+           if None, figures are made (and files read) one after the other.
+        2) spTypes: Python list of spectral types (all in SPTYPES by default).
+        3) gravs: Python list of gravities (f, g, b by default).
+        4) folderOut: String, folder where to save the PDF files.
+        5) session: nir_opt_comp_strip.DataSession object; if None, a new one
+           is created and all spectra are read into it.
+
+OUTPUT: 1) Python list with the names of the figures made.
+        2) PDF files in folderOut.
+
+Run it from the command line as: python make_strips.py [number of workers]
+'''
+
+import os
+
+import def_constants as dc
+
+GRAVS = ['f','g','b']
+
+# Session used by the figures made in each process
+__session = None
+
+
+def render(spType, grav, excluded, folderOut):
+    # Makes one strip figure. Returns the name of the figure, or None if there
+    # was nothing to plot.
+    import matplotlib
+    matplotlib.use('Agg')
+    import nir_opt_comp_strip as nocs
+    
+    figName = spType.upper() + 'strip_' + grav + ('_excluded' if excluded else '') + '.pdf'
+    if os.path.exists(folderOut + figName):
+        os.remove(folderOut + figName)
+    nocs.main(spType, grav, plot=True, excluded=excluded, session=__session, \
+              folderOut=folderOut)
+    
+    if os.path.exists(folderOut + figName):
+        return figName
+    return None
+
+
+def main(workers=None, spTypes=dc.SPTYPES, gravs=GRAVS, folderOut=dc.FOLDER_OUT_PLT, session=None):
+    
+    # 1. LOAD RELEVANT MODULES ------------------------------------------------
+    import matplotlib
+    matplotlib.use('Agg')
+    import nir_opt_comp_strip as nocs
+    
+    # 2. READ CATALOGS AND ALL SPECTRA ONCE -----------------------------------
+    if session is None:
+        session = nocs.DataSession(preload=True, workers=workers)
+    
+    # 3. LIST FIGURES TO MAKE -------------------------------------------------
+    figures = []
+    for spType in spTypes:
+        for grav in gravs:
+            for excluded in [False, True]:
+                figures.append((spType, grav, excluded, folderOut))
+    
+    # 4. MAKE FIGURES (simultaneously if requested) ---------------------------
+    if workers is None or workers <= 1:
+        __init_worker(session)
+        figNames = [render(*figure) for figure in figures]
+    else:
+        import concurrent.futures as cf
+        import multiprocessing as mp
+        
+        # Forked workers share the spectra already in memory; otherwise the
+        # session is sent once to each worker
+        if 'fork' in mp.get_all_start_methods():
+            context = mp.get_context('fork')
+        else:
+            context = mp.get_context()
+        with cf.ProcessPoolExecutor(max_workers=workers, mp_context=context, \
+                                    initializer=__init_worker, \
+                                    initargs=(session,)) as executor:
+            futures = [executor.submit(render, *figure) for figure in figures]
+            figNames = [future.result() for future in futures]
+    
+    return [figName for figName in figNames if figName is not None]
+
+
+def __init_worker(session):
+# Function used by main only
+# Keeps the session to be used by all figures made in a process.
+    global __session
+    __session = session
+
+
+if __name__ == '__main__':
+    import sys
+    numWorkers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    figNames = main(workers=numWorkers)
+    print('Made %i figures: %s' % (len(figNames), ', '.join(figNames)))
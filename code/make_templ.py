@@ -1,23 +1,177 @@
-''' This generates separate ascii files for all templates, by band (J, H, and K). The files contain five columns: wavelength, average flux, standard deviation, min flux, max flux.'''
+''' This generates separate ascii files for all templates, by band (J, H, and K). The files contain five columns: wavelength, average flux, standard deviation, min flux, max flux.
+
+Templates are only rebuilt when their inputs change: the fits files of their member spectra, the keepers & rejects files of their spectral type and gravity, and the band and normalization limits. A fingerprint of the inputs of each template is kept in FINGERPRINTS_FILE (in FOLDER_OUT_TMPL); run with --force to rebuild all templates anyway.
+
+The sufficient statistics of the templates built are kept in templ_update.STATS_FILE (in FOLDER_OUT_TMPL), so that templ_update.py can later add or remove single objects without rebuilding the templates.
+
+Run with --profile to record the time and memory used by each stage of nir_opt_comp_strip.main and by the astrotools functions it calls, added up over all templates (see profiling.py); the records are written into PROFILE_FILE (in FOLDER_OUT_TMPL) and next to it in folded stacks format (for flame graphs).
+
+Run with --diagnostics to also get leave-one-out diagnostics of the templates built (see nir_opt_comp_strip.template_diagnostics): the reduced chi2 of each member against the template without it, how much it shifts the template, and the jackknife variance of the template. They are written into DIAGNOSTICS_FILE (in FOLDER_OUT_TMPL), and the member with the highest chi2 of each template is printed on screen.
+
+Run with --workers N to read N fits files simultaneously (as many as CPUs by default; --workers 1 reads them one after the other).'''
+
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
 
 import nir_opt_comp_strip as nocs
 import astrotools as at
+import catalog
+import profiling
+import templ_update
 
 with open("def_constants.py") as f:
     code = compile(f.read(), "def_constants.py", "exec")
     exec(code)
 GRAVS = ['f','g','b']
 
+FINGERPRINTS_FILE = 'templates_fingerprints.json'
+PROFILE_FILE = 'templates_profile.json'
+DIAGNOSTICS_FILE = 'templates_diagnostics.npz'
+# Diagnostics written for each template
+DIAGNOSTICS_KEYS = ['names', 'chi2', 'shift', 'wave', 'jackVar', 'renormFacs']
+# Change this whenever the way templates are calculated changes
+FINGERPRINT_VERSION = 1
+
+
+def fingerprint(sptp, grav, band, session):
+    # Returns a hash of all inputs of the template of a spectral type, gravity
+    # and band: band & normalization limits, keepers & rejects files, and name,
+    # size and modification time of the OPT and NIR fits files of the objects
+    # in the keepers file.
+    hashObj = hashlib.sha1()
+    hashObj.update(json.dumps([FINGERPRINT_VERSION, sptp, grav, band, \
+                               nocs.BAND_LIMS[band]]).encode())
+    
+    manifests = catalog.load_manifests(session.folderIn)
+    for kind in catalog.MANIFEST_KINDS:
+        manifest = manifests.get(sptp, grav, kind)
+        if manifest is None:
+            hashObj.update(kind.encode() + b':none')
+            continue
+        with open(session.folderIn + manifest.fileName, 'rb') as manFile:
+            hashObj.update(manifest.fileName.encode() + manFile.read())
+    
+    keepers = manifests.get(sptp, grav, 'keepers')
+    for rowIdx in session.catalog.select(sptp):
+        if keepers is None or session.data['NIRfile'][rowIdx] not in keepers:
+            continue
+        for key in nocs.OPTNIR_KEYS:
+            fileName = session.data[key + 'file'][rowIdx]
+            fullName = session.folderRoot + key + '/' + fileName
+            try:
+                fileStat = os.stat(fullName)
+                fileInfo = '%s:%i:%i' % (fullName, fileStat.st_size, fileStat.st_mtime_ns)
+            except OSError:
+                fileInfo = fullName + ':missing'
+            hashObj.update(fileInfo.encode())
+    
+    return hashObj.hexdigest()
+
+
+# Fingerprints of the templates built before
+force = '--force' in sys.argv[1:]
+diagnose = '--diagnostics' in sys.argv[1:]
+if '--profile' in sys.argv[1:]:
+    profiling.start()
+workers = os.cpu_count()
+if '--workers' in sys.argv[1:]:
+    try:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    except (IndexError, ValueError):
+        print('--workers must be followed by the number of fits files to read simultaneously.')
+        sys.exit(1)
+fpName = FOLDER_OUT_TMPL + FINGERPRINTS_FILE
+oldPrints = {}
+if os.path.exists(fpName) and not force:
+    with open(fpName) as fpFile:
+        oldPrints = json.load(fpFile)
+
+# Read catalogs once for all templates (and each spectrum only the first time
+# it is needed)
+profiling.stage('read catalogs')
+session = nocs.DataSession(workers=workers)
+
+profiling.stage('build templates')
+templates = {}
+stats = {}
+diagnostics = {}
+newPrints = {}
+skipped = []
 for sptp in SPTYPES:
     print(sptp)
     for grav in GRAVS:
-        templ = nocs.main(sptp, grav, templ=True, plot=False)
+        # Find the templates whose inputs changed
+        toBuild = []
+        for band in BANDS:
+            templName = sptp + band + '_' + grav
+            newPrints[templName] = fingerprint(sptp, grav, band, session)
+            built = os.path.exists(FOLDER_OUT_TMPL + templName + '.txt')
+            if oldPrints.get(templName) == newPrints[templName] and built:
+                skipped.append(templName)
+            else:
+                toBuild.append(band)
+        if len(toBuild) == 0:
+            continue
+        
+        templ = nocs.main(sptp, grav, templ=True, plot=False, session=session, \
+                          diagnose=diagnose)
         if templ is None:
             continue
         
         print(' ' + grav)
         for bdidx, band in enumerate(templ):
-            # Create template spectrum file
+            if BANDS[bdidx] not in toBuild:
+                continue
+            # Gather template spectrum to save it later with all the others
             # columns are: wavelength, mean flux, standard deviation, min flux, max flux
-            at.create_ascii(band, FOLDER_OUT_TMPL + sptp + BANDS[bdidx] + '_' + grav)
+            templates[sptp + BANDS[bdidx] + '_' + grav] = band
+            # Keep the statistics of the template members (see templ_update.py)
+            if band is not None:
+                names, specs = session.members[BANDS[bdidx]]
+                stats[sptp + BANDS[bdidx] + '_' + grav] = templ_update.TemplateStats(specs, names)
+            if BANDS[bdidx] in session.diagnostics:
+                diagnostics[sptp + BANDS[bdidx] + '_' + grav] = session.diagnostics[BANDS[bdidx]]
+
+# Create the template spectrum files that changed
+profiling.stage('save templates')
+templArrays = at.save_templ(templates, FOLDER_OUT_TMPL)
+
+# Update the .npz file holding all templates (keeping the unchanged ones), and
+# the statistics of the templates built
+templ_update.save_container(templArrays, FOLDER_OUT_TMPL)
+if len(stats) > 0 or not os.path.exists(FOLDER_OUT_TMPL + templ_update.STATS_FILE):
+    templ_update.save_stats(stats, FOLDER_OUT_TMPL)
+
+# Save the diagnostics of the templates built
+if diagnose:
+    diagArrays = {}
+    for templName in sorted(diagnostics):
+        diag = diagnostics[templName]
+        for key in DIAGNOSTICS_KEYS:
+            if diag[key] is not None:
+                diagArrays[templName + '/' + key] = np.asarray(diag[key])
+        chi2 = np.where(np.isfinite(diag['chi2']), diag['chi2'], -np.inf)
+        if len(chi2) > 0 and np.isfinite(chi2.max()):
+            worstIdx = chi2.argmax()
+            print('%s: highest chi2 %.3f (%s), shift %.3g' % (templName, chi2[worstIdx], \
+                  diag['names'][worstIdx], diag['shift'][worstIdx]))
+    np.savez(FOLDER_OUT_TMPL + DIAGNOSTICS_FILE, **diagArrays)
+
+# Keep fingerprints of the templates built (or found up to date)
+for templName in list(newPrints.keys()):
+    if templName not in templArrays and templName not in skipped:
+        del newPrints[templName]
+with open(fpName, 'w') as fpFile:
+    json.dump(newPrints, fpFile, indent=1, sort_keys=True)
+
+print('Built %i templates: %s' % (len(templArrays), ', '.join(sorted(templArrays))))
+print('Skipped %i unchanged templates: %s' % (len(skipped), ', '.join(skipped)))
 
+profiler = profiling.stop()
+if profiler is not None:
+    profiler.write(FOLDER_OUT_TMPL + PROFILE_FILE)
+    print(profiler.summary())
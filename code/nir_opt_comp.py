@@ -507,6 +507,7 @@ def main(spInput, grav='', plot=True, templ=False, std=False, lbl=False, normali
     import pdb
     import matplotlib.pyplot as plt
     from astropy.io import ascii
+    import catalog
     
     # 2. SET UP VARIABLES -----------------------------------------------------
     # Customizable variables <><><><><><><><><><><><><><><><><><><><><><><><><><><>
@@ -579,17 +580,10 @@ def main(spInput, grav='', plot=True, templ=False, std=False, lbl=False, normali
     
     
     # 3. READ DATA FROM INPUT FILES -------------------------------------------
-    DELL_CHAR = '\t' # Delimiter character
-    COMM_CHAR = '#'  # Comment character
-    
-    # File with objects (source: query in Access)
-    dataRaw = ascii.read(FOLDER_IN + FILE_IN, format='no_header', \
-                         delimiter=DELL_CHAR, comment=COMM_CHAR, data_start=1)
-    
-    # Store data in a dictionary-type object
-    data = {}.fromkeys(HDR_FILE_IN)
-    for colIdx,colname in enumerate(dataRaw.colnames):
-        data[HDR_FILE_IN[colIdx]] = np.array(dataRaw[colname])
+    # File with objects (source: query in Access), parsed once and indexed
+    # (step 4, formatting of some columns, is done by the catalog module)
+    objCatalog = catalog.load_catalog(FOLDER_IN, FILE_IN)
+    data = objCatalog.data
     
     # File with standards (source: manually generated)
     dataRawS = ascii.read(FOLDER_IN + FILE_IN_STD, data_start=0)
@@ -600,38 +594,12 @@ def main(spInput, grav='', plot=True, templ=False, std=False, lbl=False, normali
         dataS[HDR_FILE_IN_STD[colIdx]] = np.array(dataRawS[colname])
     
     
-    # 4. FORMAT SOME ASCII COLUMNS --------------------------------------------
-    # 4.1 Convert into unicode the Spectral Type-Text column
-    uniSpType = [None] * len(data[colNameType])
-    for sIdx,sType in enumerate(data[colNameType]):
-        uniSpType[sIdx] = sType#.decode('utf-8')
-    data[colNameType] = np.array(uniSpType)
-    
-    # 4.2 Calculate J-K Color
-    data[colNameJK] = data[colNameJ] - data[colNameK]
-    
-    # 4.3 Format Designation Number in Designation Column
-    #     (From "XX XX XX.X +XX XX XX.X" to "XXXX+XXXX")
-    for desigIdx,desig in enumerate(data[colNameDesig]):
-        desig    = ''.join(desig.split())
-        signType = '+'
-        signPos  = desig.find(signType)
-        if signPos == -1:
-            signType = '-'
-            signPos  = desig.find(signType)
-        
-        desigProper = desig[:4] + signType + desig[signPos+1:signPos+5]
-        data[colNameDesig][desigIdx] = desigProper
-    
-    
     # 5. FILTER DATA BY USER INPUT IN spInput ---------------------------------
     uniqueSpec = False
     specIdx = []
     if spInput.upper().startswith('L'):
     # If input is a spectral type, then find all spectra of same spectral type
-        for spIdx,spType in enumerate(data[colNameType]):
-            if spType.upper().startswith(spInput.upper()):
-                specIdx.append(spIdx)
+        specIdx = list(objCatalog.select(spInput))
         if not specIdx:
             print('No targets found for given input.')
             if std is False:
@@ -639,9 +607,8 @@ def main(spInput, grav='', plot=True, templ=False, std=False, lbl=False, normali
         spTypeInput = spInput.upper()
     else:
     # If input is one single spectrum, then find it
-        for spIdx,spType in enumerate(data[colNameRef]):
-            if str(spType) == spInput.upper():
-                specIdx.append(spIdx)
+        if spInput.isdigit() and int(spInput) in objCatalog.refs:
+            specIdx.append(objCatalog.refs[int(spInput)])
         if not specIdx:
             print('Requested target not found.')
             if std is False:
@@ -660,10 +627,9 @@ def main(spInput, grav='', plot=True, templ=False, std=False, lbl=False, normali
     # (It may not be included in first filter because OPT SpT != NIR SpT)
     if not uniqueSpec:
         if dataS[colNameNIRS][stdIdx] != dataS[colNameOPTS][stdIdx]:
-            for spIdx,spRef in enumerate(data[colNameRef]):
-                if spRef == dataS[colNameRef][stdIdx][0]:
-                    if spIdx not in specIdx:
-                        specIdx.append(spIdx)
+            spIdx = objCatalog.refs.get(int(dataS[colNameRef][stdIdx][0]))
+            if spIdx is not None and spIdx not in specIdx:
+                specIdx.append(spIdx)
     
     # Sort relevant objects by JKmag value
     specIdx = np.array(specIdx)
@@ -446,6 +446,7 @@ def main(spInput, grav=''):
     # 1. LOAD RELEVANT MODULES ---------------------------------------------------------
     import astrotools as at
     from astropy.io import ascii
+    import catalog
     import matplotlib.pyplot as plt
     import numpy as np
     import sys
@@ -503,49 +504,15 @@ def main(spInput, grav=''):
     
     
     # 3. READ DATA FROM INPUT FILES ----------------------------------------------------
-    DELL_CHAR = '\t' # Delimiter character
-    COMM_CHAR = '#'  # Comment character
-    
-    # File with objects (source: query in Access)
-    dataRaw = ascii.read(FOLDER_IN + FILE_IN, format='no_header', \
-                         delimiter=DELL_CHAR, comment=COMM_CHAR, data_start=1)
-    
-    # Store data in a dictionary-type object
-    data = {}.fromkeys(HDR_FILE_IN)
-    for colIdx,colname in enumerate(dataRaw.colnames):
-        data[HDR_FILE_IN[colIdx]] = np.array(dataRaw[colname])
-    
-    
-    # 4. FORMAT SOME ASCII COLUMNS -----------------------------------------------------
-    # 4.1 Convert into unicode the Spectral Type-Text column
-    uniSpType = [None] * len(data[colNameType])
-    for sIdx,sType in enumerate(data[colNameType]):
-        uniSpType[sIdx] = sType#.decode('utf-8')
-    
-    data[colNameType] = np.array(uniSpType)
-    
-    # 4.2 Calculate J-K Color
-    data[colNameJK] = data[colNameJ] - data[colNameK]
-    
-    # 4.3 Format Designation Number from Designation Column
-    for desigIdx,desig in enumerate(data[colNameDesig]):
-        desig = ''.join(desig.split())
-        signType = '+'
-        signPos = desig.find(signType)
-        if signPos == -1:
-            signType = '-'
-            signPos  = desig.find(signType)
-        
-        desigProper = desig[:4] + signType + desig[signPos+1:signPos+5]
-        data[colNameDesig][desigIdx] = desigProper
+    # File with objects (source: query in Access), parsed once and indexed
+    # (step 4, formatting of some columns, is done by the catalog module)
+    objCatalog = catalog.load_catalog(FOLDER_IN, FILE_IN)
+    data = objCatalog.data
     
     
     # 5. FILTER DATA BY USER INPUT IN spInput ------------------------------------------
     # Find all spectra of same spectral type
-    specIdx = []
-    for spIdx,spType in enumerate(data[colNameType]):
-        if spType.upper().startswith(spInput.upper()):
-            specIdx.append(spIdx)
+    specIdx = list(objCatalog.select(spInput))
     
     if not specIdx:
         print('No target found for given input.')
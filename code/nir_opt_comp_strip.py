@@ -18,6 +18,12 @@ INPUT:  1) spInput: String, spectral type to select (e.g. L0).
         5) std: Boolean, whether to get the spectral type NIR standard spectrum
         6) excluded: Boolean, whether to overplot excluded objects
         7) normalize: Boolean, whether to normalize spectra or not. Used for standard spectrum really.
+        8) session: DataSession object with data already read from (1)-(3); if None,
+           data is read from disk (use one DataSession for many calls to main).
+        9) folderOut: String, folder where to save the PDF file (FOLDER_OUT by default).
+        10) diagnose: Boolean, whether to calculate leave-one-out diagnostics of the
+            templates (see template_diagnostics); they are kept by band, with the
+            NIR file names of the template members ('names'), in session.diagnostics.
 
         
 OUTPUT: 1) template (if templ=True) and NIR standard (if std=True)
@@ -25,6 +31,61 @@ OUTPUT: 1) template (if templ=True) and NIR standard (if std=True)
         2) (if plot=True) PDF file with four plots for selected spectral type.
 '''
 
+import profiling
+
+# Customizable variables <><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+FOLDER_ROOT = '/Users/alejo/Dropbox/Project_0/more data/'  # Location of NIR and OPT folders
+FOLDER_IN = '/Users/alejo/Dropbox/Project_0/data/' # Location of input files
+FOLDER_OUT = '/Users/alejo/Dropbox/Project_0/plots/' # Location to save output figures
+FILE_IN = 'nir_spex_prism_with_optical.txt' # ASCII file w/ data
+# <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+# For TXT objects file (updatable here directly)
+HDR_FILE_IN = ('Ref','Designation`','J','H','K','SpType','SpType_T','NIRFobs',\
+               'NIRFtel','NIRfile','OPTobs','OPTtel','OPTinst','OPTfile',\
+               'Young?','Dusty?','Blue?','Binary?','Pec?')
+
+# For TXT standards file
+FILE_IN_STD = 'NIR_Standards_K10.txt'   # ASCII file w/ standards
+HDR_FILE_IN_STD = ('Ref','Designation','NIR SpType','OPT SpType')
+
+OPTNIR_KEYS = ['OPT','NIR']
+
+BANDS_NAMES = ['K','H','J','OPT']
+
+# Refs of targets whose OPT spectrum is left out of the OPT template (they use the
+# same NIR fits file as both OPT and NIR spectrum, so their OPT spectrum is very bad)
+OPT_SKIP_REFS = ['50246','50061','50188']
+
+# Dictionary with bands limits and normalizing sections (used by main and
+# make_templ.py)
+BAND_LIMS = {}.fromkeys(BANDS_NAMES)
+for bandKey in BANDS_NAMES:
+    BAND_LIMS[bandKey] = dict(lim = [None] * 2, limN = [None] * 2)
+
+# Set wavelength limits for bands
+# Limits are in microns
+BAND_LIMS['OPT']['lim'][0] = 0.65
+BAND_LIMS['OPT']['lim'][1] = 0.90
+BAND_LIMS['J'  ]['lim'][0] = 0.8
+BAND_LIMS['J'  ]['lim'][1] = 1.4 
+BAND_LIMS['H'  ]['lim'][0] = 1.4
+BAND_LIMS['H'  ]['lim'][1] = 1.9
+BAND_LIMS['K'  ]['lim'][0] = 1.9
+BAND_LIMS['K'  ]['lim'][1] = 2.4
+
+# Set wl limits for normalizing sections
+# Limits are in microns
+BAND_LIMS['OPT']['limN'][0] = 0.66
+BAND_LIMS['OPT']['limN'][1] = 0.89
+BAND_LIMS['J'  ]['limN'][0] = 0.87
+BAND_LIMS['J'  ]['limN'][1] = 1.39
+BAND_LIMS['H'  ]['limN'][0] = 1.41
+BAND_LIMS['H'  ]['limN'][1] = 1.89
+BAND_LIMS['K'  ]['limN'][0] = 1.91
+BAND_LIMS['K'  ]['limN'][1] = 2.39
+
+
 def addannot(specData, subPlot, bandName, classType):
     # Adds annotations to indicate spectral absorption lines
     
@@ -172,26 +233,25 @@ def addannot(specData, subPlot, bandName, classType):
             # Initialize variables
             objsFluxIdxs = [np.nan] * len(specData)
             objsFluxAvgs = [np.nan] * len(specData)
-            xPos = np.zeros([len(specData),2])
-            xPos.fill(np.nan)
+            xPos = np.zeros([len(specData),2], dtype=int)
         
             # Find spectrum with the highest/lowest flux average @ absorption wls
             for objIdx, objSpec in enumerate(specData):
                 xLoRange = np.where(objSpec[0] <= annotation[1][0])
                 if len(xLoRange[0]) == 0:
-                    xPos[objIdx,0] = objSpec[0][0]
+                    xPos[objIdx,0] = 0
                 else:
                     xPos[objIdx,0] = xLoRange[0][-1]
                 
                 xHiRange = np.where(objSpec[0] >= annotation[1][1])
                 if len(xHiRange[0]) == 0:
-                    xPos[objIdx,1] = objSpec[0][-1]
+                    xPos[objIdx,1] = len(objSpec[0]) - 1
                 else:
                     xPos[objIdx,1] = xHiRange[0][0]
-                    
-                    # Set up limits of section with which to calculate average flux
-                    firstxPos = xPos[objIdx,0]
-                    lastxPos  = xPos[objIdx,1]
+                
+                # Set up limits of section with which to calculate average flux
+                firstxPos = xPos[objIdx,0]
+                lastxPos  = xPos[objIdx,1]
                 
                 objsFluxAvgs[objIdx] = nanmean(objSpec[1][firstxPos:lastxPos])
             
@@ -525,8 +585,9 @@ def plotspec(specData, bandNames, limits, objID, classType, grav=None, plotInstr
         # 4e) Fetch spectral strip --------------------------------------------
         # Pull wls, flux, min, max, and vars from template
         stripExists = True
-        templIdx = np.where(np.array(plotInstructions) == 'template')[0][0]
-        if templIdx.size != 0:
+        templIdxs = np.where(np.array(plotInstructions) == 'template')[0]
+        if templIdxs.size != 0:
+            templIdx = templIdxs[0]
             if specData[band][templIdx] is not None:
                 templWls = specData[band][templIdx][0]
                 templFlux = specData[band][templIdx][1]
@@ -681,37 +742,356 @@ def plotspec(specData, bandNames, limits, objID, classType, grav=None, plotInstr
     return fig
 
 
-def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, normalize=True):
-    # 1. LOAD RELEVANT MODULES ------------------------------------------------
+def read_catalogs(folderIn=FOLDER_IN):
+    # Reads the objects catalog (FILE_IN, through the catalog module) and the NIR
+    # standards catalog (FILE_IN_STD). Returns the Catalog of objects and a
+    # dictionary with one numpy array per column of the standards catalog.
+    
     from astropy.io import ascii
+    import numpy as np
+    import catalog
+    
+    # File with ALL objects (source: query in Access), parsed once and indexed
+    objCatalog = catalog.load_catalog(folderIn, FILE_IN)
+    
+    # File with standards (source: manually generated)
+    dataRawS = ascii.read(folderIn + FILE_IN_STD, data_start=0)
+    
+    # Store standard data in a dictionary-type object
+    dataS = {}.fromkeys(HDR_FILE_IN_STD)
+    for colIdx,colname in enumerate(dataRawS.colnames):
+        dataS[HDR_FILE_IN_STD[colIdx]] = np.array(dataRawS[colname])
+    
+    return objCatalog, dataS
+
+
+class DataSession(object):
+    '''
+    Holds the objects & standards catalogs and the spectra read from fits files, so that main() can be run many times (e.g. by make_templ.py) with only one pass of disk I/O. Spectra are read the first time they are requested and kept in memory afterwards.
+    
+    *folderRoot*
+      Folder containing the OPT and NIR folders with fits files.
+    *folderIn*
+      Folder containing FILE_IN and FILE_IN_STD.
+    *preload*
+      Boolean, whether to read right away the OPT and NIR spectra of all objects in the catalog.
+    *cache*
+      String with name of folder where astrotools.read_spec keeps decoded spectra between runs. If none given, fits files are decoded every run.
+    *workers*
+      Integer, number of fits files that astrotools.read_spec reads simultaneously.
+    *archive*
+      String with name of an archive created by pack_archive (with full path and no extension). Spectra found in it are not read from their fits files, unless these changed after they were packed.
+    '''
+    
+    def __init__(self, folderRoot=FOLDER_ROOT, folderIn=FOLDER_IN, preload=False, cache=None, workers=None, archive=None):
+        self.folderRoot = folderRoot
+        self.folderIn   = folderIn
+        self.cache      = cache
+        self.workers    = workers
+        self.archive    = None
+        if archive is not None:
+            import astrotools as at
+            self.archive = at.SpecArchive(archive)
+        self.catalog, self.dataS = read_catalogs(folderIn)
+        self.data = self.catalog.data
+        self.spectra = {} # Spectral data keyed by full fits file name
+        self.meta    = {} # Header data keyed by full fits file name
+        self.members = {} # NIR file names & spectra of the template members of
+                          # the last call to main, keyed by band
+        self.diagnostics = {} # Diagnostics of the templates of the last call to
+                              # main (if asked for), keyed by band
+        
+        if preload:
+            for key in OPTNIR_KEYS:
+                specFiles = []
+                for fileName in self.data[key + 'file']:
+                    if fileName[-4:] == '.dat' or fileName == 'include': continue
+                    specFiles.append(self.folderRoot + key + '/' + fileName)
+                self.read_spec(specFiles)
+    
+    def read_spec(self, specFiles):
+        # Returns the spectra of the given fits files (None for missing ones),
+        # reading from disk only those not read before in this session.
+        import astrotools as at
+        
+        toRead = []
+        for spFile in specFiles:
+            if spFile is not None and spFile not in self.spectra and spFile not in toRead:
+                toRead.append(spFile)
+        
+        # Take from the archive the spectra stored in it (those whose fits files
+        # changed after they were packed are read from the files)
+        if self.archive is not None and len(toRead) > 0:
+            notPacked = []
+            for spFile in toRead:
+                name = spFile[len(self.folderRoot):]
+                if spFile.startswith(self.folderRoot) and self.archive.current(name, spFile):
+                    self.spectra[spFile] = self.archive[name]
+                    self.meta[spFile]    = self.archive.get_meta([name])[0]
+                else:
+                    notPacked.append(spFile)
+            toRead = notPacked
+        
+        if len(toRead) > 0:
+            newSpecs, newMeta = at.read_spec(toRead, atomicron=True, negtonan=True, \
+                                    errors=True, verbose=False, cache=self.cache, \
+                                    workers=self.workers, meta=True)
+            for spFile, spec, spMeta in zip(toRead, newSpecs, newMeta):
+                self.spectra[spFile] = spec
+                self.meta[spFile]    = spMeta
+        
+        specData = [None] * len(specFiles)
+        for spIdx, spFile in enumerate(specFiles):
+            if spFile is not None:
+                specData[spIdx] = self.spectra[spFile]
+        
+        return specData
+    
+    def read_meta(self, specFiles):
+        # Returns the header data of the given fits files (None for missing ones),
+        # as gathered by astrotools.read_spec.
+        self.read_spec(specFiles)
+        
+        specMeta = [None] * len(specFiles)
+        for spIdx, spFile in enumerate(specFiles):
+            if spFile is not None:
+                specMeta[spIdx] = self.meta[spFile]
+        
+        return specMeta
+
+
+def pack_archive(archive, folderRoot=FOLDER_ROOT, folderIn=FOLDER_IN, workers=None):
+    # Packs the OPT and NIR spectra of all objects in the catalog into one archive
+    # (see astrotools.pack_spec) to be used by DataSession. Spectra are named
+    # after their folder and fits file name (e.g. 'NIR/file.fits') and keyed by
+    # the Ref of their object. Returns the number of spectra packed.
+    import astrotools as at
+    
+    objCatalog, dataS = read_catalogs(folderIn)
+    data = objCatalog.data
+    specFiles = []
+    names     = []
+    keys      = []
+    for key in OPTNIR_KEYS:
+        for refIdx, fileName in enumerate(data[key + 'file']):
+            if fileName[-4:] == '.dat' or fileName == 'include': continue
+            name = key + '/' + fileName
+            if name in names: continue
+            specFiles.append(folderRoot + name)
+            names.append(name)
+            keys.append(str(data[HDR_FILE_IN[0]][refIdx]))
+    
+    # Same options as DataSession.read_spec
+    return at.pack_spec(specFiles, archive, names=names, keys=keys, atomicron=True, \
+                        negtonan=True, errors=True, verbose=False, workers=workers)
+
+
+def make_template(templSpecs, renormalize=True):
+    # Calculates a template spectrum from a set of spectra, interpolating them only
+    # once into the wavelength grid of the first one. Returns the template (wl,
+    # mean flux, variance, min flux, max flux) and the re-normalization factors.
+    # Same result as (but faster than) calling astrotools.mean_comb three times:
+    # 1) with renormalize=True, to get the spectra re-normalized to a first mean
+    # 2) with extremes=True on the re-normalized spectra, to get the template
+    # 3) with forcesimple=True on the re-normalized spectra, to get the simple
+    #    variance (with no weights) that replaces the template variance.
+    import astrotools as at
+    
+    ip_spectra, renormFacs = __renorm_resampled(at.resample_spec(templSpecs), renormalize)
+    
+    # Calculate template, then replace its variance with the simple variance
+    template = at.comb_spec(ip_spectra, extremes=True)
+    template[2] = at.comb_spec(ip_spectra, forcesimple=True)[2]
+    
+    return template, renormFacs
+
+
+def make_template_stream(chunks, renormalize=True):
+    # Calculates the same template as make_template, from spectra given in chunks,
+    # in constant memory (see astrotools.SpecAccumulator). The wavelength grid is
+    # that of the first spectrum of the first chunk that has any. If
+    # renormalize=True, spectra are gone through twice, so chunks must give the
+    # chunks (Python lists of spectra) every time it is iterated (e.g. a list of
+    # chunks, or an object that reads each chunk from disk when iterated); a
+    # generator or other one-shot iterator is only accepted with
+    # renormalize=False. Returns the template and the re-normalization factors.
     import astrotools as at
     import numpy as np
-    import sys
-    import os
-    import pdb
-    import matplotlib.pyplot as plt
+    
+    if renormalize and iter(chunks) is chunks:
+        raise TypeError('make_template_stream: chunks must be iterable more than ' \
+                        'once (e.g. a list) to re-normalize spectra.')
+    
+    # Re-normalize spectra to their weighted mean
+    grid = None
+    renormFacs = None
+    if renormalize:
+        firstPass = None
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            if firstPass is None:
+                grid = chunk[0][0]
+                firstPass = at.SpecAccumulator(grid)
+            firstPass.add(chunk)
+        if firstPass is None:
+            return None, None
+        firstFlux = firstPass.result()[1]
+        renormFacs = []
+    
+    # Calculate template, then replace its variance with the simple variance
+    accumulator = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if accumulator is None:
+            if grid is None:
+                grid = chunk[0][0]
+            accumulator = at.SpecAccumulator(grid)
+        ip_spectra = at.resample_spec(chunk, mask=grid)
+        if renormalize:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chunkFacs = np.median(ip_spectra[1] / firstFlux, axis=1)
+            renormFacs.append(chunkFacs)
+            fluxes = ip_spectra[1] / chunkFacs[:,np.newaxis]
+            uncs = ip_spectra[2]
+            if uncs is not None:
+                uncs = uncs / chunkFacs[:,np.newaxis]
+                # Weights are used only if all re-normalized spectra still have them
+                if not np.all(np.any(np.isfinite(uncs), axis=1)):
+                    uncs = None
+            ip_spectra = [grid, fluxes, uncs, np.isfinite(fluxes)]
+        accumulator.add_resampled(ip_spectra)
+    if accumulator is None:
+        return None, None
+    
+    template = accumulator.result(extremes=True)
+    template[2] = accumulator.result(forcesimple=True)[2]
+    if renormalize:
+        renormFacs = np.concatenate(renormFacs)
+    
+    return template, renormFacs
+
+
+def template_diagnostics(templSpecs, renormalize=True):
+    # Calculates leave-one-out diagnostics of the template that make_template
+    # calculates from a set of spectra: the template without each spectrum, the
+    # reduced chi2 of each spectrum against it, how much each spectrum shifts the
+    # template, and the jackknife variance of the template. All of them come from
+    # the sums shared by all spectra (see astrotools.SpecAccumulator.leave_one_out),
+    # in O(number of spectra x number of wavelengths), instead of combining the
+    # spectra once more for each spectrum left out. Re-normalization factors are
+    # those of the full set. Returns a dictionary with the wavelength grid
+    # ('wave'), the mean flux and simple variance of the templates without each
+    # spectrum (one row per spectrum, 'looFlux' and 'looVar'), the reduced chi2
+    # ('chi2') and rms shift of the template mean flux ('shift') of each spectrum,
+    # the jackknife variance of the template mean flux ('jackVar'), and the
+    # re-normalization factors ('renormFacs').
+    import astrotools as at
+    import numpy as np
+    
+    ip_spectra, renormFacs = __renorm_resampled(at.resample_spec(templSpecs), renormalize)
+    accumulator = at.SpecAccumulator(ip_spectra[0])
+    accumulator.add_resampled(ip_spectra)
+    mean = accumulator.result()[1]
+    looFlux = accumulator.leave_one_out(ip_spectra)[0]
+    looVar = accumulator.leave_one_out(ip_spectra, forcesimple=True)[1]
+    
+    fluxes = ip_spectra[1]
+    variance = looVar
+    if ip_spectra[2] is not None:
+        variance = variance + np.where(np.isnan(ip_spectra[2]), 0., ip_spectra[2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Reduced chi2 against the template without the spectrum, using its
+        # uncertainties and the spread of the other spectra
+        valid = np.isfinite(fluxes) & np.isfinite(looFlux) & (variance > 0)
+        chi2 = np.where(valid, (fluxes - looFlux) ** 2 / variance, 0.).sum(axis=1) \
+               / valid.sum(axis=1)
+        
+        # Shift of the template mean flux when the spectrum is left out
+        valid = np.isfinite(looFlux) & np.isfinite(mean)
+        shift = np.sqrt(np.where(valid, (looFlux - mean) ** 2, 0.).sum(axis=1) \
+                        / valid.sum(axis=1))
+        
+        # Jackknife variance, from the spectra with data at each wavelength
+        valid = np.isfinite(fluxes) & np.isfinite(looFlux)
+        numValid = valid.sum(axis=0)
+        looMean = np.where(valid, looFlux, 0.).sum(axis=0) / numValid
+        jackVar = (numValid - 1.) / numValid * np.sum(np.where(valid, looFlux \
+                  - looMean, 0.) ** 2, axis=0)
+    
+    return dict(wave=ip_spectra[0], looFlux=looFlux, looVar=looVar, chi2=chi2, \
+                shift=shift, jackVar=jackVar, renormFacs=renormFacs)
+
+
+def member_spectra(session, rowIdxs):
+    # Reads, smooths, cuts and normalizes the spectra of the given objects (rows
+    # in session.data) as main does for the template members. Returns a
+    # dictionary with a list of spectra for each band in BANDS_NAMES (None for
+    # objects missing OPT or NIR data, and for those main leaves out of the
+    # template of the band).
+    import astrotools as at
+    import numpy as np
+    
+    data = session.data
+    objRef = [str(int(data[HDR_FILE_IN[0]][rowIdx])) for rowIdx in rowIdxs]
+    
+    # Read spectra (objects need both OPT and NIR data)
+    specFilesDict = {}
+    spectraRaw = {}
+    for key in OPTNIR_KEYS:
+        specFiles = [None] * len(rowIdxs)
+        for posIdx, rowIdx in enumerate(rowIdxs):
+            fileName = data[key + 'file'][rowIdx]
+            if fileName[-4:] == '.dat' or fileName == 'include': continue
+            specFiles[posIdx] = session.folderRoot + key + '/' + fileName
+        specFilesDict[key] = specFiles
+        spectraRaw[key] = session.read_spec(specFiles)
+    for posIdx in range(len(rowIdxs)):
+        if spectraRaw['OPT'][posIdx] is None or spectraRaw['NIR'][posIdx] is None:
+            spectraRaw['OPT'][posIdx] = None
+            spectraRaw['NIR'][posIdx] = None
+    
+    # Smooth, select bands, and normalize them
+    spectraS = {}
+    spectraS['OPT'] = at.smooth_batch(spectraRaw['OPT'], specMeta=session.read_meta( \
+                                      specFilesDict['OPT']), winWidth=10)
+    spectraS['NIR'] = at.smooth_spec(spectraRaw['NIR'], specMeta=session.read_meta( \
+                                     specFilesDict['NIR']), winWidth=0)
+    spectraN = {}
+    for optNIR in OPTNIR_KEYS:
+        bandLims = {}
+        for bandKey in BANDS_NAMES:
+            if (bandKey == 'OPT') == (optNIR == 'OPT'):
+                bandLims[bandKey] = BAND_LIMS[bandKey]['lim']
+        bands = at.sel_band(spectraS[optNIR], bandLims, objRef)
+        for bandKey in bandLims:
+            spectraN[bandKey] = at.norm_spec(bands[bandKey], BAND_LIMS[bandKey]['limN'])
+    
+    # Leave out the spectra main leaves out of the templates
+    for posIdx in range(len(rowIdxs)):
+        if objRef[posIdx] in OPT_SKIP_REFS:
+            spectraN['OPT'][posIdx] = None
+        for bandKey in BANDS_NAMES:
+            spex = spectraN[bandKey][posIdx]
+            if bandKey != 'OPT' and spex is not None and not np.any(np.isfinite(spex[2])):
+                spectraN[bandKey][posIdx] = None
+    
+    return spectraN
+
+
+@profiling.profiled('nir_opt_comp_strip.main')
+def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, normalize=True, session=None, folderOut=FOLDER_OUT, diagnose=False):
+    # 1. LOAD RELEVANT MODULES ------------------------------------------------
+    # (matplotlib is only imported by plotspec, so it is not loaded when plot=False)
+    import astrotools as at
+    import catalog
+    import numpy as np
     
     # 2. SET UP VARIABLES -----------------------------------------------------
-    # Customizable variables <><><><><><><><><><><><><><><><><><><><><><><><><><><>
-    FOLDER_ROOT = '/Users/alejo/Dropbox/Project_0/more data/'  # Location of NIR and OPT folders
-    FOLDER_IN = '/Users/alejo/Dropbox/Project_0/data/' # Location of input files
-    FOLDER_OUT = '/Users/alejo/Dropbox/Project_0/plots/' # Location to save output figures
-    FILE_IN = 'nir_spex_prism_with_optical.txt' # ASCII file w/ data
-    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
-    
-    # For TXT objects file (updatable here directly)
-    HDR_FILE_IN = ('Ref','Designation`','J','H','K','SpType','SpType_T','NIRFobs',\
-                   'NIRFtel','NIRfile','OPTobs','OPTtel','OPTinst','OPTfile',\
-                   'Young?','Dusty?','Blue?','Binary?','Pec?')
-    
-    # For TXT standards file
-    FILE_IN_STD = 'NIR_Standards_K10.txt'   # ASCII file w/ standards
-    HDR_FILE_IN_STD = ('Ref','Designation','NIR SpType','OPT SpType')
     colNameNIRS = HDR_FILE_IN_STD[2]
     colNameOPTS = HDR_FILE_IN_STD[3]
     
-    OPTNIR_KEYS = ['OPT','NIR']
-    BANDS_NAMES = ['K','H','J','OPT']
     data       = ''
     dataRaw    = ''
     specFiles  = ''
@@ -731,86 +1111,21 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
     colNameBin   = HDR_FILE_IN[17]
     colNamePec   = HDR_FILE_IN[18]
     
-    # Initialize dictionary to store NIR bands limits and normalizing sections
-    BAND_LIMS = {}.fromkeys(BANDS_NAMES)
-    for bandKey in BANDS_NAMES:
-        BAND_LIMS[bandKey] = dict(lim = [None] * 2, limN = [None] * 2)
-    
-    # Set wavelength limits for bands
-    # Limits are in microns
-    BAND_LIMS['OPT']['lim'][0] = 0.65
-    BAND_LIMS['OPT']['lim'][1] = 0.90
-    BAND_LIMS['J'  ]['lim'][0] = 0.8
-    BAND_LIMS['J'  ]['lim'][1] = 1.4 
-    BAND_LIMS['H'  ]['lim'][0] = 1.4
-    BAND_LIMS['H'  ]['lim'][1] = 1.9
-    BAND_LIMS['K'  ]['lim'][0] = 1.9
-    BAND_LIMS['K'  ]['lim'][1] = 2.4
-    
-    # Set wl limits for normalizing sections
-    # Limits are in microns
-    BAND_LIMS['OPT']['limN'][0] = 0.66
-    BAND_LIMS['OPT']['limN'][1] = 0.89
-    BAND_LIMS['J'  ]['limN'][0] = 0.87
-    BAND_LIMS['J'  ]['limN'][1] = 1.39
-    BAND_LIMS['H'  ]['limN'][0] = 1.41
-    BAND_LIMS['H'  ]['limN'][1] = 1.89
-    BAND_LIMS['K'  ]['limN'][0] = 1.91
-    BAND_LIMS['K'  ]['limN'][1] = 2.39
-    
-    
-    # 3. READ DATA FROM MAIN INPUT FILE ---------------------------------------
-    DELL_CHAR = '\t' # Delimiter character
-    COMM_CHAR = '#'  # Comment character
-    
-    # File with ALL objects (source: query in Access)
-    dataRaw = ascii.read(FOLDER_IN + FILE_IN, format='no_header', \
-                         delimiter=DELL_CHAR, comment=COMM_CHAR, data_start=1)
-    
-    # Store data in a dictionary-type object
-    data = {}.fromkeys(HDR_FILE_IN)
-    for colIdx,colname in enumerate(dataRaw.colnames):
-        data[HDR_FILE_IN[colIdx]] = np.array(dataRaw[colname])
-    
-    # File with standards (source: manually generated)
-    dataRawS = ascii.read(FOLDER_IN + FILE_IN_STD, data_start=0)
-    
-    # Store standard data in a dictionary-type object
-    dataS = {}.fromkeys(HDR_FILE_IN_STD)
-    for colIdx,colname in enumerate(dataRawS.colnames):
-        dataS[HDR_FILE_IN_STD[colIdx]] = np.array(dataRawS[colname])
-    
-    
-    # 4. FORMAT SOME ASCII COLUMNS --------------------------------------------
-    # 4.1 Convert into unicode the Spectral Type-Text column
-    uniSpType = [None] * len(data[colNameType])
-    for sIdx,sType in enumerate(data[colNameType]):
-        uniSpType[sIdx] = sType #.decode('utf-8')
-    data[colNameType] = np.array(uniSpType)
-    
-    # 4.2 Calculate J-K Color
-    data[colNameJK] = data[colNameJ] - data[colNameK]
-    
-    # 4.3 Format Designation Number from Designation Column
-    #     (From "XX XX XX.X +XX XX XX.X" to "XXXX+XXXX")
-    for desigIdx,desig in enumerate(data[colNameDesig]):
-        desig    = ''.join(desig.split())
-        signType = '+'
-        signPos  = desig.find(signType)
-        if signPos == -1:
-            signType = '-'
-            signPos  = desig.find(signType)
-        
-        desigProper = desig[:4] + signType + desig[signPos+1:signPos+5]
-        data[colNameDesig][desigIdx] = desigProper
+    # 3-4. READ & FORMAT DATA FROM INPUT FILES --------------------------------
+    # (Catalogs and spectra are read only once per session)
+    profiling.stage('3-4. read catalogs')
+    if session is None:
+        session = DataSession()
+    session.members = {}
+    session.diagnostics = {}
+    data  = session.data
+    dataS = session.dataS
     
     
     # 5. FILTER DATA BY USER INPUT IN spInput ---------------------------------
-    specIdx = []
+    profiling.stage('5. filter data')
     # Find all spectra of same spectral type
-    for spIdx,spType in enumerate(data[colNameType]):
-        if spType.upper().startswith(spInput.upper()):
-            specIdx.append(spIdx)
+    specIdx = list(session.catalog.select(spInput))
     if not specIdx:
         print('No targets found for given input.')
         if std is False:
@@ -826,10 +1141,9 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
     # Add NIR standard target to list of filtered objects if not there already
     # (It may not be included in first filter because OPT SpT != NIR SpT)
     if dataS[colNameNIRS][stdIdx] != dataS[colNameOPTS][stdIdx]:
-        for spIdx,spRef in enumerate(data[colNameRef]):
-            if spRef == int(dataS[colNameRef][stdIdx][0]):
-                if spIdx not in specIdx:
-                    specIdx.append(spIdx)
+        spIdx = session.catalog.refs.get(int(dataS[colNameRef][stdIdx][0]))
+        if spIdx is not None and spIdx not in specIdx:
+            specIdx.append(spIdx)
     
     # Sort relevant objects by JKmag value
     specIdx     = np.array(specIdx)
@@ -837,6 +1151,7 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
     
     
     # 6. READ SPECTRAL DATA FROM SPECTRAL FILES -------------------------------
+    profiling.stage('6. read spectra', items=len(OPTNIR_KEYS) * len(specSortIdx))
     spectraRaw    = {}.fromkeys(OPTNIR_KEYS) # Used to store the raw data from fits files
     specFilesDict = {}.fromkeys(OPTNIR_KEYS) # Used for reference purposes
     
@@ -846,12 +1161,11 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
         for sortIdx,specSort in enumerate(specSortIdx):
             if data[key + 'file'][specIdx[specSort]][-4:] == '.dat': continue
             if data[key + 'file'][specIdx[specSort]] == 'include': continue
-            tmpFullName = FOLDER_ROOT + key + '/' + data[key + 'file'][specIdx[specSort]]
+            tmpFullName = session.folderRoot + key + '/' + data[key + 'file'][specIdx[specSort]]
             specFiles[sortIdx] = tmpFullName
         specFilesDict[key] = specFiles
         
-        spectraRaw[key] = at.read_spec(specFiles, atomicron=True, negtonan=True, \
-                                       errors=True, verbose=False)
+        spectraRaw[key] = session.read_spec(specFiles)
     
     # Clear out spectral data for objects missing either OPT or NIR data
     allNone = True
@@ -877,6 +1191,7 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
     
     
     # 7. GATHER OBJECTS' NAMES ------------------------------------------------
+    profiling.stage('7. gather names', items=len(specSortIdx))
     # Filtered objects
     refs = [None] * len(specSortIdx)
     NIRfilenames = [None] * len(specSortIdx)
@@ -896,30 +1211,34 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
     
     
     # 8. SMOOTH SPECTRA -------------------------------------------------------
+    profiling.stage('8. smooth spectra', items=len(OPTNIR_KEYS) * len(specSortIdx))
     # Smooth the flux data to a reasonable resolution
     spectraS = {}.fromkeys(OPTNIR_KEYS)
-    tmpSpOPT = at.smooth_spec(spectraRaw['OPT'], specFile=specFilesDict['OPT'], \
-                              winWidth=10)
-    tmpSpNIR = at.smooth_spec(spectraRaw['NIR'], specFile=specFilesDict['NIR'], \
-                              winWidth=0)
+    tmpSpOPT = at.smooth_batch(spectraRaw['OPT'], specMeta=session.read_meta( \
+                               specFilesDict['OPT']), winWidth=10)
+    tmpSpNIR = at.smooth_spec(spectraRaw['NIR'], specMeta=session.read_meta( \
+                              specFilesDict['NIR']), winWidth=0)
     
     spectraS['OPT'] = tmpSpOPT
     spectraS['NIR'] = tmpSpNIR
     
     # 9. SELECT SPECTRAL DATA FOR THE DIFFERENT BANDS -------------------------
+    profiling.stage('9. select & normalize bands', items=len(BANDS_NAMES) * len(specSortIdx))
     # Initialize variables
     spectra  = {}.fromkeys(BANDS_NAMES)
     spectraN = {}.fromkeys(BANDS_NAMES)
     
+    # Select all bands of each set of spectra at once
+    for optNIR in OPTNIR_KEYS:
+        bandLims = {}
+        for bandKey in BANDS_NAMES:
+            if (bandKey == 'OPT') == (optNIR == 'OPT'):
+                bandLims[bandKey] = BAND_LIMS[bandKey]['lim']
+        tmpBands = at.sel_band(spectraS[optNIR], bandLims, objRef)
+        if tmpBands is not None:
+            spectra.update(tmpBands)
+    
     for bandKey in BANDS_NAMES:
-        if bandKey == 'OPT':
-            optNIR = 'OPT'
-        else:
-            optNIR = 'NIR'
-        
-        # Select band
-        spectra[bandKey] = at.sel_band(spectraS[optNIR], BAND_LIMS[bandKey]['lim'], \
-                                       objRef)
         if spectra[bandKey] is None:
             break
         
@@ -933,76 +1252,27 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
     
     
     # 10. CHARACTERIZE TARGETS (i.e. identify young, field, and excluded) -----
+    profiling.stage('10. characterize targets', items=len(refs))
     grav = grav.lower()
     toInclude = [False] * len(refs)
     # toInclude_LG = [False] * len(refs)
     toExclude = [False] * len(refs)
-    dataIncl = []
-    # dataIncl_LG = []
-    dataExcl = []
-    
-    # 10.1 Extract NIR file names from "keepers" file
-    fileslist = os.listdir(FOLDER_IN)
-    inclFile = ''
-    for fl in fileslist:
-        if fl.find('keepers') == -1 or fl.find(spInput) == -1: continue
-        
-        tmpfl = fl.split('_')
-        if len(tmpfl[1]) == 2 and grav == 'f':
-            inclFile = fl
-            break
-        elif len(tmpfl[1]) == 3:
-            if tmpfl[1][-1] == grav:
-                inclFile = fl
-                break
-    
-    if inclFile != '':
-        dataIncl = ascii.read(FOLDER_IN + inclFile, format='no_header', \
-                              delimiter=DELL_CHAR, comment=COMM_CHAR)
-    if len(dataIncl) > 0:
-        includeObjs = np.array(dataIncl['col1']).astype(object)
-        includeObjs = includeObjs + np.repeat('.fits', len(dataIncl))
-        # Find intersection of include-obj list and filtered targets list
-        setInclude = set(includeObjs).intersection(set(NIRfilenames))
-        # Create list with intersection targets
-        if len(setInclude) != 0:
-            for inclIdx in setInclude:
-                tmpInclIdx = np.where(np.array(NIRfilenames) == inclIdx)[0]
-                toInclude[tmpInclIdx] = True
-    
-    # 10.2 Extract NIR file names from "rejects" file
-    exclFile = ''
-    for fl in fileslist:
-        if fl.find('rejects') == -1 or fl.find(spInput) == -1: continue
-        
-        tmpfl = fl.split('_')
-        if len(tmpfl[1]) == 2 and grav == 'f':
-            exclFile = fl
-            break
-        elif len(tmpfl[1]) == 3:
-            if tmpfl[1][-1] == grav:
-                exclFile = fl
-                break
-    
-    if exclFile != '':
-        try:
-            dataExcl = ascii.read(FOLDER_IN + exclFile, format='no_header', \
-                                  delimiter=DELL_CHAR, comment=COMM_CHAR)
-        except:
-            dataExcl = []
-    if len(dataExcl) == 0 and excluded:
+    
+    # 10.1 Find NIR file names in "keepers" file
+    manifests = catalog.load_manifests(session.folderIn)
+    keepers = manifests.get(spInput, grav, 'keepers')
+    if keepers is not None:
+        for idx, NIRfile in enumerate(NIRfilenames):
+            toInclude[idx] = NIRfile in keepers
+    
+    # 10.2 Find NIR file names in "rejects" file
+    rejects = manifests.get(spInput, grav, 'rejects')
+    if (rejects is None or len(rejects) == 0) and excluded:
         print('No objects found in REJECTS file. Nothing to plot.')
         return
-    elif len(dataExcl) > 0:
-        excludeObjs = np.array(dataExcl['col1']).astype(object)
-        excludeObjs = excludeObjs + np.repeat('.fits', len(dataExcl))
-        # Find intersection of exclude-obj list and filtered targets list
-        setExclude = set(excludeObjs).intersection(set(NIRfilenames))
-        # Create list with intersection targets
-        if len(setExclude) != 0:
-            for exclIdx in setExclude:
-                tmpExclIdx = np.where(np.array(NIRfilenames) == exclIdx)[0]
-                toExclude[tmpExclIdx] = True
+    elif rejects is not None:
+        for idx, NIRfile in enumerate(NIRfilenames):
+            toExclude[idx] = NIRfile in rejects
     
     # 10.3 Determine which target is the NIR Standard object
     O_standard = [None] * 3 # Holds standard for output
@@ -1053,6 +1323,7 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
     
     
     # 11. CALCULATE TEMPLATE SPECTRA FOR SELECTED SET OF SPECTRA ---------------------
+    profiling.stage('11. calculate template')
     # Gather spectra to use to calculate template spectrum
     if not allExcl:
         O_template = [None] * 3 # Holds calculated template for output
@@ -1060,6 +1331,7 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
         for bandIdx, bandKey in enumerate(BANDS_NAMES):
             template = None
             templSpecs = []
+            templNames = [] # NIR file names of the objects in templSpecs
             for spIdx, spex in enumerate(spectraN[bandKey]):
                 if templInstructions[spIdx]:
                     # Check that spectrum exists
@@ -1069,15 +1341,10 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
                     
                     if bandKey == 'OPT':
                         # Manually skip including OPT spectrum of some specific targets
-                        # which use the same NIR fits file as both OPT and NIR spectrum
-                        # so OPT spectrum is very bad
-                        if refs[spIdx] == '50246':
-                            continue
-                        if refs[spIdx] == '50061':
-                            continue
-                        elif refs[spIdx] == '50188':
+                        if refs[spIdx] in OPT_SKIP_REFS:
                             continue
                         templSpecs.append(spex)
+                        templNames.append(NIRfilenames[spIdx])
                     
                     else:
                         # Check that spectrum comes with error values (NIR bands only)
@@ -1085,24 +1352,22 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
                         notNans = np.any(notNansBool)
                         if notNans:
                             templSpecs.append(spex)
+                            templNames.append(NIRfilenames[spIdx])
                         else:
                             print(str(objRef[spIdx]) + ' excluded from template')
                             templInstructions[spIdx] = False
             
             # Calculate template spectrum using spec uncertainties as weights
+            profiling.count(len(templSpecs))
+            session.members[bandKey] = (templNames, templSpecs)
             if len(templSpecs) > 1:
-                if bandKey == 'OPT':
-                    template = at.mean_comb(templSpecs, extremes=True)
-                else:
-                    template_first, renormSpecs = at.mean_comb(templSpecs, renormalize=True)
-                    # Re-calculate template using re-normalized spectra
-                    template = at.mean_comb(renormSpecs, extremes=True)
-                
-                # To calculate simple standard deviation, recalculate template without
-                # any weights, and just use the simple variance that comes out of that.
-                tmptempl = at.mean_comb(renormSpecs, forcesimple=True)
-                template[2] = tmptempl[2].copy()
+                template, renormFacs = make_template(templSpecs, \
+                                                     renormalize=(bandKey != 'OPT'))
                 templCalculated = True
+                if diagnose:
+                    session.diagnostics[bandKey] = template_diagnostics(templSpecs, \
+                                                   renormalize=(bandKey != 'OPT'))
+                    session.diagnostics[bandKey]['names'] = templNames
             
             # Append template to list of spectra to plot in the next step
             if templCalculated:
@@ -1128,6 +1393,7 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
     
     
     # 12. PLOT DATA -----------------------------------------------------------
+    profiling.stage('12. plot data')
     if plot:
         # Gather info on each target
         objInfo = [None] * len(refs)
@@ -1160,12 +1426,14 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
                           grav, plotInstructions, excluded)
     
     if plot:
+        profiling.stage('12. save figure')
         if excluded:
             sptxt = '_excluded'
         else:
             sptxt = ''
-        figObj.savefig(FOLDER_OUT + spTypeInput + 'strip_' + \
-                       grav + sptxt + '.pdf', dpi=300)
+        # No creation date in the file, so that the same data give the same file
+        figObj.savefig(folderOut + spTypeInput + 'strip_' + \
+                       grav + sptxt + '.pdf', dpi=300, metadata={'CreationDate':None})
     
     
     # 13. DETERMINE OUTPUT ----------------------------------------------------
@@ -1178,3 +1446,27 @@ def main(spInput, grav='', plot=True, templ=False, std=False, excluded=False, no
         return O_standard
     else:
         return spectraN
+
+
+def __renorm_resampled(ip_spectra, renormalize):
+# Function used by make_template and template_diagnostics only
+# Re-normalizes spectra interpolated into one grid (as returned by
+# astrotools.resample_spec) to their weighted mean, if renormalize=True.
+# Returns the re-normalized spectra and the re-normalization factors (None if
+# not re-normalized).
+    import astrotools as at
+    import numpy as np
+    
+    if not renormalize:
+        return ip_spectra, None
+    
+    tmptempl, renormFacs = at.comb_spec(ip_spectra, renormalize=True)
+    fluxes = ip_spectra[1] / renormFacs[:,np.newaxis]
+    uncs = ip_spectra[2]
+    if uncs is not None:
+        uncs = uncs / renormFacs[:,np.newaxis]
+        # Weights are used only if all re-normalized spectra still have them
+        if not np.all(np.any(np.isfinite(uncs), axis=1)):
+            uncs = None
+    
+    return [ip_spectra[0], fluxes, uncs, np.isfinite(fluxes)], renormFacs
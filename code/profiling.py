@@ -0,0 +1,236 @@
+'''
+The module profiling records where the time and memory of the template & figure pipelines go, when asked to (it does nothing otherwise).
+
+Functions decorated with profiled (e.g. nir_opt_comp_strip.main) and the astrotools functions in FUNCTIONS are timed while a Profiler is running; stage() marks the beginning of each numbered stage inside a function, which lasts until the next stage or the end of the function. For each function and stage it records the number of calls, wall time, CPU time, peak memory allocated (using tracemalloc), and the number of items processed (e.g. spectra). Records are identified by their call path (e.g. 'nir_opt_comp_strip.main;8. smooth spectra;astrotools.smooth_spec'), so the records of many calls (e.g. the 27 calls of make_templ.py) add up.
+
+Use:
+    import profiling
+    profiler = profiling.start()
+    ... (run the pipeline)
+    profiling.stop().write('profile.json')
+
+This writes profile.json with one record per call path, and profile.folded with the (self) wall time of each call path in microseconds, in the folded stacks format read by flamegraph.pl and speedscope.
+'''
+
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+# astrotools functions timed while a Profiler is running
+FUNCTIONS = ['read_spec', 'smooth_spec', 'smooth_batch', 'sel_band', 'norm_spec', \
+             'resample_spec', 'mean_comb', 'comb_spec', 'avg_flux', 'avg_flux_batch']
+
+# Profiler running (None if profiling is off)
+__ACTIVE = [None]
+
+
+class Profiler(object):
+    '''
+    Timings and memory use of profiled functions and their stages.
+    
+    *memory*
+      Boolean, whether to record peak memory with tracemalloc (which slows Python down).
+    *functions*
+      Python list of names of astrotools functions to time.
+    *thread*
+      Identifier of the thread whose calls are recorded (the one that created the Profiler).
+    *records*
+      Dictionary that maps call path to a dictionary with the number of calls ('calls'), wall & CPU time in seconds ('wall', 'cpu'), wall time spent outside nested records ('self'), peak memory in bytes allocated during any one call ('peakMem'), and number of items processed ('items').
+    '''
+    
+    def __init__(self, memory=True, functions=FUNCTIONS):
+        self.memory = memory
+        self.functions = functions
+        self.thread = threading.get_ident()
+        self.records = {}
+        self.order = {} # Order in which call paths were first entered
+        self.frames = [] # Records open, innermost last
+        self.patched = {}
+        self.tracing = False # Whether tracemalloc was started by this Profiler
+    
+    def open(self, name, isFunc, items=None):
+        # Opens a record nested in the innermost one open. Stages close the
+        # stage open in the same function (or at the top level) first.
+        if not isFunc:
+            funcLevel = self.func_level()
+            self.close(0 if funcLevel is None else funcLevel + 1)
+        
+        path = name
+        if len(self.frames) > 0:
+            path = self.frames[-1]['path'] + ';' + name
+        self.order.setdefault(path, len(self.order))
+        frame = dict(path=path, isFunc=isFunc, items=items, children=0., \
+                     wall=time.perf_counter(), cpu=time.process_time())
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self.frames) > 0:
+                self.frames[-1]['peak'] = max(self.frames[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['mem'] = current
+            frame['peak'] = current
+        self.frames.append(frame)
+        return len(self.frames) - 1
+    
+    def close(self, level):
+        # Closes all records from level (counted from the outermost) inwards.
+        while len(self.frames) > level:
+            frame = self.frames.pop()
+            wall = time.perf_counter() - frame['wall']
+            cpu = time.process_time() - frame['cpu']
+            peakMem = 0
+            if self.memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                peakMem = peak - frame['mem']
+                if len(self.frames) > 0:
+                    self.frames[-1]['peak'] = max(self.frames[-1]['peak'], peak)
+            if len(self.frames) > 0:
+                self.frames[-1]['children'] += wall
+            
+            record = self.records.setdefault(frame['path'], dict(calls=0, wall=0., \
+                     cpu=0., self=0., peakMem=0, items=0))
+            record['calls'] += 1
+            record['wall'] += wall
+            record['cpu'] += cpu
+            record['self'] += wall - frame['children']
+            record['peakMem'] = max(record['peakMem'], peakMem)
+            if frame['items'] is not None:
+                record['items'] += frame['items']
+    
+    def count(self, items):
+        # Adds items to the innermost record open.
+        if len(self.frames) > 0:
+            self.frames[-1]['items'] = (self.frames[-1]['items'] or 0) + items
+    
+    def func_level(self):
+        # Returns the level of the innermost function record open (None if none).
+        for level in range(len(self.frames) - 1, -1, -1):
+            if self.frames[level]['isFunc']:
+                return level
+        return None
+    
+    def paths(self):
+        # Returns the call paths recorded, in the order they were first entered
+        # (so that stages follow each other, and nested records follow their parent).
+        return sorted(self.records, key=lambda path: self.order[path])
+    
+    def write(self, fileName, folded=True):
+        # Writes the records into a JSON file (in call order) and, if
+        # folded=True, the self wall time of each call path into a folded stacks
+        # file with the same name and extension .folded.
+        import os
+        
+        output = dict(memory=self.memory, records=[])
+        for path in self.paths():
+            record = dict(path=path, name=path.split(';')[-1])
+            record.update(self.records[path])
+            output['records'].append(record)
+        with open(fileName, 'w') as jsonFile:
+            json.dump(output, jsonFile, indent=1)
+        
+        if folded:
+            lines = []
+            for path in self.paths():
+                selfTime = int(round(1.e6 * self.records[path]['self']))
+                lines.append(path.replace(' ', '_') + ' %i\n' % max(selfTime, 0))
+            with open(os.path.splitext(fileName)[0] + '.folded', 'w') as foldFile:
+                foldFile.writelines(lines)
+    
+    def summary(self):
+        # Returns a text table with the records (in call order).
+        lines = ['%-70s %6s %9s %9s %10s %8s' % ('path', 'calls', 'wall s', 'cpu s', \
+                                                  'peak MB', 'items')]
+        for path in self.paths():
+            record = self.records[path]
+            indent = '  ' * path.count(';')
+            lines.append('%-70s %6i %9.3f %9.3f %10.2f %8i' % ((indent + \
+                         path.split(';')[-1])[:70], record['calls'], record['wall'], \
+                         record['cpu'], record['peakMem'] / 1024. ** 2, record['items']))
+        return '\n'.join(lines)
+
+
+def active():
+    # Returns the Profiler running, or None if profiling is off.
+    return __ACTIVE[0]
+
+
+def count(items):
+    # Adds items (e.g. number of spectra processed) to the current stage or
+    # function. Does nothing if profiling is off.
+    profiler = __running()
+    if profiler is not None:
+        profiler.count(items)
+
+
+def profiled(name):
+    # Decorator that records the calls of a function under the given name while
+    # a Profiler is running.
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = __running()
+            if profiler is None:
+                return func(*args, **kwargs)
+            level = profiler.open(name, True)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.close(level)
+        wrapper.unprofiled = func
+        return wrapper
+    return decorator
+
+
+def stage(name, items=None):
+    # Marks the start of a stage of the function being profiled (or of the
+    # script, outside profiled functions); it lasts until the next stage or the
+    # end of the function. Does nothing if profiling is off.
+    profiler = __running()
+    if profiler is not None:
+        profiler.open(name, False, items)
+
+
+def start(memory=True, functions=FUNCTIONS):
+    # Starts profiling (stopping any Profiler already running). Returns the new
+    # Profiler.
+    import astrotools as at
+    
+    if __ACTIVE[0] is not None:
+        stop()
+    profiler = Profiler(memory, functions)
+    for funcName in functions:
+        func = getattr(at, funcName)
+        profiler.patched[funcName] = func
+        setattr(at, funcName, profiled('astrotools.' + funcName)(func))
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        profiler.tracing = True
+    __ACTIVE[0] = profiler
+    return profiler
+
+
+def stop():
+    # Stops profiling. Returns the Profiler that was running (None if none).
+    import astrotools as at
+    
+    profiler = __ACTIVE[0]
+    if profiler is None:
+        return None
+    profiler.close(0)
+    for funcName in profiler.patched:
+        setattr(at, funcName, profiler.patched[funcName])
+    if profiler.tracing:
+        tracemalloc.stop()
+    __ACTIVE[0] = None
+    return profiler
+
+
+def __running():
+# Function used by count, profiled, and stage only
+# Returns the Profiler running, or None if profiling is off or if called from
+# another thread than the one that started it (e.g. read_spec workers).
+    profiler = __ACTIVE[0]
+    if profiler is None or profiler.thread != threading.get_ident():
+        return None
+    return profiler
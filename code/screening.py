@@ -0,0 +1,257 @@
+'''
+The main() procedure screens the objects of each spectral type and gravity against the NIR standard of the spectral type, and writes the keepers & rejects files that nir_opt_comp_strip.py uses to select the objects of each template.
+
+For each object, the NIR spectrum is smoothed, cut into the J, H, and K bands, and normalized (as in nir_opt_comp_strip.py); each band is then interpolated into the wavelength grid of the standard, scaled to best match it, and compared to it using the reduced chi2. Objects with reduced chi2 below the threshold in all three bands are keepers; the rest are rejects. The reduced chi2 of the full NIR spectrum is also calculated and written to the files, but it is not used to select objects.
+
+The chi2 of all objects of a spectral type and gravity are calculated at once with array operations; the spectral types and gravities can also be screened simultaneously in separate processes.
+
+NEEDED: 1) The objects catalog, NIR standards catalog, and NIR fits files used by
+           nir_opt_comp_strip.py (see nir_opt_comp_strip.DataSession).
+
+INPUT:  1) spTypes: Python list of spectral types to screen (e.g. ['L0','L1']).
+        2) gravs: Python list of gravities to screen (f, g, b).
+        3) sigmas: Dictionary with the chi2 threshold of each spectral type
+           (SIGMA for the ones not in it).
+        4) workers: Integer, number of processes in which to screen; if None,
+           all are screened one after the other.
+        5) write: Boolean, whether to write the keepers & rejects files.
+        6) session: nir_opt_comp_strip.DataSession object; if None, a new one is created.
+
+OUTPUT: 1) Dictionary that maps (spectral type, gravity) to the screening results
+           (see screen_group).
+        2) (if write=True) keepers & rejects files in session.folderIn.
+'''
+
+import os
+
+import numpy as np
+
+import def_constants as dc
+
+# Default reduced chi2 threshold, and the threshold of some spectral types
+SIGMA = 2.0
+SIGMAS = {'L1':2.3, 'L7':1.4, 'L8':1.4}
+
+GRAVS = ['f','g','b']
+
+# Bands screened, plus the full NIR spectrum (and its normalization limits)
+FULL_KEY = 'NIR'
+FULL_LIMS = [0.8, 2.4]
+FULL_NORM = [1.28, 1.32]
+CHI2_KEYS = dc.BANDS + [FULL_KEY]
+
+
+def chi2_stack(stdSpec, objSpecs):
+    # Reduced chi2 of many spectra against a standard spectrum, all at once.
+    # Each spectrum is interpolated into the wavelength grid of the standard and
+    # scaled by the factor that minimizes its chi2 (one degree of freedom).
+    # Returns an array with one chi2 per spectrum (nan if it has no data points
+    # in common with the standard).
+    import astrotools as at
+    
+    ip_spectra = at.resample_spec(objSpecs, mask=stdSpec[0])
+    fluxes = ip_spectra[1]
+    
+    # Variance of each point: object and standard uncertainties added (missing
+    # uncertainties count as zero; points with none at all are not used)
+    stdVar = np.nan_to_num(np.asarray(stdSpec[2], dtype=float) ** 2)
+    variance = np.zeros(fluxes.shape) + stdVar
+    if ip_spectra[2] is not None:
+        variance = variance + np.nan_to_num(ip_spectra[2] ** 2)
+    stdFlux = np.zeros(fluxes.shape) + np.asarray(stdSpec[1], dtype=float)
+    
+    valid = np.isfinite(fluxes) & np.isfinite(stdFlux) & np.isfinite(variance) \
+            & (variance > 0)
+    fluxes = np.where(valid, fluxes, 0.)
+    stdFlux = np.where(valid, stdFlux, 0.)
+    weights = np.where(valid, 1. / np.where(valid, variance, 1.), 0.)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.sum(fluxes * stdFlux * weights, axis=1) \
+                / np.sum(fluxes ** 2 * weights, axis=1)
+        chi2 = np.sum((scale[:,None] * fluxes - stdFlux) ** 2 * weights, axis=1)
+        numPoints = valid.sum(axis=1)
+        chi2 = np.where(numPoints > 1, chi2 / (numPoints - 1), np.nan)
+    
+    return chi2
+
+
+def prepare_spectra(spectra, specMeta):
+    # Smooths, cuts, and normalizes NIR spectra as nir_opt_comp_strip.main does.
+    # Returns a dictionary with the spectra of each band (keys in CHI2_KEYS);
+    # spectra that do not cover a band are None in it.
+    import astrotools as at
+    
+    smoothed = at.smooth_spec(spectra, specMeta=specMeta, winWidth=0)
+    bandLims = {FULL_KEY:FULL_LIMS}
+    normLims = {FULL_KEY:FULL_NORM}
+    for bandKey in dc.BANDS:
+        bandLims[bandKey] = dc.BAND_LIMS[bandKey]['lim']
+        normLims[bandKey] = dc.NORM_LIMS[bandKey]['lim']
+    
+    bands = at.sel_band(smoothed, bandLims)
+    if bands is None:
+        raise ValueError('prepare_spectra: the spectra could not be cut into the ' \
+                         'bands ' + ', '.join(CHI2_KEYS) + '.')
+    for bandKey in CHI2_KEYS:
+        # A band that no spectrum covers is left out of the screening
+        if bands[bandKey] is None:
+            bands[bandKey] = [None] * len(spectra)
+            continue
+        bands[bandKey] = at.norm_spec(bands[bandKey], normLims[bandKey])
+    
+    return bands
+
+
+def screen_group(stdBands, objBands, names, sigma):
+    # Screens a group of objects against their standard. stdBands and objBands
+    # are as returned by prepare_spectra (one spectrum and a list of them).
+    # Returns a dictionary with the object names ('names'), an array with their
+    # chi2 (one column per key in CHI2_KEYS, 'chi2'), and a boolean array that is
+    # True for keepers ('keep').
+    chi2 = np.zeros((len(names), len(CHI2_KEYS))) * np.nan
+    for keyIdx, bandKey in enumerate(CHI2_KEYS):
+        hasData = [spec is not None for spec in objBands[bandKey]]
+        if stdBands[bandKey][0] is None or not any(hasData):
+            continue
+        objSpecs = [spec for spec in objBands[bandKey] if spec is not None]
+        chi2[np.array(hasData),keyIdx] = chi2_stack(stdBands[bandKey][0], objSpecs)
+    
+    bandIdxs = [CHI2_KEYS.index(bandKey) for bandKey in dc.BANDS]
+    with np.errstate(invalid='ignore'):
+        keep = np.all(chi2[:,bandIdxs] < sigma, axis=1)
+    
+    return dict(names=names, chi2=chi2, keep=keep)
+
+
+def write_manifests(folderIn, spType, grav, sigma, result):
+    # Writes the keepers & rejects files of a spectral type and gravity, replacing
+    # any older files of the same spectral type and gravity. Both files are
+    # written to temporary files first and then moved into place, and older
+    # files with other names are removed only after that, so that readers
+    # always find a complete pair of files.
+    import tempfile
+    import catalog
+    
+    gravLabel = '' if grav == 'f' else grav
+    baseName = 'comp_' + spType + gravLabel + '_s%.1f_band_' % sigma
+    
+    contents = {}
+    for kind in catalog.MANIFEST_KINDS:
+        if kind == 'keepers':
+            rows = np.where(result['keep'])[0]
+            header = '# %i %s dwarfs used for template construction because\n' \
+                     '# reduced chi2 < %.5f in all bands (but not full spectrum)\n'
+        else:
+            rows = np.where(~result['keep'])[0]
+            header = '# %i %s dwarfs rejected from template construction because \n' \
+                     '# reduced chi2 > %.5f in any band (but not full spectrum)\n'
+        lines = [header % (len(rows), spType + gravLabel, sigma)]
+        lines.append('# Name\t' + '\t'.join([key + ' chi2' for key in CHI2_KEYS]) + '\n')
+        for row in rows:
+            name = result['names'][row]
+            if name.endswith('.fits'):
+                name = name[:-5]
+            chi2Txt = ['%.6g' % chi2 for chi2 in result['chi2'][row]]
+            lines.append(name + ' \t' + '\t'.join(chi2Txt) + '\n')
+        contents[kind] = lines
+    
+    tmpNames = {}
+    try:
+        for kind in catalog.MANIFEST_KINDS:
+            tmpHandle, tmpNames[kind] = tempfile.mkstemp(dir=folderIn, suffix='.tmp')
+            with os.fdopen(tmpHandle, 'w') as tmpFile:
+                tmpFile.writelines(contents[kind])
+        for kind in catalog.MANIFEST_KINDS:
+            os.replace(tmpNames[kind], folderIn + baseName + kind + '.txt')
+            del tmpNames[kind]
+    finally:
+        for tmpName in tmpNames.values():
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+    
+    newNames = [baseName + kind + '.txt' for kind in catalog.MANIFEST_KINDS]
+    for fileName in os.listdir(folderIn):
+        fileKey = catalog.manifest_key(fileName)
+        if fileKey is not None and fileKey[:2] == (spType, grav) and fileName not in newNames:
+            os.remove(folderIn + fileName)
+
+
+def main(spTypes=dc.SPTYPES, gravs=GRAVS, sigmas=None, workers=None, write=True, session=None):
+    
+    # 1. LOAD RELEVANT MODULES ------------------------------------------------
+    import nir_opt_comp_strip as nocs
+    
+    # 2. SET UP VARIABLES -----------------------------------------------------
+    if sigmas is None:
+        sigmas = SIGMAS
+    colNameRef     = nocs.HDR_FILE_IN[0]
+    colNameNIRfile = nocs.HDR_FILE_IN[9]
+    colNameRefS    = nocs.HDR_FILE_IN_STD[0]
+    colNameNIRS    = nocs.HDR_FILE_IN_STD[2]
+    
+    # 3. READ CATALOGS --------------------------------------------------------
+    if session is None:
+        session = nocs.DataSession()
+    data = session.data
+    dataS = session.dataS
+    
+    def nir_file(rowIdx):
+        fileName = data[colNameNIRfile][rowIdx]
+        if fileName[-4:] == '.dat' or fileName == 'include':
+            return None
+        return session.folderRoot + 'NIR/' + fileName
+    
+    # 4. GATHER STANDARD AND OBJECTS OF EACH GROUP ----------------------------
+    groups = []
+    for spType in spTypes:
+        stdRow = None
+        for stdIdx, stdType in enumerate(dataS[colNameNIRS]):
+            if stdType.upper().startswith(spType.upper()):
+                stdRow = session.catalog.refs.get(int(dataS[colNameRefS][stdIdx]))
+                break
+        if stdRow is None or nir_file(stdRow) is None:
+            print('No NIR standard found for ' + spType + '.')
+            continue
+        
+        for grav in gravs:
+            rows = [rowIdx for rowIdx in session.catalog.select(spType, grav) \
+                    if nir_file(rowIdx) is not None]
+            if len(rows) == 0:
+                continue
+            groups.append((spType, grav, stdRow, rows))
+    
+    # 5. READ AND PREPARE SPECTRA (each spectrum only once) -------------------
+    allRows = sorted(set([group[2] for group in groups] \
+                         + [rowIdx for group in groups for rowIdx in group[3]]))
+    specFiles = [nir_file(rowIdx) for rowIdx in allRows]
+    prepared = prepare_spectra(session.read_spec(specFiles), session.read_meta(specFiles))
+    rowPos = dict(zip(allRows, range(len(allRows))))
+    
+    # 6. SCREEN ALL GROUPS (simultaneously if requested) ----------------------
+    tasks = []
+    for spType, grav, stdRow, rows in groups:
+        stdBands = {}
+        objBands = {}
+        for bandKey in CHI2_KEYS:
+            stdBands[bandKey] = [prepared[bandKey][rowPos[stdRow]]]
+            objBands[bandKey] = [prepared[bandKey][rowPos[rowIdx]] for rowIdx in rows]
+        names = [str(data[colNameNIRfile][rowIdx]) for rowIdx in rows]
+        tasks.append((stdBands, objBands, names, sigmas.get(spType, SIGMA)))
+    
+    if workers is None or workers <= 1 or len(tasks) <= 1:
+        results = [screen_group(*task) for task in tasks]
+    else:
+        import concurrent.futures as cf
+        with cf.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(screen_group, *task) for task in tasks]
+            results = [future.result() for future in futures]
+    
+    # 7. WRITE KEEPERS & REJECTS FILES ----------------------------------------
+    screened = {}
+    for (spType, grav, stdRow, rows), task, result in zip(groups, tasks, results):
+        screened[(spType, grav)] = result
+        if write:
+            write_manifests(session.folderIn, spType, grav, task[3], result)
+    
+    return screened
@@ -0,0 +1,279 @@
+''' This updates the templates of a spectral type and gravity right away when objects are added to or removed from its keepers file, without rebuilding them: the template files (and templates.npz) in FOLDER_OUT_TMPL are rewritten from the sufficient statistics of each template, which are kept in STATS_FILE (written by make_templ.py).
+
+The statistics of a template (see TemplateStats) are those of its member spectra as they are (to re-normalize new members) and re-normalized (to get the template): counts, means and squared deviations, weighted sums, and the lowest & highest flux values at each wavelength. Adding or removing one spectrum takes time proportional to its number of wavelengths, whatever the number of members. Only when a removed object held all the lowest (or highest) values kept at some wavelengths are all member spectra read again, to find the min (or max) flux values of those wavelengths.
+
+The re-normalization factors of the members already in a template are not updated when others are added or removed (as they would be by a full rebuild), and the wavelength grid stays that of the template when it was built. The fingerprints of make_templ.py are not updated either, so the next run of make_templ.py rebuilds the updated templates exactly.
+
+INPUT:  1) spType: String, spectral type (e.g. L0).
+        2) grav: String, gravity (f, g, b).
+        3) session: nir_opt_comp_strip.DataSession object; if None, a new one is
+           created.
+        4) folderOut: String, folder with the templates and STATS_FILE.
+
+OUTPUT: 1) Dictionary with the names of the templates updated ('templates'), and the
+           NIR file names of the objects added ('added') and removed ('removed').
+        2) Template files, templates.npz, and STATS_FILE updated in folderOut.
+
+Run it from the command line as: python templ_update.py L0 g
+'''
+
+import os
+
+import numpy as np
+
+import def_constants as dc
+
+STATS_FILE = 'templates_stats.npz'
+CONTAINER = 'templates'
+
+# Number of lowest & highest flux values kept at each wavelength
+DEPTH = 3
+
+
+class TemplateStats(object):
+    '''
+    Sufficient statistics of a template and its members, as built by nir_opt_comp_strip.make_template: member spectra re-normalized to their weighted mean, combined using their uncertainties as weights, and the simple variance.
+    
+    *specs*
+      Python list of member spectra (as gathered by nir_opt_comp_strip.main).
+    *names*
+      Python list of NIR file names of the members.
+    *renormalize*
+      Boolean, whether member spectra are re-normalized.
+    *state*
+      Dictionary returned by *state*, to restore TemplateStats saved before (*specs*, *names* and *renormalize* are then ignored).
+    '''
+    
+    def __init__(self, specs=None, names=None, renormalize=True, state=None):
+        import astrotools as at
+        
+        if state is not None:
+            self.renormalize = bool(state['renormalize'])
+            self.first = None
+            if self.renormalize:
+                self.first = at.SpecAccumulator(state=_sub_state(state, 'first/'))
+            self.final = at.SpecAccumulator(state=_sub_state(state, 'final/'))
+            self.names = [str(name) for name in state['names']]
+            self.ids = [int(specId) for specId in state['ids']]
+            self.factors = [float(factor) for factor in state['factors']]
+            return
+        
+        grid = specs[0][0]
+        self.renormalize = renormalize
+        self.names = list(names)
+        self.ids = list(range(len(specs)))
+        self.factors = [1.] * len(specs)
+        
+        # Re-normalization factors, as comb_spec gives them
+        self.first = None
+        if renormalize:
+            self.first = at.SpecAccumulator(grid, DEPTH)
+            self.first.add(specs, ids=self.ids)
+            self.factors = list(self.first.renorm_factors(specs))
+        
+        self.final = at.SpecAccumulator(grid, DEPTH)
+        self.final.add(self.scaled(specs, self.factors), ids=self.ids)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def add(self, spec, name):
+        # Adds a member. Its re-normalization factor is that to the weighted
+        # mean of all members (itself included).
+        specId = self.final.nextId
+        factor = 1.
+        if self.renormalize:
+            self.first.add([spec], ids=[specId])
+            factor = float(self.first.renorm_factors([spec])[0])
+        self.final.add(self.scaled([spec], [factor]), ids=[specId])
+        self.names.append(name)
+        self.ids.append(specId)
+        self.factors.append(factor)
+    
+    def remove(self, spec, name):
+        # Removes a member (spec must be the same spectrum it was added with).
+        memIdx = self.names.index(name)
+        specId = self.ids[memIdx]
+        if self.renormalize:
+            self.first.remove([spec], [specId])
+        self.final.remove(self.scaled([spec], [self.factors[memIdx]]), [specId])
+        del self.names[memIdx]
+        del self.ids[memIdx]
+        del self.factors[memIdx]
+    
+    def refill(self, specs):
+        # Finds again the min & max flux values where they are stale, given the
+        # spectra of all members (in the order of names).
+        self.final.refill(self.scaled(specs, self.factors), self.ids)
+    
+    def scaled(self, specs, factors):
+        # Returns the spectra divided by their re-normalization factors.
+        if not self.renormalize:
+            return specs
+        scaled = []
+        for spec, factor in zip(specs, factors):
+            scaled.append([spec[0]] + [spec[rowIdx] / factor for rowIdx in range(1, len(spec))])
+        return scaled
+    
+    def state(self):
+        # Returns a dictionary of numpy arrays with all the statistics, to save
+        # them and restore them later (see state above).
+        state = dict(renormalize=np.array(self.renormalize), names=np.array(self.names, \
+                     dtype=str), ids=np.array(self.ids, dtype=int), \
+                     factors=np.array(self.factors, dtype=float))
+        for prefix, accumulator in [('first/', self.first), ('final/', self.final)]:
+            if accumulator is None:
+                continue
+            accState = accumulator.state()
+            for key in accState:
+                state[prefix + key] = accState[key]
+        return state
+    
+    def template(self):
+        # Returns the template (wl, mean flux, variance, min flux, max flux) as
+        # make_template does, or None if there are fewer than two members.
+        if len(self.names) < 2:
+            return None
+        template = self.final.result(extremes=True)
+        template[2] = self.final.result(forcesimple=True)[2]
+        return template
+
+
+def load_stats(folder=dc.FOLDER_OUT_TMPL):
+    # Returns a dictionary with the TemplateStats of each template saved in
+    # STATS_FILE (empty if there is none).
+    fileName = folder + STATS_FILE
+    allStats = {}
+    if not os.path.exists(fileName):
+        return allStats
+    with np.load(fileName) as arrays:
+        states = {}
+        for key in arrays.files:
+            templName, field = key.split('/', 1)
+            states.setdefault(templName, {})[field] = arrays[key]
+    for templName in states:
+        allStats[templName] = TemplateStats(state=states[templName])
+    return allStats
+
+
+def save_stats(allStats, folder=dc.FOLDER_OUT_TMPL, keep=True):
+    # Saves the TemplateStats of each template into STATS_FILE. If keep=True,
+    # the statistics of other templates already in the file are kept.
+    import tempfile
+    
+    if keep:
+        oldStats = load_stats(folder)
+        oldStats.update(allStats)
+        allStats = oldStats
+    arrays = {}
+    for templName in sorted(allStats):
+        state = allStats[templName].state()
+        for field in state:
+            arrays[templName + '/' + field] = state[field]
+    
+    # Write to a temporary file first so that readers never see partial files
+    tmpHandle, tmpName = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(tmpHandle, 'wb') as tmpFile:
+        np.savez(tmpFile, **arrays)
+    os.replace(tmpName, folder + STATS_FILE)
+
+
+def save_container(templArrays, folder=dc.FOLDER_OUT_TMPL):
+    # Updates the .npz file holding all templates with the given template
+    # arrays (as returned by astrotools.save_templ), keeping the other ones.
+    containerName = folder + CONTAINER + '.npz'
+    allArrays = {}
+    if os.path.exists(containerName):
+        with np.load(containerName) as oldArrays:
+            for templName in oldArrays.files:
+                allArrays[templName] = oldArrays[templName]
+    allArrays.update(templArrays)
+    if len(templArrays) > 0 or not os.path.exists(containerName):
+        np.savez(containerName, **allArrays)
+
+
+def main(spType, grav, session=None, folderOut=dc.FOLDER_OUT_TMPL):
+    
+    # 1. LOAD RELEVANT MODULES ------------------------------------------------
+    import astrotools as at
+    import catalog
+    import nir_opt_comp_strip as nocs
+    
+    # 2. SET UP VARIABLES -----------------------------------------------------
+    colNameNIRfile = nocs.HDR_FILE_IN[9]
+    allStats = load_stats(folderOut)
+    if session is None:
+        session = nocs.DataSession()
+    data = session.data
+    
+    # 3. FIND CURRENT KEEPERS -------------------------------------------------
+    manifests = catalog.load_manifests(session.folderIn)
+    keepers = manifests.get(spType, grav, 'keepers')
+    rowOfName = {}
+    for rowIdx in session.catalog.select(spType):
+        rowOfName.setdefault(str(data[colNameNIRfile][rowIdx]), rowIdx)
+    wanted = [name for name in rowOfName if keepers is not None and name in keepers]
+    
+    # 4. ADD & REMOVE MEMBERS OF EACH TEMPLATE --------------------------------
+    templates = {}
+    added = set()
+    removed = set()
+    for band in dc.BANDS:
+        templName = spType + band + '_' + grav
+        stats = allStats.get(templName)
+        if stats is None:
+            print('No statistics kept for ' + templName + '; run make_templ.py --force.')
+            continue
+        
+        toAdd = [name for name in wanted if name not in stats.names]
+        toRemove = [name for name in stats.names if name not in wanted]
+        if len(toAdd) + len(toRemove) == 0:
+            continue
+        for name in toRemove:
+            if name not in rowOfName:
+                print(name + ' not found among ' + spType + ' objects; run make_templ.py' \
+                      ' to rebuild ' + templName + '.')
+        toRemove = [name for name in toRemove if name in rowOfName]
+        
+        # Only the spectra of the objects added or removed are read
+        rows = [rowOfName[name] for name in toRemove + toAdd]
+        specs = nocs.member_spectra(session, rows)[band]
+        for name, spec in zip(toRemove + toAdd, specs):
+            if spec is None:
+                if name in toRemove:
+                    print('No spectrum of ' + name + ' to remove it; run make_templ.py' \
+                          ' to rebuild ' + templName + '.')
+            elif name in toRemove:
+                stats.remove(spec, name)
+                removed.add(name)
+            else:
+                stats.add(spec, name)
+                added.add(name)
+        
+        if stats.final.stale.any():
+            stats.refill(nocs.member_spectra(session, [rowOfName[name] for name \
+                                                       in stats.names])[band])
+        templates[templName] = stats.template()
+        if templates[templName] is None:
+            print(templName + ' has fewer than two members; its files are left as they were.')
+    
+    # 5. SAVE TEMPLATES & STATISTICS ------------------------------------------
+    templArrays = at.save_templ(templates, folderOut)
+    save_container(templArrays, folderOut)
+    save_stats(allStats, folderOut, keep=False)
+    
+    return dict(templates=sorted(templArrays), added=sorted(added), removed=sorted(removed))
+
+
+def _sub_state(state, prefix):
+# Function used by TemplateStats only
+# Returns the entries of state whose keys start with prefix (without it).
+    return dict([(key[len(prefix):], state[key]) for key in state if key.startswith(prefix)])
+
+
+if __name__ == '__main__':
+    import sys
+    result = main(sys.argv[1], sys.argv[2])
+    print('Updated %i templates: %s' % (len(result['templates']), ', '.join(result['templates'])))
+    print('Added: ' + ', '.join(result['added']))
+    print('Removed: ' + ', '.join(result['removed']))